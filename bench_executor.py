@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+代码执行器性能基准脚本
+用于对比执行路径优化前后的单次执行开销
+
+运行方式（在插件所在目录的上一级执行）:
+    python -m <插件目录名>.bench_executor
+"""
+
+import asyncio
+import random
+import re
+import statistics
+import string
+import subprocess
+import sys
+import tempfile
+import time
+
+from . import executor
+
+# fork 服务器基准使用的代码片段：空代码与典型的数据处理
+FORK_BENCH_SNIPPETS = {
+    "空代码 print(1)": "print(1)",
+    "pandas 计算": (
+        "df = pd.DataFrame(np.random.rand(20000, 8))\n"
+        "print(df.describe().loc['mean'].sum())"
+    ),
+}
+
+
+def _measure(func, rounds: int):
+    """执行 func rounds 次，返回每次耗时（毫秒）"""
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def _report(name: str, timings):
+    print(f"  {name:<28} 中位数 {statistics.median(timings):8.2f} ms  "
+          f"平均 {statistics.mean(timings):8.2f} ms  最小 {min(timings):8.2f} ms")
+
+
+def bench_namespace_template(rounds: int = 200):
+    """空代码片段：每次重建注入库命名空间 vs 浅拷贝命名空间模板"""
+    print("🔍 基准: 空代码片段的命名空间构建开销")
+
+    # 预热：确保库已在 sys.modules 中，只比较命名空间构建本身
+    template = executor.get_namespace_template(True)
+
+    def rebuild_each_time():
+        # 旧行为：每次执行都遍历 LIBS_TO_INJECT 导入并重试特殊库
+        executor._build_namespace(True)
+        exec("pass", {})
+
+    def copy_template():
+        exec("pass", dict(template))
+
+    before = _measure(rebuild_each_time, rounds)
+    after = _measure(copy_template, rounds)
+    _report("每次重建命名空间", before)
+    _report("浅拷贝命名空间模板", after)
+    saved = statistics.median(before) - statistics.median(after)
+    print(f"  ✅ 每次执行节省约 {saved:.3f} ms")
+
+
+# 在全新解释器中计时单次 run_code，反映插件进程内（asyncio.to_thread）首次执行的真实开销
+_COLD_RUN_SCRIPT = """
+import sys, tempfile, time
+from {package} import executor
+executor.get_namespace_template(True)
+start = time.perf_counter()
+executor.run_code("print(1 + 1)", tempfile.mkdtemp(), needs_plotting={eager})
+print((time.perf_counter() - start) * 1000, 'matplotlib' in sys.modules)
+"""
+
+
+def bench_lazy_plotting(rounds: int = 200):
+    """不绘图的简单代码：每次执行都配置 matplotlib（旧行为） vs 首次接触绘图库时才配置"""
+    print("🔍 基准: 简单代码 print(1 + 1) 的绘图环境配置开销")
+    output_dir = tempfile.mkdtemp()
+    executor.get_namespace_template(True)
+
+    def run(eager):
+        return lambda: executor.run_code("print(1 + 1)", output_dir, needs_plotting=eager)
+
+    print("  [常驻进程，matplotlib 已导入]")
+    run(True)()  # 预热：导入 matplotlib 并完成字体检测
+    _report("每次配置绘图环境", _measure(run(True), rounds))
+    _report("按需配置（导入钩子）", _measure(run(False), rounds))
+
+    print("  [全新解释器的首次执行，命名空间模板已构建]")
+    for name, eager in (("每次配置绘图环境", True), ("按需配置（导入钩子）", False)):
+        timings, loaded = [], False
+        for _ in range(3):
+            out = subprocess.run(
+                [sys.executable, "-c", _COLD_RUN_SCRIPT.format(package=__package__, eager=eager)],
+                check=True, capture_output=True, text=True,
+            ).stdout.split()
+            timings.append(float(out[0]))
+            loaded = out[1] == "True"
+        _report(f"{name}{'（加载了 matplotlib）' if loaded else ''}", timings)
+
+
+def bench_fork_server(rounds: int = 20):
+    """asyncio.to_thread 插件进程内执行 vs 常驻工作进程 vs fork 服务器模式"""
+    print("🔍 基准: 单次执行的端到端耗时（含调度与结果回传）")
+    try:
+        from .worker_pool import WorkerPool
+    except ImportError as e:
+        print(f"  ⚠️ 无法导入执行进程池（需要 AstrBot 环境）: {e}")
+        return
+    output_dir = tempfile.mkdtemp()
+    options = {"file_output_dir": output_dir, "restricted_libraries": [], "data_dir": output_dir}
+    executor.init_worker(options)
+
+    async def run_rounds(execute, code):
+        await execute(code)  # 预热
+        timings = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            result = await execute(code)
+            timings.append((time.perf_counter() - start) * 1000)
+            assert result["success"], result["error"]
+        return timings
+
+    async def bench():
+        pools = {
+            "常驻工作进程": WorkerPool(1, 0, options),
+            "fork 服务器": WorkerPool(1, 0, dict(options, fork_per_task=True)),
+        }
+        for pool in pools.values():
+            await pool.start()
+        try:
+            for name, code in FORK_BENCH_SNIPPETS.items():
+                print(f"  [{name}]")
+                _report("asyncio.to_thread（当前）",
+                        await run_rounds(lambda c: asyncio.to_thread(executor.run_code, c, output_dir), code))
+                for pool_name, pool in pools.items():
+                    _report(pool_name, await run_rounds(lambda c, p=pool: p.execute({"code": c}, timeout=60), code))
+        finally:
+            for pool in pools.values():
+                await pool.shutdown()
+
+    asyncio.run(bench())
+
+    # 参照：每次执行都启动全新解释器并重新导入重型库
+    fresh = _measure(lambda: subprocess.run(
+        [sys.executable, "-c", "import numpy, pandas, matplotlib.pyplot"], check=True
+    ), 3)
+    _report("全新解释器（仅导入库）", fresh)
+    print("  ✅ fork 服务器每次执行都在全新子进程中完成，残留状态随子进程退出一并清理")
+
+
+def _legacy_policy_check(code: str, keywords, libraries):
+    """旧实现：逐个关键词子串查找，每个库每次调用都编译正则并扫描两遍源码"""
+    code_lower = code.lower()
+    matched = {kw for kw in keywords if kw and kw in code_lower}
+    for lib in libraries:
+        pattern_import = re.compile(r"^(\s*(import|from)\s+" + re.escape(lib) + r"\b)", re.IGNORECASE | re.MULTILINE)
+        if pattern_import.search(code) or lib + "." in code_lower:
+            matched.add(lib)
+    return matched
+
+
+def bench_policy_engine(rounds: int = 20):
+    """非管理员安全检查：旧的逐项扫描 vs 策略引擎（首次检查与命中缓存）"""
+    print("🔍 基准: 100KB 代码片段的安全策略检查")
+    from .policy import PolicyEngine
+    from . import preflight as preflight_module
+
+    # 100KB 的合法代码：重复拼接本模块源码中的函数体
+    with open(executor.__file__, encoding="utf-8") as f:
+        source = f.read()
+    code = (source * (100_000 // len(source) + 1))[:100_000]
+    code = code[:code.rfind("\ndef ")]
+    default_keywords = ["os.system", "subprocess", "popen", "shell=true", "eval(", "exec(",
+                        "shutil.rmtree", "os.remove(", "os.rmdir("]
+    libraries = ["subprocess", "socket", "ctypes", "psutil", "paramiko"]
+    rng = random.Random(0)
+    alphabet = string.ascii_lowercase + "._("
+
+    for count in (len(default_keywords), 200, 1000):
+        keywords = default_keywords + [
+            "".join(rng.choice(alphabet) for _ in range(rng.randint(6, 16))) for _ in range(count - len(default_keywords))
+        ]
+        engine = PolicyEngine(keywords, libraries)
+
+        # 预检（编译与 AST 分析）在插件中无论是否启用检查都会执行，这里只计检查本身
+        pre = preflight_module.preflight(code)
+
+        def engine_cold():
+            engine._verdicts.clear()
+            engine.check(code, pre)
+
+        print(f"  [{count} 个关键词，{len(code) // 1024}KB 代码]")
+        _report("逐项扫描（旧实现）", _measure(lambda: _legacy_policy_check(code, keywords, libraries), rounds))
+        _report("策略引擎首次检查", _measure(engine_cold, rounds))
+        _report("策略引擎命中缓存", _measure(lambda: engine.check(code, pre), rounds))
+
+
+def bench_import_guard(rounds: int = 20, imports: int = 20_000):
+    """运行时导入拦截对合法导入的开销：管理员执行 vs 启用拦截的非管理员执行"""
+    print(f"🔍 基准: 单次执行中 {imports} 次合法导入")
+    output_dir = tempfile.mkdtemp()
+    code = compile(f"for _ in range({imports}):\n    import json, os.path\n    from collections import abc\n",
+                   "<string>", "exec")
+    restricted = ["subprocess", "socket", "ctypes", "psutil", "paramiko"]
+    for name, is_admin in (("管理员（不拦截）", True), ("非管理员（导入拦截）", False)):
+        _report(name, _measure(
+            lambda a=is_admin: executor.run_code("", output_dir, is_admin_flag=a, restricted_libraries=restricted,
+                                                 compiled=code), rounds
+        ))
+
+
+def main():
+    """主基准函数"""
+    print("🚀 开始代码执行器性能基准测试...\n")
+    bench_namespace_template()
+    print()
+    bench_lazy_plotting()
+    print()
+    bench_policy_engine()
+    print()
+    bench_import_guard()
+    print()
+    bench_fork_server()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""用户状态检查点
+
+代码中通过 persist(name, obj) 发布的对象按会话（unified_msg_origin）保存到插件数据目录，
+插件重启或热重载后，会话下一次执行引用到该变量名时再从磁盘恢复。
+
+本模块运行在工作进程中，与 executor.py 一样不导入 AstrBot 框架。
+序列化使用 pickle 协议 5：numpy 数组、DataFrame 等的大块数据以带外缓冲区原样写入文件，
+读取时直接引用文件内容，避免额外的内存拷贝。
+"""
+import hashlib
+import logging
+import os
+import pickle
+import struct
+from typing import Any, Dict, List, Set
+
+logger = logging.getLogger("astrbot")
+
+# 检查点根目录名（位于插件数据目录）
+STATE_DIR = "session_state"
+
+# 文件格式：魔数 | 缓冲区个数 | pickle 数据长度 | 各缓冲区长度 | pickle 数据 | 各缓冲区数据
+_MAGIC = b"CKP5"
+_HEADER = struct.Struct("<4sIQ")
+_LENGTH = struct.Struct("<Q")
+
+
+def referenced_names(code) -> Set[str]:
+    """收集代码对象（含嵌套函数、类、推导式）中引用到的全部名称"""
+    names = set(code.co_names) | set(code.co_varnames)
+    for const in code.co_consts:
+        if hasattr(const, "co_names"):
+            names |= referenced_names(const)
+    return names
+
+
+class StateStore:
+    """单个会话的检查点存储"""
+
+    def __init__(self, data_dir: str, scope: str, max_bytes: int = 0):
+        self.dir = os.path.join(data_dir, STATE_DIR, hashlib.sha256(scope.encode("utf-8")).hexdigest()[:24])
+        self.max_bytes = max_bytes
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.dir, f"{name}.ckpt")
+
+    def names(self) -> List[str]:
+        """已保存的对象名"""
+        try:
+            return [f[:-5] for f in os.listdir(self.dir) if f.endswith(".ckpt")]
+        except OSError:
+            return []
+
+    def total_bytes(self, exclude: str = None) -> int:
+        total = 0
+        for name in self.names():
+            if name != exclude:
+                try:
+                    total += os.path.getsize(self._path(name))
+                except OSError:
+                    pass
+        return total
+
+    def save(self, name: str, obj: Any) -> int:
+        """保存对象，返回写入的字节数
+
+        :raises ValueError: 名称不合法、对象无法序列化或超出存储上限
+        """
+        if not isinstance(name, str) or not name.isidentifier():
+            raise ValueError(f"persist 的名称必须是合法的变量名: {name!r}")
+        buffers = []
+        try:
+            data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+        except Exception as e:
+            raise ValueError(f"对象 {name} 无法序列化，不能持久化: {e}") from e
+        raw_buffers = [buffer.raw() for buffer in buffers]
+        size = _HEADER.size + len(data) + sum(_LENGTH.size + b.nbytes for b in raw_buffers)
+        if self.max_bytes and self.total_bytes(exclude=name) + size > self.max_bytes:
+            raise ValueError(
+                f"持久化 {name} 需要 {size / 1024 / 1024:.1f}MB，超出当前会话的存储上限 "
+                f"{self.max_bytes / 1024 / 1024:.0f}MB"
+            )
+
+        os.makedirs(self.dir, exist_ok=True)
+        tmp_path = self._path(name) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, len(raw_buffers), len(data)))
+            for b in raw_buffers:
+                f.write(_LENGTH.pack(b.nbytes))
+            f.write(data)
+            for b in raw_buffers:
+                f.write(b)
+        # 先写临时文件再替换，进程中途被终止也不会留下损坏的检查点
+        os.replace(tmp_path, self._path(name))
+        return size
+
+    def load(self, name: str) -> Any:
+        with open(self._path(name), "rb") as f:
+            content = bytearray(f.read())
+        magic, buffer_count, data_length = _HEADER.unpack_from(content)
+        if magic != _MAGIC:
+            raise ValueError(f"检查点 {name} 格式无效")
+        offset = _HEADER.size
+        lengths = []
+        for _ in range(buffer_count):
+            lengths.append(_LENGTH.unpack_from(content, offset)[0])
+            offset += _LENGTH.size
+        view = memoryview(content)
+        data = view[offset:offset + data_length]
+        offset += data_length
+        buffers = []
+        for length in lengths:
+            buffers.append(view[offset:offset + length])
+            offset += length
+        # 带外缓冲区直接引用读入的 bytearray，恢复出的数组可写且无需再次拷贝
+        return pickle.loads(data, buffers=buffers)
+
+    def restore_into(self, namespace: Dict[str, Any], wanted: Set[str]) -> List[str]:
+        """把代码引用到、且命名空间中尚不存在的已保存对象加载进命名空间，返回恢复的名称"""
+        restored = []
+        for name in self.names():
+            if name not in wanted or name in namespace:
+                continue
+            try:
+                namespace[name] = self.load(name)
+                restored.append(name)
+            except Exception as e:
+                logger.warning(f"恢复持久化对象 {name} 失败: {e}")
+        return restored
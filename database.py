@@ -2,11 +2,48 @@ import sqlite3
 import json
 import asyncio
 import aiosqlite
+from collections import Counter
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 from astrbot.api import logger
 
 
+# 基础表结构之后新增的列，旧数据库在初始化时自动补齐
+EXTRA_COLUMNS = {
+    "status": "TEXT",  # success / failed / killed（超时被强制终止）/ rejected（执行队列已满被拒绝）
+    "reclaim_time": "REAL",  # 强制终止执行进程并回收资源的耗时（秒）
+    "libraries_used": "TEXT",  # JSON格式存储本次执行实际用到的注入库
+    "output_file": "TEXT",  # 输出超出捕获预算时保存完整输出的溢出文件路径
+    "queue_lane": "TEXT",  # 调度通道：admin / user
+    "queue_wait": "REAL",  # 在执行队列中等待的秒数
+    "peak_rss_mb": "REAL",  # 执行期间的峰值常驻内存（MB）
+    "cpu_user_time": "REAL",  # 用户态 CPU 时间（秒）
+    "cpu_sys_time": "REAL",  # 内核态 CPU 时间（秒）
+    "wall_time": "REAL",  # 用户代码本身的运行时间（秒），不含进程通信与结果处理
+    "session_reused": "INTEGER",  # 会话模式下是否复用了已有命名空间（非会话模式为 NULL）
+    "figure_stats": "TEXT",  # JSON格式存储每张图表的编码统计（格式、字节数、编码耗时等）
+    "blocked_imports": "TEXT",  # JSON格式存储执行时被安全策略拦截的导入
+}
+
+RECORD_COLUMNS = [
+    "id", "sender_id", "sender_name", "code", "description", "success",
+    "output", "error_msg", "file_paths", "execution_time", "created_at",
+] + list(EXTRA_COLUMNS)
+
+
+def _row_to_record(row) -> Dict[str, Any]:
+    """将查询结果行转换为记录字典"""
+    record = dict(zip(RECORD_COLUMNS, row))
+    record['success'] = bool(record['success'])
+    record['file_paths'] = json.loads(record['file_paths']) if record['file_paths'] else []
+    record['libraries_used'] = json.loads(record['libraries_used']) if record['libraries_used'] else []
+    record['figure_stats'] = json.loads(record['figure_stats']) if record['figure_stats'] else []
+    record['blocked_imports'] = json.loads(record['blocked_imports']) if record['blocked_imports'] else []
+    if not record.get('status'):
+        record['status'] = 'success' if record['success'] else 'failed'
+    return record
+
+
 class ExecutionHistoryDB:
     """代码执行历史记录数据库管理类"""
     
@@ -33,6 +70,14 @@ class ExecutionHistoryDB:
                     )
                 """)
                 
+                # 为旧版本数据库补齐新增的列
+                async with db.execute("PRAGMA table_info(execution_history)") as cursor:
+                    existing_columns = {row[1] for row in await cursor.fetchall()}
+                for column, column_type in EXTRA_COLUMNS.items():
+                    if column not in existing_columns:
+                        await db.execute(f"ALTER TABLE execution_history ADD COLUMN {column} {column_type}")
+                        logger.info(f"数据库已添加新列: {column}")
+                
                 # 创建索引提高查询性能
                 await db.execute("""
                     CREATE INDEX IF NOT EXISTS idx_sender_id ON execution_history(sender_id)
@@ -59,17 +104,61 @@ class ExecutionHistoryDB:
                                  output: str = None,
                                  error_msg: str = None,
                                  file_paths: List[str] = None,
-                                 execution_time: float = None) -> int:
-        """添加执行记录"""
+                                 execution_time: float = None,
+                                 status: str = None,
+                                 reclaim_time: float = None,
+                                 libraries_used: List[str] = None,
+                                 output_file: str = None,
+                                 queue_lane: str = None,
+                                 queue_wait: float = None,
+                                 resource_usage: Dict[str, float] = None,
+                                 session_reused: bool = None,
+                                 figure_stats: List[Dict[str, Any]] = None,
+                                 blocked_imports: List[str] = None) -> int:
+        """添加执行记录
+        :param status: 'success' / 'failed' / 'killed' / 'rejected'，默认根据 success 推断
+        :param reclaim_time: 超时强制终止后回收资源的耗时（秒）
+        :param libraries_used: 本次执行实际用到的注入库
+        :param output_file: 完整输出的溢出文件路径
+        :param queue_lane: 调度通道 'admin' / 'user'
+        :param queue_wait: 在执行队列中等待的秒数
+        :param resource_usage: 执行端统计的资源使用，键为 peak_rss_mb / cpu_user_time / cpu_sys_time / wall_time
+        :param session_reused: 会话模式下是否复用了已有命名空间，非会话模式传 None
+        :param figure_stats: 每张图表的编码统计，键为 name / format / bytes / encode_ms / dpi / quality 等
+        :param blocked_imports: 非管理员执行时被运行时导入拦截阻止的模块名
+        """
         try:
-            file_paths_json = json.dumps(file_paths or [], ensure_ascii=False)
+            values = {
+                "sender_id": sender_id,
+                "sender_name": sender_name,
+                "code": code,
+                "description": description,
+                "success": success,
+                "output": output,
+                "error_msg": error_msg,
+                "file_paths": json.dumps(file_paths or [], ensure_ascii=False),
+                "execution_time": execution_time,
+                "status": status or ('success' if success else 'failed'),
+                "reclaim_time": reclaim_time,
+                "libraries_used": json.dumps(libraries_used or [], ensure_ascii=False),
+                "output_file": output_file,
+                "queue_lane": queue_lane,
+                "queue_wait": queue_wait,
+                "session_reused": session_reused,
+                "figure_stats": json.dumps(figure_stats, ensure_ascii=False) if figure_stats else None,
+                "blocked_imports": json.dumps(blocked_imports, ensure_ascii=False) if blocked_imports else None,
+            }
+            usage = resource_usage or {}
+            for column in ("peak_rss_mb", "cpu_user_time", "cpu_sys_time", "wall_time"):
+                values[column] = usage.get(column)
+            columns = ", ".join(values)
+            placeholders = ", ".join("?" for _ in values)
             
             async with aiosqlite.connect(self.db_path) as db:
-                cursor = await db.execute("""
-                    INSERT INTO execution_history 
-                    (sender_id, sender_name, code, description, success, output, error_msg, file_paths, execution_time)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (sender_id, sender_name, code, description, success, output, error_msg, file_paths_json, execution_time))
+                cursor = await db.execute(
+                    f"INSERT INTO execution_history ({columns}) VALUES ({placeholders})",
+                    tuple(values.values())
+                )
                 
                 await db.commit()
                 record_id = cursor.lastrowid
@@ -166,8 +255,7 @@ class ExecutionHistoryDB:
                 
                 # 获取分页数据
                 data_query = f"""
-                    SELECT id, sender_id, sender_name, code, description, success, 
-                           output, error_msg, file_paths, execution_time, created_at
+                    SELECT {", ".join(RECORD_COLUMNS)}
                     FROM execution_history 
                     {where_clause}
                     ORDER BY created_at DESC 
@@ -178,22 +266,7 @@ class ExecutionHistoryDB:
                     rows = await cursor.fetchall()
                 
                 # 处理结果
-                records = []
-                for row in rows:
-                    record = {
-                        'id': row[0],
-                        'sender_id': row[1],
-                        'sender_name': row[2],
-                        'code': row[3],
-                        'description': row[4],
-                        'success': bool(row[5]),
-                        'output': row[6],
-                        'error_msg': row[7],
-                        'file_paths': json.loads(row[8]) if row[8] else [],
-                        'execution_time': row[9],
-                        'created_at': row[10]
-                    }
-                    records.append(record)
+                records = [_row_to_record(row) for row in rows]
                 
                 return {
                     'records': records,
@@ -210,9 +283,8 @@ class ExecutionHistoryDB:
         """获取单条执行记录详情"""
         try:
             async with aiosqlite.connect(self.db_path) as db:
-                async with db.execute("""
-                    SELECT id, sender_id, sender_name, code, description, success, 
-                           output, error_msg, file_paths, execution_time, created_at
+                async with db.execute(f"""
+                    SELECT {", ".join(RECORD_COLUMNS)}
                     FROM execution_history 
                     WHERE id = ?
                 """, (record_id,)) as cursor:
@@ -221,19 +293,7 @@ class ExecutionHistoryDB:
                 if not row:
                     return None
                 
-                return {
-                    'id': row[0],
-                    'sender_id': row[1],
-                    'sender_name': row[2],
-                    'code': row[3],
-                    'description': row[4],
-                    'success': bool(row[5]),
-                    'output': row[6],
-                    'error_msg': row[7],
-                    'file_paths': json.loads(row[8]) if row[8] else [],
-                    'execution_time': row[9],
-                    'created_at': row[10]
-                }
+                return _row_to_record(row)
         except Exception as e:
             logger.error(f"获取执行详情失败: {e}", exc_info=True)
             raise
@@ -253,6 +313,56 @@ class ExecutionHistoryDB:
                 # 失败执行次数
                 failed_executions = total_executions - successful_executions
                 
+                # 超时被强制终止的次数
+                async with db.execute("SELECT COUNT(*) FROM execution_history WHERE status = 'killed'") as cursor:
+                    killed_executions = (await cursor.fetchone())[0]
+                
+                # 平均资源回收耗时
+                async with db.execute("SELECT AVG(reclaim_time) FROM execution_history WHERE status = 'killed'") as cursor:
+                    avg_reclaim_time = (await cursor.fetchone())[0]
+                
+                # 注入库的实际使用次数
+                library_usage = Counter()
+                async with db.execute(
+                    "SELECT libraries_used FROM execution_history WHERE libraries_used IS NOT NULL"
+                ) as cursor:
+                    async for (libraries_json,) in cursor:
+                        library_usage.update(json.loads(libraries_json))
+                
+                # 各调度通道的排队等待时间
+                queue_wait_by_lane = {}
+                async with db.execute("""
+                    SELECT queue_lane, COUNT(*), AVG(queue_wait), MAX(queue_wait) FROM execution_history
+                    WHERE queue_lane IS NOT NULL GROUP BY queue_lane
+                """) as cursor:
+                    async for lane, count, avg_wait, max_wait in cursor:
+                        queue_wait_by_lane[lane] = {
+                            'count': count,
+                            'avg_wait': round(avg_wait or 0, 3),
+                            'max_wait': round(max_wait or 0, 3),
+                        }
+                
+                # 资源使用概况，用于根据真实数据调整资源限制
+                async with db.execute("""
+                    SELECT AVG(peak_rss_mb), MAX(peak_rss_mb), AVG(cpu_user_time + cpu_sys_time),
+                           MAX(cpu_user_time + cpu_sys_time)
+                    FROM execution_history WHERE peak_rss_mb IS NOT NULL
+                """) as cursor:
+                    avg_rss, max_rss, avg_cpu, max_cpu = await cursor.fetchone()
+                resource_usage = {
+                    'avg_peak_rss_mb': round(avg_rss, 2) if avg_rss is not None else None,
+                    'max_peak_rss_mb': round(max_rss, 2) if max_rss is not None else None,
+                    'avg_cpu_time': round(avg_cpu, 3) if avg_cpu is not None else None,
+                    'max_cpu_time': round(max_cpu, 3) if max_cpu is not None else None,
+                }
+                
+                # 会话模式的命名空间复用率
+                async with db.execute("""
+                    SELECT COUNT(*), SUM(session_reused) FROM execution_history WHERE session_reused IS NOT NULL
+                """) as cursor:
+                    session_executions, session_reuses = await cursor.fetchone()
+                session_reuses = session_reuses or 0
+                
                 # 用户数量
                 async with db.execute("SELECT COUNT(DISTINCT sender_id) FROM execution_history") as cursor:
                     unique_users = (await cursor.fetchone())[0]
@@ -268,9 +378,16 @@ class ExecutionHistoryDB:
                     'total_executions': total_executions,
                     'successful_executions': successful_executions,
                     'failed_executions': failed_executions,
+                    'killed_executions': killed_executions,
+                    'avg_reclaim_time': round(avg_reclaim_time, 3) if avg_reclaim_time is not None else None,
                     'success_rate': round(successful_executions / total_executions * 100, 2) if total_executions > 0 else 0,
                     'unique_users': unique_users,
-                    'recent_executions': recent_executions
+                    'recent_executions': recent_executions,
+                    'library_usage': dict(library_usage.most_common(20)),
+                    'queue_wait_by_lane': queue_wait_by_lane,
+                    'resource_usage': resource_usage,
+                    'session_executions': session_executions,
+                    'session_reuse_rate': round(session_reuses / session_executions * 100, 2) if session_executions else 0
                 }
         except Exception as e:
             logger.error(f"获取统计信息失败: {e}", exc_info=True)
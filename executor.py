@@ -0,0 +1,1148 @@
+"""代码执行工作进程
+
+本模块运行在独立的工作进程中（由 worker_pool.WorkerPool 启动），
+因此不导入 AstrBot 框架，只依赖标准库和注入给用户代码的第三方库。
+"""
+import builtins
+import collections
+import contextlib
+import contextvars
+import hashlib
+import importlib
+import importlib.util
+import io
+import json
+import logging
+import marshal
+import multiprocessing
+import os
+import platform
+import signal
+import sys
+import threading
+import time
+import traceback
+import types
+import uuid
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+from .checkpoint import StateStore, referenced_names
+from .image_cache import ImageCache
+from .import_guard import ImportGuard, import_guard_context, install as install_import_guard
+from .preflight import PLOTTING_MODULES
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块，不支持资源限制
+    resource = None
+
+# 工作进程中不加载 AstrBot，直接使用同名的标准 logging 记录器
+logger = logging.getLogger("astrbot")
+
+# 注入到用户代码命名空间的库：模块名 -> 变量名
+LIBS_TO_INJECT = {
+    # 数据科学核心
+    'numpy': 'np', 'pandas': 'pd', 'scipy': 'scipy', 'statsmodels': 'statsmodels',
+    # 网络请求
+    'requests': 'requests', 'aiohttp': 'aiohttp', 'urllib': 'urllib', 'socket': 'socket',
+    # 可视化
+    'seaborn': 'sns', 'plotly': 'plotly', 'bokeh': 'bokeh',
+    # 文件处理
+    'openpyxl': 'openpyxl', 'docx': 'docx', 'fpdf': 'fpdf', 
+    'json': 'json', 'yaml': 'yaml', 'csv': 'csv', 'pickle': 'pickle',
+    # 数据库
+    'sqlite3': 'sqlite3', 'pymongo': 'pymongo', 'sqlalchemy': 'sqlalchemy',
+    'psycopg2': 'psycopg2',
+    # 图像处理
+    'PIL': 'PIL', 'cv2': 'cv2', 'imageio': 'imageio',
+    # 时间处理
+    'datetime': 'datetime', 'time': 'time', 'calendar': 'calendar',
+    # 加密安全
+    'hashlib': 'hashlib', 'hmac': 'hmac', 'secrets': 'secrets', 
+    'base64': 'base64', 'cryptography': 'cryptography',
+    # 文本处理
+    're': 're', 'string': 'string', 'textwrap': 'textwrap', 
+    'difflib': 'difflib', 'nltk': 'nltk', 'jieba': 'jieba',
+    # 系统工具
+    'os': 'os', 'sys': 'sys', 'shutil': 'shutil', 'zipfile': 'zipfile',
+    'tarfile': 'tarfile', 'pathlib': 'pathlib', 'subprocess': 'subprocess',
+    # 数学科学
+    'sympy': 'sympy', 'math': 'math', 'statistics': 'statistics',
+    'random': 'random', 'decimal': 'decimal', 'fractions': 'fractions',
+    # 实用工具
+    'itertools': 'itertools', 'collections': 'collections', 
+    'functools': 'functools', 'operator': 'operator', 'copy': 'copy', 'uuid': 'uuid'
+}
+
+# 体积大、使用频率低的库：以 LazyModule 代理注入，首次访问属性时才真正导入
+LAZY_LIBRARIES = {
+    'scipy', 'statsmodels', 'requests', 'aiohttp', 'seaborn', 'plotly', 'bokeh',
+    'openpyxl', 'docx', 'fpdf', 'yaml', 'pymongo', 'sqlalchemy', 'psycopg2',
+    'PIL', 'cv2', 'imageio', 'cryptography', 'nltk', 'jieba', 'sympy',
+}
+
+# 当前执行中实际用到的注入库（按执行上下文隔离）
+_touched_libraries: contextvars.ContextVar = contextvars.ContextVar("touched_libraries", default=None)
+
+# 当前执行的绘图环境（_PlottingSetup），代码首次接触绘图库时由导入钩子激活；
+# figure_backend 据此判断图表属于哪次执行
+plotting_context: contextvars.ContextVar = contextvars.ContextVar("plotting_context", default=None)
+
+# 按执行隔离图表的 matplotlib 后端
+FIGURE_BACKEND = f"module://{__package__}.figure_backend"
+
+# 每次执行在输出目录下使用自己的子目录（SAVE_DIR）：输出目录由所有工作进程共用，
+# 按目录差异检测新文件时只看本次执行的子目录，并发执行不会收集到彼此生成的文件
+RUN_DIR_PREFIX = "run_"
+SESSION_DIR_PREFIX = "session_"
+
+
+def _mark_touched(module_name: str):
+    top_level = module_name.partition('.')[0]
+    touched = _touched_libraries.get()
+    if touched is not None:
+        touched.add(top_level)
+    if top_level in PLOTTING_MODULES:
+        # 必须在真正导入之前配置，才能保证 pyplot 以 Agg 后端加载
+        setup = plotting_context.get()
+        if setup is not None:
+            setup.activate()
+
+
+class LazyModule(types.ModuleType):
+    """延迟导入的模块代理
+
+    首次访问属性时才导入真实模块，之后的属性读写都转发给真实模块。
+    代理本身是 ModuleType 实例，isinstance 检查不受影响；`from x import y` 走正常导入机制，同样不受影响。
+    """
+
+    def __init__(self, module_name: str):
+        super().__init__(module_name)
+        # 去掉 ModuleType 自带的占位属性，让它们也转发给真实模块
+        for attr in ('__doc__', '__package__', '__loader__', '__spec__'):
+            self.__dict__.pop(attr, None)
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self) -> types.ModuleType:
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, name):
+        _mark_touched(self.__name__)
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        _mark_touched(self.__name__)
+        setattr(self._load(), name, value)
+
+    def __delattr__(self, name):
+        _mark_touched(self.__name__)
+        delattr(self._load(), name)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        module = self.__dict__['_lazy_module']
+        return repr(module) if module is not None else f"<lazy module '{self.__name__}'>"
+
+
+def _tracking_import(name, globals=None, locals=None, fromlist=(), level=0):
+    """检查非管理员执行的受限库，记录用户代码显式导入的注入库，再交给原始 __import__"""
+    if level == 0:
+        guard = import_guard_context.get()
+        if guard is not None:
+            guard.check(name)
+        top_level = name.partition('.')[0]
+        if top_level in LIBS_TO_INJECT or top_level in PLOTTING_MODULES:
+            _mark_touched(top_level)
+    return builtins.__import__(name, globals, locals, fromlist, level)
+
+
+# 用户代码使用的 builtins：仅替换 __import__ 以统计库的实际使用情况
+_USER_BUILTINS = dict(builtins.__dict__, __import__=_tracking_import)
+
+
+def _is_importable(module_name: str) -> bool:
+    try:
+        return importlib.util.find_spec(module_name) is not None
+    except (ImportError, ValueError):
+        return False
+
+
+# 当前执行上下文的输出缓冲区：(stdout缓冲, stderr缓冲)
+_capture_streams: contextvars.ContextVar = contextvars.ContextVar("capture_streams", default=None)
+
+# 工作进程中同一时刻只有一个执行，用户代码自建线程（不继承上下文）的输出也归入该执行
+_process_capture = None
+
+
+class _ContextLocalStream(io.TextIOBase):
+    """按执行上下文分发写入的 sys.stdout/sys.stderr 代理
+
+    启动时安装一次，此后各次执行只切换上下文变量，不再替换全局的 sys.stdout，
+    并发执行各自只捕获自己的输出，其他线程（如 AstrBot 日志）仍写入原始流。
+    """
+
+    def __init__(self, fallback, index: int):
+        self._fallback = fallback
+        self._index = index
+
+    def _target(self):
+        streams = _capture_streams.get() or _process_capture
+        return streams[self._index] if streams else self._fallback
+
+    def write(self, s):
+        return self._target().write(s)
+
+    def writelines(self, lines):
+        self._target().writelines(lines)
+
+    def flush(self):
+        target = self._target()
+        if hasattr(target, 'flush'):
+            target.flush()
+
+    def writable(self):
+        return True
+
+    # io.TextIOBase 自带 encoding/errors/fileno/isatty 的默认实现，不会经过 __getattr__，需要显式转发：
+    # 执行中转发给捕获缓冲区（缓冲区没有的编码信息沿用原始流），执行之外转发给原始流
+    @property
+    def encoding(self):
+        return getattr(self._target(), 'encoding', None) or getattr(self._fallback, 'encoding', None)
+
+    @property
+    def errors(self):
+        return getattr(self._target(), 'errors', None) or getattr(self._fallback, 'errors', None)
+
+    def fileno(self):
+        return self._target().fileno()
+
+    def isatty(self):
+        return self._target().isatty()
+
+    def __getattr__(self, name):
+        # 其余属性沿用原始流
+        return getattr(self._fallback, name)
+
+
+class OutputForwarder:
+    """执行期间按固定间隔把新增输出交给回调（用于流式发送到聊天）
+
+    写入只追加到待发送列表，由后台线程定期合并后调用 callback，不阻塞用户代码。
+    待发送内容超过 max_pending_chars 时只保留最新部分。
+    """
+
+    def __init__(self, callback, interval: float, max_pending_chars: int = 65536):
+        self.callback = callback
+        self.interval = max(0.1, interval)
+        self.max_pending_chars = max_pending_chars
+        self._pending: List[str] = []
+        self._pending_chars = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="output_forwarder", daemon=True)
+
+    def write(self, s: str):
+        with self._lock:
+            self._pending.append(s)
+            self._pending_chars += len(s)
+            if self._pending_chars > self.max_pending_chars:
+                text = "".join(self._pending)[-self.max_pending_chars:]
+                self._pending = [text]
+                self._pending_chars = len(text)
+
+    def _flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            text = "".join(self._pending)
+            self._pending, self._pending_chars = [], 0
+        try:
+            self.callback(text)
+        except Exception as e:
+            logger.debug(f"流式输出回调失败: {e}")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._flush()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """停止后台线程；剩余输出随最终结果返回，这里不再发送"""
+        self._stop.set()
+        self._thread.join(self.interval + 1)
+
+
+class CappedOutputBuffer(io.TextIOBase):
+    """有字节上限的输出缓冲区
+
+    只保留输出开头和结尾各一半预算的内容，中间部分丢弃并计数，避免无限打印耗尽内存。
+    可选地把完整输出写入溢出文件（同样有上限），供之后发送或在 WebUI 中查看。
+    """
+
+    def __init__(self, budget_bytes: int, spill_path: str = None, spill_max_bytes: int = 0,
+                 forwarder: OutputForwarder = None):
+        self.forwarder = forwarder
+        self.head_limit = max(0, budget_bytes) // 2
+        self.tail_limit = max(0, budget_bytes) - self.head_limit
+        self.head = bytearray()
+        self.tail = collections.deque()
+        self.tail_bytes = 0
+        self.total_bytes = 0
+        self.spill_path = spill_path if spill_max_bytes > 0 else None
+        self.spill_max_bytes = spill_max_bytes
+        self.spilled_bytes = 0
+        self._spill_file = None
+
+    @property
+    def dropped_bytes(self) -> int:
+        return self.total_bytes - len(self.head) - self.tail_bytes
+
+    def writable(self):
+        return True
+
+    def write(self, s) -> int:
+        # 无法编码的字符（如孤立代理项）直接丢弃，与旧版的清理方式一致
+        if self.forwarder is not None:
+            self.forwarder.write(s)
+        data = s.encode('utf-8', errors='ignore')
+        self.total_bytes += len(data)
+        if self._spill_file is not None:
+            self._spill(data)
+
+        room = self.head_limit - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if not data:
+            return len(s)
+
+        if self.spill_path and self._spill_file is None:
+            # 首次超出开头预算时才创建溢出文件，并补写已缓存的内容
+            self._open_spill()
+            self._spill(bytes(self.head) + data)
+
+        self.tail.append(data)
+        self.tail_bytes += len(data)
+        while self.tail_bytes > self.tail_limit:
+            excess = self.tail_bytes - self.tail_limit
+            first = self.tail[0]
+            if len(first) <= excess:
+                self.tail.popleft()
+                self.tail_bytes -= len(first)
+            else:
+                self.tail[0] = first[excess:]
+                self.tail_bytes -= excess
+        return len(s)
+
+    def _open_spill(self):
+        try:
+            self._spill_file = open(self.spill_path, 'wb')
+        except OSError as e:
+            logger.warning(f"创建输出溢出文件失败: {e}")
+            self.spill_path = None
+
+    def _spill(self, data: bytes):
+        room = self.spill_max_bytes - self.spilled_bytes
+        if room <= 0 or self._spill_file is None:
+            return
+        chunk = data[:room]
+        self._spill_file.write(chunk)
+        self.spilled_bytes += len(chunk)
+
+    def close_spill(self) -> str:
+        """关闭溢出文件，返回其路径（未产生溢出时返回 None）"""
+        if self._spill_file is None:
+            return None
+        self._spill_file.close()
+        self._spill_file = None
+        return self.spill_path
+
+    def getvalue(self) -> str:
+        head = self.head.decode('utf-8', errors='ignore')
+        tail = b''.join(self.tail).decode('utf-8', errors='ignore')
+        if self.dropped_bytes:
+            return f"{head}\n...(输出过长，已省略 {self.dropped_bytes} 字节)...\n{tail}"
+        return head + tail
+
+
+def install_output_router():
+    """安装 sys.stdout/sys.stderr 路由代理（幂等）"""
+    if not isinstance(sys.stdout, _ContextLocalStream):
+        sys.stdout = _ContextLocalStream(sys.stdout, 0)
+    if not isinstance(sys.stderr, _ContextLocalStream):
+        sys.stderr = _ContextLocalStream(sys.stderr, 1)
+
+
+# 默认输出捕获预算（字节），开头和结尾各保留一半
+DEFAULT_CAPTURE_BYTES = 1024 * 1024
+
+# 流式输出的默认发送间隔（秒）
+DEFAULT_STREAM_INTERVAL = 2.0
+
+# 字体检测结果缓存文件名（位于插件数据目录）
+FONT_CACHE_FILE = "font_cache.json"
+
+# 工作进程级配置，由 init_worker 设置
+_worker_options: Dict[str, Any] = {}
+
+# 与插件的图片预取共用的图片缓存（配置了 image_cache_dir 时创建），用户代码通过 fetch_cached(url) 使用
+_image_cache: Optional[ImageCache] = None
+
+
+def _get_image_cache() -> Optional[ImageCache]:
+    global _image_cache
+    cache_dir = _worker_options.get("image_cache_dir")
+    if not cache_dir:
+        return None
+    if _image_cache is None or _image_cache.cache_dir != cache_dir:
+        _image_cache = ImageCache(cache_dir, _worker_options.get("image_cache_max_bytes", 0))
+    return _image_cache
+
+
+# 工作进程启动时预先导入的重型库，避免首个任务承担冷启动开销
+PRELOAD_MODULES = ["numpy", "pandas", "matplotlib", "matplotlib.pyplot"]
+
+
+# 已构建的命名空间模板：(是否管理员, 禁用库) -> 模板字典
+_NAMESPACE_TEMPLATES: Dict[tuple, Dict[str, Any]] = {}
+
+
+def _build_namespace(is_admin_flag: bool, restricted_libraries: List[str] = None) -> Dict[str, Any]:
+    """导入注入库并构建用户代码的基础命名空间"""
+    namespace = {
+        '__builtins__': _USER_BUILTINS,
+        'print': print,
+        'io': io
+    }
+    libs_to_inject = LIBS_TO_INJECT
+    if not is_admin_flag and restricted_libraries:
+        rl = set(restricted_libraries)
+        libs_to_inject = {k: v for k, v in libs_to_inject.items() if k.lower() not in rl}
+    for lib_name, alias in libs_to_inject.items():
+        if lib_name in LAZY_LIBRARIES:
+            if _is_importable(lib_name):
+                namespace[alias or lib_name] = LazyModule(lib_name)
+            else:
+                logger.warning(f"库 {lib_name} 不可用，相关功能禁用")
+            continue
+        try:
+            lib = __import__(lib_name)
+            namespace[alias or lib_name] = lib
+        except ImportError:
+            logger.warning(f"库 {lib_name} 不可用，相关功能禁用")
+    # 特殊库导入处理
+    try:
+        from bs4 import BeautifulSoup; namespace['BeautifulSoup'] = BeautifulSoup
+    except ImportError:
+        pass
+    if 'PIL' in libs_to_inject and _is_importable('PIL'):
+        namespace['Image'] = LazyModule('PIL.Image')
+    if _is_importable('dateutil'):
+        namespace['dateutil_parser'] = LazyModule('dateutil.parser')
+        namespace['dateutil'] = LazyModule('dateutil')
+    # matplotlib 同样以代理注入：访问 plt 时才配置绘图环境，不绘图的代码完全不涉及 matplotlib
+    if _is_importable('matplotlib'):
+        namespace['matplotlib'] = LazyModule('matplotlib')
+        namespace['plt'] = LazyModule('matplotlib.pyplot')
+    return namespace
+
+
+def get_namespace_template(is_admin_flag: bool, restricted_libraries: List[str] = None) -> Dict[str, Any]:
+    """获取（必要时构建）命名空间模板，管理员与非管理员各自缓存一份
+
+    模板只在每个工作进程中构建一次，执行时通过 dict() 浅拷贝使用，不要直接修改返回值。
+    """
+    key = (bool(is_admin_flag), tuple(restricted_libraries or ()) if not is_admin_flag else ())
+    template = _NAMESPACE_TEMPLATES.get(key)
+    if template is None:
+        template = _build_namespace(is_admin_flag, restricted_libraries)
+        _NAMESPACE_TEMPLATES[key] = template
+    return template
+
+
+def _resolve_chinese_fonts(fm):
+    """智能检测并配置中文字体，支持多平台，返回 (font_list, primary_font, found_paths)"""
+    system = platform.system().lower()
+    available_fonts = [f.name for f in fm.fontManager.ttflist]
+    
+    # 定义不同平台的中文字体优先级列表
+    chinese_fonts = {
+        'windows': [
+            'Microsoft YaHei', 'SimHei', 'SimSun', 'KaiTi', 'FangSong',
+            'Microsoft JhengHei', 'DFKai-SB', 'MingLiU'
+        ],
+        'darwin': [  # macOS
+            'PingFang SC', 'Hiragino Sans GB', 'STHeiti', 'STSong',
+            'STKaiti', 'STFangsong', 'Songti SC', 'Kaiti SC'
+        ],
+        'linux': [
+            'Noto Sans CJK SC', 'Noto Serif CJK SC', 'Source Han Sans SC',
+            'Source Han Serif SC', 'WenQuanYi Micro Hei', 'WenQuanYi Zen Hei',
+            'AR PL UMing CN', 'AR PL UKai CN', 'SimHei', 'SimSun'
+        ]
+    }
+    
+    # 获取当前系统的字体列表
+    system_fonts = chinese_fonts.get(system, chinese_fonts['windows'])
+    
+    found_fonts, found_paths = [], []
+    
+    # 先按优先级尝试 findfont，确保拿到路径并注册
+    for font in system_fonts:
+        try:
+            path = fm.findfont(font, fallback_to_default=False)
+            if path and os.path.exists(path):
+                try:
+                    fm.fontManager.addfont(path)
+                except Exception:
+                    pass
+                family = fm.FontProperties(fname=path).get_name()
+                found_fonts.append(family)
+                found_paths.append(path)
+                logger.debug(f"找到可用中文字体: {family} ({path})")
+        except Exception:
+            continue
+    
+    # 如果没找到，尝试常见候选与名称关键词
+    if not found_fonts:
+        logger.warning("未找到预定义的中文字体，尝试搜索其他中文字体...")
+        fallback_candidates = [
+            'Microsoft YaHei', 'SimHei', 'SimSun', 'Noto Sans CJK SC',
+            'Source Han Sans SC', 'PingFang SC'
+        ]
+        for font in fallback_candidates + available_fonts:
+            try:
+                path = fm.findfont(font, fallback_to_default=False)
+                if path and os.path.exists(path):
+                    try:
+                        fm.fontManager.addfont(path)
+                    except Exception:
+                        pass
+                    family = fm.FontProperties(fname=path).get_name()
+                    # 避免重复
+                    if family not in found_fonts:
+                        found_fonts.append(family)
+                        found_paths.append(path)
+                        logger.debug(f"找到候选中文字体: {family} ({path})")
+                        if len(found_fonts) >= 3:
+                            break
+            except Exception:
+                continue
+    
+    # 构建字体列表（中文字体 + 英文回退字体）
+    font_list = found_fonts + ['DejaVu Sans', 'Arial', 'Liberation Sans', 'sans-serif']
+    primary_font = found_fonts[0] if found_fonts else 'DejaVu Sans'
+    
+    if found_fonts:
+        logger.info(f"配置中文字体成功，使用字体: {primary_font} (共找到 {len(found_fonts)} 个中文字体)")
+        try:
+            logger.debug(f"主字体路径: {found_paths[0]}")
+        except Exception:
+            pass
+    else:
+        logger.warning("未找到任何中文字体，将使用系统默认字体，中文可能显示为方框")
+    
+    return font_list, primary_font, found_paths
+
+
+# 本进程已解析的中文字体配置：(font_list, primary_font)
+_font_config = None
+
+
+def _font_set_key(fm) -> str:
+    """根据系统字体集合生成缓存键，字体增删或 matplotlib 升级后缓存自动失效"""
+    import matplotlib
+    digest = hashlib.sha256()
+    digest.update(f"{platform.system()}|{matplotlib.__version__}".encode('utf-8'))
+    # 新版 matplotlib 中 addfont 注册的字体 fname 为 FontPath 对象，统一转为字符串路径
+    for fname in sorted({str(f.fname) for f in fm.fontManager.ttflist}):
+        digest.update(fname.encode('utf-8', errors='ignore'))
+    return digest.hexdigest()
+
+
+def _load_font_cache(cache_path: str, key: str):
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get("key") != key:
+        return None
+    return cached
+
+
+def _save_font_cache(cache_path: str, cached: Dict[str, Any]):
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(cached, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.debug(f"写入字体缓存失败: {e}")
+
+
+def setup_chinese_fonts(fm):
+    """获取中文字体配置，返回 (font_list, primary_font)
+
+    结果在进程内缓存，并以系统字体集合为键持久化到插件数据目录的 font_cache.json，
+    后续进程直接读取缓存，只有字体发生变化时才重新检测。
+    """
+    global _font_config
+    if _font_config is not None:
+        return _font_config
+
+    data_dir = _worker_options.get("data_dir")
+    cache_path = os.path.join(data_dir, FONT_CACHE_FILE) if data_dir else None
+    key = _font_set_key(fm)
+
+    cached = _load_font_cache(cache_path, key) if cache_path else None
+    if cached:
+        logger.debug(f"使用字体缓存: {cached['primary_font']}")
+        _font_config = (cached["font_list"], cached["primary_font"])
+        return _font_config
+
+    font_list, primary_font, found_paths = _resolve_chinese_fonts(fm)
+    # 设置字体缓存刷新（确保字体配置生效），只在重新检测后执行一次
+    try:
+        fm._rebuild()
+    except Exception:
+        pass  # 某些版本的matplotlib可能没有这个方法
+    if cache_path:
+        _save_font_cache(cache_path, {
+            "key": key, "font_list": font_list, "primary_font": primary_font, "font_paths": [str(path) for path in found_paths]
+        })
+    _font_config = (font_list, primary_font)
+    return _font_config
+
+
+class CpuTimeLimitExceeded(Exception):
+    """执行超出 CPU 时间上限（由 SIGXCPU 信号触发）"""
+
+
+def _on_cpu_limit(signum, frame):
+    raise CpuTimeLimitExceeded(f"超出单次执行 CPU 时间上限（{_worker_options.get('cpu_time_limit', 0)} 秒）")
+
+
+def _read_proc_status_kb(field: str) -> Optional[int]:
+    """读取 /proc/self/status 中以 kB 为单位的字段（仅 Linux）"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _reset_peak_rss() -> bool:
+    """重置进程的峰值常驻内存（VmHWM），使其只反映本次执行"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+@contextlib.contextmanager
+def _resource_guard(usage: Dict[str, Any]):
+    """在本次执行期间施加内存/CPU时间限制，并把资源使用情况写入 usage
+
+    只在独占的工作进程中生效：rlimit 作用于整个进程，插件进程内执行时只记录耗时。
+    内存上限按"当前地址空间 + memory_limit_mb"计算，即本次执行可额外申请的内存；
+    CPU 时间同理按本进程已用时间累加。只调整软限制，执行结束后恢复原值。
+    """
+    limited = bool(_worker_options.get("exclusive")) and resource is not None
+    restore = []
+    if limited:
+        peak_reset = _reset_peak_rss()
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        memory_limit_mb = _worker_options.get("memory_limit_mb", 0)
+        address_space_kb = _read_proc_status_kb("VmSize")
+        if memory_limit_mb and address_space_kb is not None:
+            soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+            limit = address_space_kb * 1024 + memory_limit_mb * 1024 * 1024
+            if hard != resource.RLIM_INFINITY:
+                limit = min(limit, hard)
+            resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+            restore.append((resource.RLIMIT_AS, (soft, hard)))
+        cpu_time_limit = _worker_options.get("cpu_time_limit", 0)
+        if cpu_time_limit and hasattr(signal, "SIGXCPU"):
+            soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+            limit = int(before.ru_utime + before.ru_stime + cpu_time_limit) + 1
+            if hard != resource.RLIM_INFINITY:
+                limit = min(limit, hard)
+            resource.setrlimit(resource.RLIMIT_CPU, (limit, hard))
+            restore.append((resource.RLIMIT_CPU, (soft, hard)))
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        usage["wall_time"] = round(time.perf_counter() - start, 4)
+        for limit_type, original in reversed(restore):
+            resource.setrlimit(limit_type, original)
+        if limited:
+            after = resource.getrusage(resource.RUSAGE_SELF)
+            usage["cpu_user_time"] = round(after.ru_utime - before.ru_utime, 4)
+            usage["cpu_sys_time"] = round(after.ru_stime - before.ru_stime, 4)
+            peak_kb = _read_proc_status_kb("VmHWM") if peak_reset else None
+            if peak_kb is None:
+                # 无法重置峰值时退回进程生命周期内的最大值（macOS 上单位为字节）
+                peak_kb = after.ru_maxrss / 1024 if sys.platform == "darwin" else after.ru_maxrss
+            usage["peak_rss_mb"] = round(peak_kb / 1024, 2)
+
+
+def _describe_limit_error(exc: BaseException) -> Optional[str]:
+    """把资源超限异常转换为可读的原因，其他异常返回 None"""
+    if isinstance(exc, CpuTimeLimitExceeded):
+        return f"❌ {exc}，执行已被中止"
+    if isinstance(exc, MemoryError) and _worker_options.get("exclusive") and _worker_options.get("memory_limit_mb"):
+        return f"❌ 超出单次执行内存上限（{_worker_options['memory_limit_mb']} MB），执行已被中止"
+    return None
+
+
+class _PlottingSetup:
+    """单次执行的绘图环境
+
+    首次接触 matplotlib 时才切换到按执行隔离的后端（figure_backend）并应用中文字体。
+    本次执行创建的图表归属于它：plt.show/plt.savefig 只保存自己的图表，不影响并发的其他执行。
+    图表按配置的格式、DPI 和大小预算编码；内存模式下编码结果随结果返回，由插件直接发送，不写入输出目录。
+    """
+
+    def __init__(self, file_output_dir: str, files_to_send: List[str], options: Dict[str, Any]):
+        self.file_output_dir = file_output_dir
+        self.files_to_send = files_to_send
+        self.in_memory = options.get("in_memory_figures", False)
+        self.figure_format = options.get("figure_format", "png")
+        self.figure_dpi = options.get("figure_dpi", 150)
+        self.figure_max_bytes = options.get("figure_max_bytes", 0)
+        # 单个折线/散点超过该点数时在绘制前降采样（0 表示不降采样）
+        self.downsample_threshold = options.get("plot_downsample_threshold", 0)
+        # 内存模式下生成的图表：[{"name": 文件名, "data": 编码后的字节}]
+        self.figures: List[Dict[str, Any]] = []
+        # 每张图表的编码统计（格式、字节数、编码耗时等）
+        self.figure_stats: List[Dict[str, Any]] = []
+        self.active = False
+        self._activated = False
+
+    def activate(self):
+        if self._activated:
+            return
+        self._activated = True
+        try:
+            import matplotlib
+            matplotlib.use(FIGURE_BACKEND)
+            import matplotlib.pyplot as plt
+            import matplotlib.font_manager as fm
+        except ImportError:
+            logger.warning("matplotlib 不可用，图表功能禁用")
+            return
+
+        # 应用字体配置（每个进程只检测一次，之后直接复用缓存结果）
+        font_list, primary_font = setup_chinese_fonts(fm)
+        plt.rcParams['font.family'] = [primary_font, 'sans-serif']
+        plt.rcParams['font.sans-serif'] = font_list
+        plt.rcParams['axes.unicode_minus'] = False
+        self.active = True
+
+    def add_figure(self, base_name: str, extension: str, data: bytes, stats: Dict[str, Any]):
+        """保存一张编码好的图表（内存模式下只保留字节）"""
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        name = f"{base_name}_{timestamp}_{uuid.uuid4().hex[:8]}.{extension}"
+        self.figure_stats.append(dict(stats, name=name))
+        if not stats["within_budget"]:
+            logger.warning(f"图表 {name} 降到最低质量后仍有 {len(data) / 1024:.0f}KB，超出大小预算")
+        if self.in_memory:
+            print(f"[图表已生成: {name}]")
+            self.figures.append({"name": name, "data": data})
+            return
+        filepath = os.path.join(self.file_output_dir, name)
+        with open(filepath, "wb") as f:
+            f.write(data)
+        print(f"[图表已保存: {filepath}]")
+        self._register(filepath)
+
+    def add_saved_figure(self, path: str, stats: Dict[str, Any]):
+        """登记用户按路径保存（fig.savefig(path)）的图表，文件保留在该路径；内存模式下同时读取字节随结果返回"""
+        name = os.path.basename(path)
+        self.figure_stats.append(dict(stats, name=name))
+        print(f"[图表已保存: {path}]")
+        if self.in_memory:
+            with open(path, "rb") as f:
+                self.figures.append({"name": name, "data": f.read()})
+            return
+        self._register(path)
+
+    def _register(self, path: str):
+        path = os.path.abspath(path)
+        if path not in self.files_to_send:
+            self.files_to_send.append(path)
+
+    def close(self):
+        """关闭本次执行未保存的图表"""
+        if self.active:
+            from .figure_backend import close_figures
+            close_figures(self)
+            self.active = False
+
+
+def _make_run_dir(file_output_dir: str, session_key: Optional[str] = None) -> str:
+    """创建本次执行的输出子目录
+
+    会话模式按会话使用固定的子目录，之后的执行仍能读取之前保存的文件（同一会话的执行串行进行）。
+    """
+    if session_key is None:
+        name = f"{RUN_DIR_PREFIX}{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+    else:
+        name = SESSION_DIR_PREFIX + hashlib.sha256(session_key.encode("utf-8")).hexdigest()[:16]
+    path = os.path.join(file_output_dir, name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def run_code(code_to_run: str, file_output_dir: str, image_urls: List[str] = None, is_admin_flag: bool = True,
+             restricted_libraries: List[str] = None, stream_callback=None,
+             namespace: Dict[str, Any] = None, state_scope: str = None, compiled=None,
+             needs_plotting: bool = False, image_files: List[Optional[str]] = None) -> Dict[str, Any]:
+    """执行一段用户代码，返回 {"success", "output", "error", "file_paths"} 结果字典
+
+    :param stream_callback: 可选，执行期间定期以新增的标准输出文本调用（在后台线程中调用）
+    :param namespace: 可选，会话模式下在多次执行之间保留的命名空间，首次使用时从模板填充
+    :param state_scope: 可选，持久化状态的作用域（会话ID），提供时向代码注入 persist(name, obj)
+    :param compiled: 可选，预检阶段已编译好的代码对象，提供时不再重复编译
+    :param needs_plotting: 预检判断代码会绘图时为 True，执行前就配置好绘图环境（df.plot() 等不经过 plt 的绘图也能用上中文字体）；
+        否则在代码首次接触 matplotlib/plt/sns 时才配置，不绘图的代码不承担任何 matplotlib 开销
+    :param image_files: 可选，插件预取的图片本地路径，与 image_urls 一一对应（下载失败为 None）
+    """
+    global _process_capture
+    install_output_router()
+    capture_bytes = _worker_options.get("output_capture_bytes", DEFAULT_CAPTURE_BYTES)
+    spill_path = os.path.join(
+        file_output_dir, f"output_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.log"
+    )
+    forwarder = None
+    if stream_callback is not None:
+        forwarder = OutputForwarder(stream_callback, _worker_options.get("stream_interval", DEFAULT_STREAM_INTERVAL))
+        forwarder.start()
+    output_buffer = CappedOutputBuffer(
+        capture_bytes, spill_path, _worker_options.get("output_spill_max_bytes", 0), forwarder
+    )
+    error_buffer = CappedOutputBuffer(capture_bytes)
+
+    files_to_send_explicitly = []
+    libraries_used = set()
+    resource_usage: Dict[str, Any] = {}
+    persisted, restored = [], []
+    touched_token = _touched_libraries.set(libraries_used)
+    session_key = f"{state_scope}:{'admin' if is_admin_flag else 'user'}" if namespace is not None else None
+    run_dir = _make_run_dir(file_output_dir, session_key)
+    plotting = _PlottingSetup(run_dir, files_to_send_explicitly, _worker_options)
+    plotting_token = plotting_context.set(plotting)
+    # 非管理员执行在导入时拦截受限库（拼接模块名、importlib 等静态检查发现不了的导入）
+    import_guard = ImportGuard(restricted_libraries) if not is_admin_flag and restricted_libraries else None
+    if import_guard is not None:
+        install_import_guard()
+    guard_token = import_guard_context.set(import_guard)
+    files_before = set(os.listdir(run_dir))
+
+    # 输出只路由到本次执行的缓冲区，不修改全局 sys.stdout
+    capture_token = _capture_streams.set((output_buffer, error_buffer))
+    if _worker_options.get("exclusive"):
+        _process_capture = (output_buffer, error_buffer)
+
+    try:
+
+        # 从预先构建的模板浅拷贝命名空间，避免每次执行重复导入几十个库
+        if namespace is None:
+            exec_globals = dict(get_namespace_template(is_admin_flag, restricted_libraries))
+        else:
+            if not namespace:
+                namespace.update(get_namespace_template(is_admin_flag, restricted_libraries))
+            exec_globals = namespace
+        exec_globals.update({
+            'SAVE_DIR': run_dir,
+            'FILES_TO_SEND': files_to_send_explicitly,
+            'img_url': image_urls or [],  # 提供图片URL列表给代码使用
+            'img_files': image_files or [],  # 已预取到本地的图片路径
+        })
+
+        store = None
+        if state_scope and _worker_options.get("data_dir"):
+            store = StateStore(_worker_options["data_dir"], state_scope, _worker_options.get("persist_max_bytes", 0))
+
+            def persist(name: str, obj):
+                """把对象保存到当前会话的检查点，之后的执行（包括插件重启后）可直接用该变量名访问"""
+                size = store.save(name, obj)
+                exec_globals[name] = obj
+                if name not in persisted:
+                    persisted.append(name)
+                return size
+
+            exec_globals['persist'] = persist
+
+        image_cache = _get_image_cache()
+        if image_cache is not None:
+            def fetch_cached(url: str) -> str:
+                """下载图片并返回本地路径；同一 URL 再次获取（包括插件已预取过的）直接使用缓存"""
+                return image_cache.fetch(
+                    url, _worker_options.get("image_max_bytes", 0), _worker_options.get("image_timeout", 15)
+                )
+
+            exec_globals['fetch_cached'] = fetch_cached
+
+        if needs_plotting:
+            plotting.activate()
+
+        # 确保代码字符串使用正确的编码
+        if isinstance(code_to_run, str):
+            # 处理可能的编码问题
+            try:
+                code_to_run.encode('utf-8')
+            except UnicodeEncodeError:
+                # 如果包含无法编码的字符，尝试清理
+                code_to_run = code_to_run.encode('utf-8', errors='ignore').decode('utf-8')
+        
+        if compiled is None:
+            compiled = compile(code_to_run, "<string>", "exec")
+        if store:
+            # 只恢复本次代码引用到的持久化对象，未用到的不读盘
+            restored = store.restore_into(exec_globals, referenced_names(compiled))
+
+        exit_error = None
+        with _resource_guard(resource_usage):
+            try:
+                exec(compiled, exec_globals)
+            except SystemExit as e:
+                # sys.exit()/exit() 只结束用户代码（与脚本提前退出一致），不能让它结束工作进程、丢失已有输出
+                if e.code not in (None, 0):
+                    exit_error = f"代码调用 sys.exit({e.code!r}) 提前结束"
+
+        plotting.close()
+
+        # 优先使用 FILES_TO_SEND 列表，提高文件归属准确性
+        # 过滤掉不存在的显式路径，避免重复和日志噪音
+        files_to_send_explicitly = [
+            p for p in files_to_send_explicitly
+            if isinstance(p, str) and os.path.exists(p) and os.path.isfile(p)
+        ]
+        # 用户显式添加到 FILES_TO_SEND 的文件（以及保存的图表）在前，本次执行子目录中新生成的文件作为补充
+        all_files_to_send = files_to_send_explicitly[:]
+        seen = {os.path.abspath(p) for p in all_files_to_send}
+        files_after = set(os.listdir(run_dir)) if os.path.exists(run_dir) else set()
+        all_files_to_send.extend(
+            os.path.join(run_dir, f) for f in sorted(files_after - files_before)
+            if os.path.abspath(os.path.join(run_dir, f)) not in seen
+        )
+
+        # 溢出文件只供查看，不作为生成文件自动发送
+        output_spill_path = output_buffer.close_spill()
+        all_files_to_send = [f for f in all_files_to_send if f != output_buffer.spill_path]
+
+        # 缓冲区写入时已清理无法编码的字符
+        return {
+            "success": exit_error is None, "output": output_buffer.getvalue(), "error": exit_error,
+            "file_paths": all_files_to_send, "libraries_used": sorted(libraries_used),
+            "output_dropped_bytes": output_buffer.dropped_bytes, "output_spill_path": output_spill_path,
+            "resource_usage": resource_usage, "persisted": persisted, "restored": restored,
+            "figures": plotting.figures, "figure_stats": plotting.figure_stats,
+            "blocked_imports": import_guard.blocked if import_guard else [],
+        }
+    except Exception as e:
+        tb_str = traceback.format_exc()
+        logger.error(f"代码执行出错:\n{tb_str}")
+        limit_reason = _describe_limit_error(e)
+        if limit_reason:
+            tb_str = f"{limit_reason}\n\n{tb_str}"
+        
+        # 安全处理错误输出的编码
+        try:
+            tb_str.encode('utf-8')
+        except UnicodeEncodeError:
+            tb_str = tb_str.encode('utf-8', errors='ignore').decode('utf-8')
+        
+        return {"success": False, "error": tb_str, "output": output_buffer.getvalue(), "file_paths": [],
+                "libraries_used": sorted(libraries_used),
+                "output_dropped_bytes": output_buffer.dropped_bytes, "output_spill_path": output_buffer.close_spill(),
+                "resource_usage": resource_usage, "limit_exceeded": limit_reason is not None,
+                "persisted": persisted, "restored": restored,
+                "blocked_imports": import_guard.blocked if import_guard else []}
+    finally:
+        if forwarder is not None:
+            forwarder.stop()
+        _touched_libraries.reset(touched_token)
+        plotting_context.reset(plotting_token)
+        import_guard_context.reset(guard_token)
+        _capture_streams.reset(capture_token)
+        _process_capture = None
+        try:
+            plotting.close()
+        except Exception:
+            pass
+        if session_key is None:
+            # 没有生成文件的子目录直接删除
+            try:
+                os.rmdir(run_dir)
+            except OSError:
+                pass
+
+
+def _preload_modules():
+    """预热常用库：导入后留在 sys.modules 中，后续执行直接复用"""
+    try:
+        import matplotlib
+        matplotlib.use(FIGURE_BACKEND)
+    except ImportError:
+        pass
+    for module_name in PRELOAD_MODULES:
+        try:
+            __import__(module_name)
+        except ImportError:
+            logger.debug(f"预加载库 {module_name} 不可用")
+    try:
+        # 字体检测也提前完成，首个任务不再承担这部分开销
+        import matplotlib.font_manager as fm
+        setup_chinese_fonts(fm)
+    except ImportError:
+        pass
+
+
+def _run_forked(task: Dict[str, Any], execute_task, send):
+    """fork 服务器模式：在 fork 出的子进程中执行任务，子进程退出即完成全部清理
+
+    子进程与本进程（zygote）共享已导入库的只读内存页，启动只需几毫秒；
+    泄漏的线程、内存和被修改的全局状态都随子进程一起销毁。
+    子进程通过独立管道发回流式输出和结果，由 zygote 转发，子进程在发送中途被终止时主管道不会收到半条消息。
+    """
+    reader, writer = multiprocessing.Pipe(duplex=False)
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 1
+        try:
+            reader.close()
+            child_lock = threading.Lock()
+
+            def child_send(message):
+                with child_lock:
+                    writer.send(message)
+
+            child_send(execute_task(task, child_send))
+            exit_code = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            # 跳过 atexit 和缓冲区刷新，避免重复执行 zygote 的清理逻辑
+            os._exit(exit_code)
+
+    writer.close()
+    # 先告知主进程子进程 pid，超时时主进程只终止该子进程
+    send({"forked": pid})
+    result = None
+    try:
+        while True:
+            message = reader.recv()
+            if "stream" in message and "success" not in message:
+                send(message)
+                continue
+            result = message
+            break
+    except (EOFError, OSError):
+        pass
+    finally:
+        reader.close()
+        _, status = os.waitpid(pid, 0)
+    if result is None:
+        if os.WIFSIGNALED(status):
+            signum = os.WTERMSIG(status)
+            reason = f"被信号 {signum} 终止"
+            if signum == signal.SIGKILL:
+                reason += "，可能是执行超时或内存耗尽"
+        else:
+            reason = f"退出码 {os.waitstatus_to_exitcode(status)}"
+        result = {"success": False, "error": f"执行子进程异常退出（{reason}）", "output": None, "file_paths": []}
+    send(result)
+
+
+def init_worker(options: Dict[str, Any]):
+    """设置工作进程级配置（data_dir 等），在插件进程内执行时同样需要调用"""
+    _worker_options.clear()
+    _worker_options.update(options)
+
+
+def worker_main(conn, options: Dict[str, Any]):
+    """工作进程主循环：通过管道接收任务，执行后把结果字典发回
+
+    :param conn: 与主进程通信的管道端点
+    :param options: 工作进程级配置（file_output_dir、restricted_libraries 等）
+    """
+    # 工作进程一次只执行一个任务，可以独占输出捕获
+    init_worker(dict(options, exclusive=True))
+    install_output_router()
+    if resource is not None and hasattr(signal, "SIGXCPU"):
+        # 超出 CPU 时间软限制时在执行线程中抛出异常，而不是直接终止工作进程
+        signal.signal(signal.SIGXCPU, _on_cpu_limit)
+    _preload_modules()
+    install_import_guard()
+    # 预先构建管理员与非管理员两份命名空间模板
+    get_namespace_template(True)
+    get_namespace_template(False, options.get("restricted_libraries"))
+    # 流式输出由后台线程发送，与最终结果共用管道，需要加锁
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    send({"ready": True, "pid": os.getpid()})
+
+    # 会话模式下命名空间在本进程的多次执行之间保留
+    session_namespace: Optional[Dict[str, Any]] = {} if options.get("session") else None
+    # fork 服务器模式：本进程作为 zygote，每个任务 fork 一个子进程执行（仅支持有 fork 的系统）
+    fork_per_task = bool(options.get("fork_per_task")) and hasattr(os, "fork") and session_namespace is None
+
+    def execute_task(task: Dict[str, Any], send_message) -> Dict[str, Any]:
+        stream_callback = (lambda text: send_message({"stream": text})) if task.get("stream") else None
+        session_reused = bool(session_namespace)
+        result = run_code(
+            task["code"],
+            options["file_output_dir"],
+            task.get("img_urls"),
+            task.get("is_admin", True),
+            options.get("restricted_libraries"),
+            stream_callback,
+            session_namespace,
+            task.get("state_scope"),
+            marshal.loads(task["compiled"]) if task.get("compiled") else None,
+            task.get("needs_plotting", False),
+            task.get("img_files"),
+        )
+        if session_namespace is not None:
+            result["session_reused"] = session_reused
+            rss_kb = _read_proc_status_kb("VmRSS")
+            result["process_rss_mb"] = round(rss_kb / 1024, 2) if rss_kb is not None else None
+        return result
+
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, OSError):
+            break
+        if task is None:
+            break
+
+        try:
+            if fork_per_task:
+                _run_forked(task, execute_task, send)
+            else:
+                send(execute_task(task, send))
+        except (BrokenPipeError, OSError):
+            break
@@ -0,0 +1,223 @@
+"""按执行隔离的 matplotlib 后端
+
+基于 Agg 渲染，在创建图表时记录所属的执行（executor.plotting_context），之后：
+- plt.show() 只保存并关闭当前执行自己的图表；
+- plt.savefig()/fig.savefig() 传入路径时与 Agg 后端一样写入该路径，并记入所属执行的待发送文件（内存模式下同时以字节返回）；
+- plt.gcf()/plt.close('all') 在执行上下文中只作用于当前执行的图表。
+多个执行并发绘图时互不干扰，也不需要在每次执行前后替换 plt.show/plt.savefig。
+plt.show() 保存的图表按配置的格式与 DPI 编码，超出大小预算时逐级降低质量和分辨率；
+启用降采样时，编码前先对点数过多的折线与散点降采样（见 downsampling.py）。
+
+plt.gcf()/plt.close('all') 的隔离通过替换 Gcf.get_active/Gcf.destroy_all 实现，这是进程级的修改：
+加载本后端（首次绘图切换后端）时替换一次，之后进程内所有线程都使用替换后的实现。
+替换后的实现只在执行上下文中（plotting_context 非空）改变行为，上下文之外直接调用原实现，
+所以插件进程中其他使用 matplotlib 的代码不受影响。
+
+本模块运行在工作进程（或插件进程的执行线程）中，不导入 AstrBot 框架。
+"""
+import io
+import os
+import time
+from typing import Any, Dict, Tuple
+
+import matplotlib
+from matplotlib._pylab_helpers import Gcf
+from matplotlib.backend_bases import FigureManagerBase
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from .downsampling import downsample_figure
+from .executor import plotting_context
+
+
+# pyplot 加载后端时会读取该属性
+backend_version = matplotlib.__version__
+
+# 文件扩展名
+FORMAT_EXTENSIONS = {'png': 'png', 'jpeg': 'jpg', 'webp': 'webp', 'svg': 'svg'}
+
+# 超出大小预算时依次尝试的质量，降到最低质量仍超出时再降低分辨率。
+# JPEG/WebP 为编码质量；PNG 为调色板颜色数（None 表示保留原始颜色），图表通常用不到 256 种颜色
+QUALITY_STEPS = {'jpeg': (90, 75, 60, 45), 'webp': (90, 75, 60, 45), 'png': (None, 256)}
+# 每次降低分辨率至少缩小到原来的比例，以及分辨率下限
+DPI_STEP = 0.75
+MIN_DPI = 50
+
+
+def _encode_image(image, fmt: str, quality: int = None, scale: float = 1.0) -> bytes:
+    """把已渲染的位图按比例缩小后重新编码"""
+    from PIL import Image
+    if scale < 1:
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.LANCZOS)
+    buffer = io.BytesIO()
+    if fmt == 'png':
+        if quality:
+            image = image.quantize(colors=quality, method=Image.Quantize.FASTOCTREE)
+        image.save(buffer, format='PNG', optimize=True)
+        return buffer.getvalue()
+    if fmt == 'jpeg':
+        # JPEG 不支持透明通道，与 matplotlib 一样先合成到白色背景上
+        image = Image.alpha_composite(Image.new('RGBA', image.size, 'white'), image.convert('RGBA')).convert('RGB')
+    image.save(buffer, format=fmt.upper(), quality=quality)
+    return buffer.getvalue()
+
+
+def encode_figure(canvas, fmt: str, dpi: int, max_bytes: int = 0) -> Tuple[bytes, str, Dict[str, Any]]:
+    """按配置编码图表，超出 max_bytes 时逐级降低质量与分辨率
+
+    图表只绘制一次：位图格式先渲染为 PNG，超出预算时在已渲染的位图上降低质量或缩小尺寸重新编码。
+
+    :return: (编码后的字节, 实际使用的格式, 编码统计)
+    """
+    start = time.perf_counter()
+
+    def fits(data):
+        return not max_bytes or len(data) <= max_bytes
+
+    def finish(data, fmt, dpi, quality, attempts, within_budget):
+        return data, fmt, {
+            "format": fmt, "bytes": len(data), "encode_ms": round((time.perf_counter() - start) * 1000, 2),
+            "dpi": dpi, "quality": quality, "attempts": attempts, "within_budget": within_budget,
+        }
+
+    attempts = 0
+    if fmt == 'svg':
+        buffer = io.BytesIO()
+        FigureCanvasAgg.print_figure(canvas, buffer, format='svg', dpi=dpi, bbox_inches='tight')
+        attempts += 1
+        if fits(buffer.getvalue()):
+            return finish(buffer.getvalue(), fmt, dpi, None, attempts, True)
+        fmt = 'png'  # 矢量图过大（通常是点数很多的散点图）时改为位图
+
+    buffer = io.BytesIO()
+    FigureCanvasAgg.print_figure(canvas, buffer, format='png', dpi=dpi, bbox_inches='tight')
+    rendered = buffer.getvalue()
+    image = None
+    qualities = QUALITY_STEPS[fmt]
+    scale, quality = 1.0, None
+    while True:
+        for quality in qualities:
+            attempts += 1
+            if fmt == 'png' and scale == 1.0 and quality is None:
+                data = rendered
+            else:
+                if image is None:
+                    from PIL import Image
+                    image = Image.open(io.BytesIO(rendered))
+                    image.load()
+                data = _encode_image(image, fmt, quality, scale)
+            if fits(data):
+                return finish(data, fmt, round(dpi * scale), quality, attempts, True)
+        if dpi * scale <= MIN_DPI:
+            return finish(data, fmt, round(dpi * scale), quality, attempts, False)
+        # 文件大小约与像素数（DPI 的平方）成正比，据此估算下一档分辨率
+        scale = max(MIN_DPI / dpi, min(scale * DPI_STEP, scale * (max_bytes / len(data)) ** 0.5))
+        qualities = qualities[-1:]
+
+
+def _owned_managers(owner):
+    return [m for m in Gcf.get_all_fig_managers() if getattr(m, "owner", None) is owner]
+
+
+def _downsample(canvas, owner) -> Dict[str, int]:
+    points = {}
+    if owner.downsample_threshold:
+        points = downsample_figure(canvas.figure, owner.downsample_threshold)
+        if points:
+            print(f"[图表降采样: {points['original']:,} 个点 → {points['rendered']:,} 个点]")
+    return points
+
+
+def _save_figure(canvas, owner, base_name: str):
+    """按所属执行的配置编码图表并交给该执行保存，然后关闭图表"""
+    try:
+        points = _downsample(canvas, owner)
+        data, fmt, stats = encode_figure(canvas, owner.figure_format, owner.figure_dpi, owner.figure_max_bytes)
+        if points:
+            stats.update(points_original=points["original"], points_rendered=points["rendered"])
+        owner.add_figure(base_name, FORMAT_EXTENSIONS[fmt], data, stats)
+    except Exception as e:
+        print(f"[保存图表失败: {e}]")
+    finally:
+        Gcf.destroy_fig(canvas.figure)
+
+
+class FigureManager(FigureManagerBase):
+    def __init__(self, canvas, num):
+        super().__init__(canvas, num)
+        # 创建图表的执行；在执行上下文之外创建的图表为 None，行为与 Agg 后端一致
+        self.owner = plotting_context.get()
+
+    @classmethod
+    def pyplot_show(cls, *args, **kwargs):
+        owner = plotting_context.get()
+        if owner is None:
+            return
+        for manager in _owned_managers(owner):
+            if manager.canvas.figure.get_axes():
+                _save_figure(manager.canvas, owner, "plot")
+            else:
+                Gcf.destroy(manager)
+
+
+class FigureCanvas(FigureCanvasAgg):
+    manager_class = FigureManager
+
+    def print_figure(self, filename, *args, **kwargs):
+        owner = getattr(self.manager, "owner", None)
+        if owner is None or not isinstance(filename, (str, os.PathLike)):
+            # 写入内存缓冲区等情况保持原样
+            return super().print_figure(filename, *args, **kwargs)
+        # 按用户指定的路径和参数保存（代码之后可能还要读取该文件），保存后记入所属执行并关闭图表
+        path = os.fspath(filename)
+        if kwargs.get("format") is None and not os.path.splitext(path)[1]:
+            # 与 matplotlib 一致：文件名没有扩展名时使用默认格式并补上扩展名
+            kwargs["format"] = self.get_default_filetype()
+            path = f"{path.rstrip('.')}.{kwargs['format']}"
+        start = time.perf_counter()
+        try:
+            points = _downsample(self, owner)
+            super().print_figure(path, *args, **kwargs)
+            dpi = kwargs.get("dpi")
+            stats = {
+                "format": kwargs.get("format") or os.path.splitext(path)[1][1:].lower(),
+                "bytes": os.path.getsize(path), "encode_ms": round((time.perf_counter() - start) * 1000, 2),
+                "dpi": round(dpi if isinstance(dpi, (int, float)) else self.figure.dpi), "quality": None,
+                "attempts": 1, "within_budget": True,
+            }
+            if points:
+                stats.update(points_original=points["original"], points_rendered=points["rendered"])
+            owner.add_saved_figure(path, stats)
+        finally:
+            Gcf.destroy_fig(self.figure)
+
+
+def close_figures(owner):
+    """关闭某次执行遗留的图表（未显式保存的图表只关闭，不自动保存）"""
+    for manager in _owned_managers(owner):
+        Gcf.destroy(manager)
+
+
+_original_get_active = Gcf.get_active
+_original_destroy_all = Gcf.destroy_all
+
+
+def _get_active(cls):
+    owner = plotting_context.get()
+    if owner is None:
+        return _original_get_active()
+    managers = _owned_managers(owner)
+    return managers[-1] if managers else None
+
+
+def _destroy_all(cls):
+    owner = plotting_context.get()
+    if owner is None:
+        return _original_destroy_all()
+    close_figures(owner)
+
+
+# 当前图表与 close('all') 按执行上下文区分（进程级替换，见模块说明）：上下文之外的调用与原实现完全一致，
+# 只需在加载后端时设置一次
+Gcf.get_active = classmethod(_get_active)
+Gcf.destroy_all = classmethod(_destroy_all)
@@ -0,0 +1,160 @@
+"""图片下载缓存
+
+引用消息（Comp.Reply）时同一张表情包或截图的 URL 会反复出现，每次都重新下载。
+下载过的图片按内容哈希保存到插件数据目录（相同内容的不同 URL 共用一个文件），
+索引记录 URL 到内容哈希的映射、文件大小与最近使用时间，总大小超出配额时按最近最少使用淘汰。
+
+插件进程（图片预取）与工作进程（用户代码中的 fetch_cached(url)）共用同一份缓存：
+索引使用 SQLite（WAL 模式），文件先写临时文件再原子替换，多个进程并发读写都是安全的。
+命中与未命中次数同样记录在索引中，所有进程累计。
+
+本模块运行在工作进程中，与 executor.py 一样不导入 AstrBot 框架。
+"""
+import contextlib
+import hashlib
+import logging
+import mimetypes
+import os
+import sqlite3
+import time
+import urllib.request
+import uuid
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger("astrbot")
+
+# 缓存目录名（位于插件数据目录）
+CACHE_DIR = "image_cache"
+
+# 按文件头识别常见图片格式，确定缓存文件的扩展名（WebP 单独判断）
+_IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"GIF87a", ".gif"),
+    (b"GIF89a", ".gif"),
+    (b"BM", ".bmp"),
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, name TEXT NOT NULL, size INTEGER NOT NULL,
+                                  last_used REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, digest TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS idx_blobs_last_used ON blobs(last_used);
+CREATE INDEX IF NOT EXISTS idx_urls_digest ON urls(digest);
+CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0);
+"""
+
+
+class ImageTooLargeError(Exception):
+    """图片超出单张大小上限"""
+
+
+def guess_extension(data: bytes, content_type: str = "") -> str:
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return ".webp"
+    for signature, extension in _IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return extension
+    return mimetypes.guess_extension(content_type.split(";")[0].strip()) or ".bin"
+
+
+def download(url: str, max_bytes: int = 0, timeout: float = 15) -> Tuple[bytes, str]:
+    """同步下载一张图片（工作进程中使用），边读边检查大小，超出上限立即中止"""
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        length = int(response.headers.get("Content-Length") or 0)
+        if max_bytes and length > max_bytes:
+            raise ImageTooLargeError(f"{length} 字节")
+        data = response.read(max_bytes + 1) if max_bytes else response.read()
+        if max_bytes and len(data) > max_bytes:
+            raise ImageTooLargeError(f"超过 {max_bytes} 字节")
+        return data, response.headers.get("Content-Type", "")
+
+
+class ImageCache:
+    """按内容寻址、带大小配额的图片缓存"""
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._index_path = os.path.join(cache_dir, "index.db")
+        os.makedirs(cache_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self._index_path, timeout=30)
+        try:
+            with conn:  # 提交或回滚事务
+                yield conn
+        finally:
+            conn.close()
+
+    def lookup(self, url: str) -> Optional[str]:
+        """返回 URL 对应的缓存文件路径并记为最近使用，未缓存时返回 None；同时累计命中/未命中次数"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT b.digest, b.name FROM urls u JOIN blobs b ON b.digest = u.digest WHERE u.url = ?", (url,)
+            ).fetchone()
+            path = os.path.join(self.cache_dir, row[1]) if row else None
+            if path and not os.path.exists(path):
+                # 文件被外部删除，清理失效的索引
+                conn.execute("DELETE FROM urls WHERE digest = ?", (row[0],))
+                conn.execute("DELETE FROM blobs WHERE digest = ?", (row[0],))
+                path = None
+            if path:
+                conn.execute("UPDATE blobs SET last_used = ? WHERE digest = ?", (time.time(), row[0]))
+            conn.execute("UPDATE counters SET value = value + 1 WHERE name = ?", ("hits" if path else "misses",))
+            return path
+
+    def store(self, url: str, data: bytes, content_type: str = "") -> str:
+        """保存下载的图片并记录 URL 映射，返回缓存文件路径；超出配额时淘汰最久未使用的图片"""
+        digest = hashlib.sha256(data).hexdigest()
+        name = digest + guess_extension(data, content_type)
+        path = os.path.join(self.cache_dir, name)
+        if not os.path.exists(path):
+            temp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?)", (digest, name, len(data), time.time()))
+            conn.execute("INSERT OR REPLACE INTO urls VALUES (?, ?)", (url, digest))
+            self._evict(conn, keep=digest)
+        return path
+
+    def _evict(self, conn, keep: str):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if not self.max_bytes or total <= self.max_bytes:
+            return
+        rows = conn.execute("SELECT digest, name, size FROM blobs WHERE digest != ? ORDER BY last_used", (keep,))
+        for digest, name, size in rows.fetchall():
+            if total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM urls WHERE digest = ?", (digest,))
+            conn.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total -= size
+            logger.debug(f"图片缓存超出配额，已淘汰 {name}")
+
+    def fetch(self, url: str, max_bytes: int = 0, timeout: float = 15) -> str:
+        """同步获取图片的本地路径：命中缓存直接返回，否则下载后写入缓存"""
+        if not url.startswith(("http://", "https://")):
+            raise ValueError(f"只支持 http/https 图片地址: {url}")
+        path = self.lookup(url)
+        if path is None:
+            data, content_type = download(url, max_bytes, timeout)
+            path = self.store(url, data, content_type)
+        return path
+
+    def stats(self) -> Dict[str, int]:
+        """累计命中/未命中次数与当前缓存的文件数、总字节数"""
+        with self._connect() as conn:
+            counters = dict(conn.execute("SELECT name, value FROM counters"))
+            entries, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        return {"hits": counters["hits"], "misses": counters["misses"], "entries": entries, "bytes": total}
@@ -0,0 +1,122 @@
+"""执行前并发预取消息中的图片
+
+LLM 生成的代码通常用 requests 逐个下载 img_url 中的图片，下载时间全部计入执行超时。
+插件在代码用到图片时，于排队等待执行槽位期间用 aiohttp 并发下载全部图片，
+执行时以 img_files（与 img_url 一一对应的本地路径）提供给代码，代码可以直接打开处理。
+单张图片有大小上限与超时，超出或下载失败的位置为 None，代码仍可按 img_url 自行下载。
+启用图片缓存（image_cache.py）时先查缓存，下载的图片写入缓存，由缓存按配额淘汰；否则执行结束后删除。
+"""
+import asyncio
+import os
+import sqlite3
+import uuid
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+import aiohttp
+
+from astrbot.api import logger
+
+from .image_cache import ImageCache, ImageTooLargeError, guess_extension
+
+# 同时下载的图片数上限
+DEFAULT_MAX_CONCURRENCY = 8
+
+
+class ImagePrefetcher:
+    """并发下载图片到本地目录（或图片缓存）"""
+
+    def __init__(self, download_dir: str, max_bytes: int, timeout: float,
+                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY, cache: Optional[ImageCache] = None):
+        self.download_dir = download_dir
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.cache = cache
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session: Optional[aiohttp.ClientSession] = None
+        os.makedirs(download_dir, exist_ok=True)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # 复用同一个会话的连接池；会话必须在事件循环中创建
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def _download(self, url: str) -> Tuple[bytes, str]:
+        """下载一张图片，边读边检查大小，超出上限立即中止"""
+        async with self._semaphore:
+            async with self._get_session().get(url) as response:
+                response.raise_for_status()
+                if self.max_bytes and (response.content_length or 0) > self.max_bytes:
+                    raise ImageTooLargeError(f"{response.content_length} 字节")
+                chunks, size = [], 0
+                async for chunk in response.content.iter_chunked(65536):
+                    size += len(chunk)
+                    if self.max_bytes and size > self.max_bytes:
+                        raise ImageTooLargeError(f"超过 {self.max_bytes} 字节")
+                    chunks.append(chunk)
+                return b"".join(chunks), response.headers.get("Content-Type", "")
+
+    def _write(self, data: bytes, content_type: str) -> str:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        path = os.path.join(
+            self.download_dir, f"img_{timestamp}_{uuid.uuid4().hex[:8]}{guess_extension(data, content_type)}"
+        )
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    async def fetch(self, url: str) -> Optional[str]:
+        """下载一张图片并返回本地路径，失败、超时或超出大小上限时返回 None"""
+        if not url.startswith(("http://", "https://")):
+            return None
+        try:
+            if self.cache is not None:
+                path = await asyncio.to_thread(self.cache.lookup, url)
+                if path is not None:
+                    return path
+            data, content_type = await self._download(url)
+            if self.cache is not None:
+                return await asyncio.to_thread(self.cache.store, url, data, content_type)
+            return await asyncio.to_thread(self._write, data, content_type)
+        except ImageTooLargeError as e:
+            logger.warning(f"图片超出预取大小上限（{e}），跳过: {url}")
+        except asyncio.TimeoutError:
+            logger.warning(f"图片预取超时（{self.timeout}秒），跳过: {url}")
+        except (aiohttp.ClientError, OSError, sqlite3.Error) as e:
+            logger.warning(f"图片预取失败，跳过: {url} ({e})")
+        return None
+
+    async def fetch_all(self, urls: List[str]) -> List[Optional[str]]:
+        """并发下载全部图片，返回与 urls 一一对应的本地路径（重复的 URL 只下载一次）"""
+        unique = list(dict.fromkeys(urls))
+        fetched = dict(zip(unique, await asyncio.gather(*(self.fetch(url) for url in unique))))
+        paths = [fetched[url] for url in urls]
+        summary = f"已预取 {sum(p is not None for p in paths)}/{len(urls)} 张图片"
+        if self.cache is not None:
+            try:
+                stats = await asyncio.to_thread(self.cache.stats)
+                summary += (f"（图片缓存累计命中 {stats['hits']} 次、未命中 {stats['misses']} 次，"
+                            f"{stats['entries']} 张 / {stats['bytes'] / 1048576:.1f}MB）")
+            except sqlite3.Error:
+                pass
+        logger.info(summary)
+        return paths
+
+    def discard(self, task: "asyncio.Task"):
+        """删除一次预取下载的文件（作为 fetch_all 任务的完成回调，任务被取消时同样适用）
+
+        启用缓存时文件属于缓存，由缓存按配额淘汰，这里不删除。
+        """
+        if self.cache is not None or task.cancelled() or task.exception() is not None:
+            return
+        for path in task.result():
+            if path:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
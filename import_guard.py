@@ -0,0 +1,67 @@
+"""非管理员执行的运行时导入拦截
+
+静态检查（policy.py）只能看到代码文本，`__import__('sub' + 'process')` 这类拼接出来的模块名会漏过。
+这里在导入发生时按 restricted_libraries 拦截，两处入口共用同一份检查：
+- 用户代码的 __import__（executor._tracking_import）：import 语句与 __import__() 调用都经过这里，
+  即使模块已在 sys.modules 中（subprocess、socket 通常早已被其他库导入）也能拦截；
+- sys.meta_path 查找器：模块尚未导入时，importlib.import_module() 或第三方库间接导入同样会被拦截。
+拦截只对非管理员执行生效（按执行上下文区分），管理员执行与执行上下文之外的导入每次只多一次 ContextVar 读取；
+模块名的匹配结果按名称缓存，合法导入不承担逐个比对受限库的开销。
+
+这不是沙箱：注入的 os/sys 仍可直接访问 sys.modules 中已加载的模块，只是提高了绕过静态检查的门槛。
+本模块运行在工作进程（或插件进程的执行线程）中，不导入 AstrBot 框架。
+"""
+import contextvars
+import sys
+from functools import lru_cache
+from typing import FrozenSet, Iterable, List, Optional
+
+# 模块名匹配结果的缓存条数上限
+MATCH_CACHE_SIZE = 4096
+
+# 当前执行的导入拦截（ImportGuard），管理员执行与执行上下文之外为 None
+import_guard_context: contextvars.ContextVar = contextvars.ContextVar("import_guard", default=None)
+
+
+@lru_cache(maxsize=MATCH_CACHE_SIZE)
+def _match_restricted(fullname: str, restricted: FrozenSet[str]) -> Optional[str]:
+    """返回模块名命中的受限库（库本身或其子模块），未命中返回 None"""
+    name = fullname.lower()
+    for lib in restricted:
+        if name == lib or name.startswith(lib + "."):
+            return lib
+    return None
+
+
+class ImportGuard:
+    """单次非管理员执行的导入拦截，记录被拦截的模块"""
+
+    def __init__(self, restricted_libraries: Iterable[str]):
+        self.restricted = frozenset(lib.lower() for lib in restricted_libraries if lib)
+        # 被拦截的模块名（按首次出现顺序去重）
+        self.blocked: List[str] = []
+
+    def check(self, fullname: str):
+        lib = _match_restricted(fullname, self.restricted)
+        if lib is None:
+            return
+        if fullname not in self.blocked:
+            self.blocked.append(fullname)
+        raise ImportError(f"安全策略禁止非管理员导入 {fullname}（受限库: {lib}）", name=fullname)
+
+
+class RestrictedImportFinder:
+    """sys.meta_path 查找器：只做拦截检查，不负责查找模块（始终交给后续查找器）"""
+
+    @staticmethod
+    def find_spec(fullname, path=None, target=None):
+        guard = import_guard_context.get()
+        if guard is not None:
+            guard.check(fullname)
+        return None
+
+
+def install():
+    """把查找器放到 sys.meta_path 最前面（每个进程只需一次，重复调用无副作用）"""
+    if not any(isinstance(finder, RestrictedImportFinder) for finder in sys.meta_path):
+        sys.meta_path.insert(0, RestrictedImportFinder())
@@ -1,13 +1,10 @@
 import asyncio
-import sys
-import io
 import time
-import traceback
 import os
+import sys
 import base64
-from datetime import datetime
-from typing import Dict, Any, List
-import re
+from urllib.parse import quote
+from typing import Dict, Any, List, Callable, Optional
 
 from astrbot.api.event import filter, AstrMessageEvent, MessageChain
 from astrbot.api.star import Context, Star, register, StarTools
@@ -18,10 +15,20 @@ from astrbot.api.provider import ProviderRequest
 from astrbot.core.message.components import Plain
 
 from .database import ExecutionHistoryDB
+from .executor import run_code, init_worker
+from .output_stream import OutputStreamer
+from .scheduler import ExecutionScheduler, QueueFullError
+from . import subinterpreter
+from .checkpoint import StateStore
+from .preflight import preflight, PreflightResult
+from .policy import PolicyEngine
+from .image_cache import ImageCache, CACHE_DIR
+from .image_prefetch import ImagePrefetcher
 from .webui import CodeExecutorWebUI
+from .worker_pool import WorkerPool, SessionPool
 
 
-@register("code_executor", "Xican", "代码执行器 - 全能小狐狸汐林", "2.6.0")
+@register("code_executor", "Xican", "代码执行器 - 全能小狐狸汐林", "2.6.0")
 class CodeExecutorPlugin(Star):
     def __init__(self, context: Context, config: AstrBotConfig = None):
         super().__init__(context)
@@ -67,7 +74,63 @@ class CodeExecutorPlugin(Star):
             self.config.get("restricted_libraries"),
             ["subprocess", "socket", "ctypes", "psutil", "paramiko"],
         )
+        # 非管理员安全策略：配置加载时编译一次，检查结果按代码哈希缓存
+        self.policy = PolicyEngine(self.restricted_keywords, self.restricted_libraries)
         
+        # 执行进程池配置（worker_pool_size 为 0 时在插件进程内用线程执行）
+        self.worker_pool_size = self.config.get("worker_pool_size", 2)
+        self.worker_max_tasks = self.config.get("worker_max_tasks", 50)
+        # fork 服务器模式（仅 Linux）：工作进程作为 zygote，每次执行 fork 一个用完即退出的子进程
+        self.fork_server_mode = self.config.get("fork_server_mode", False)
+        if self.fork_server_mode and not sys.platform.startswith("linux"):
+            logger.warning("fork 服务器模式仅支持 Linux，已回退为常驻工作进程模式")
+            self.fork_server_mode = False
+        # 执行调度：全局并发上限（0 表示与进程池大小一致）、单用户并发上限与等待队列长度
+        self.max_concurrent_executions = self.config.get("max_concurrent_executions", 0)
+        self.per_user_concurrent_limit = self.config.get("per_user_concurrent_limit", 1)
+        self.execution_queue_size = self.config.get("execution_queue_size", 20)
+        # 管理员通道：为管理员保留的执行槽位数，以及管理员排队任务是否优先执行
+        self.admin_reserved_slots = self.config.get("admin_reserved_slots", 0)
+        self.admin_queue_priority = self.config.get("admin_queue_priority", True)
+        # 输出捕获预算（字节）与完整输出溢出文件上限（0 表示不保存）
+        self.output_capture_bytes = self.config.get("output_capture_bytes", 1048576)
+        self.output_spill_max_bytes = self.config.get("output_spill_max_bytes", 0)
+        # 图表内存模式：图表渲染为字节直接发送，只在 WebUI 或本地路由需要时才写入输出目录
+        self.in_memory_figures = self.config.get("in_memory_figures", False)
+        # 图表输出格式、分辨率与单张大小预算（超出时自动降低质量或分辨率，0 表示不限制）
+        self.figure_format = str(self.config.get("figure_format", "png")).lower()
+        if self.figure_format == "jpg":
+            self.figure_format = "jpeg"
+        if self.figure_format not in ("png", "jpeg", "webp", "svg"):
+            logger.warning(f"不支持的图表格式 {self.figure_format}，已改用 png")
+            self.figure_format = "png"
+        self.figure_dpi = self.config.get("figure_dpi", 150)
+        self.figure_max_bytes = self.config.get("figure_max_bytes", 4194304)
+        # 单个折线/散点超过该点数时在绘制前降采样（0 表示不降采样）
+        self.plot_downsample_threshold = self.config.get("plot_downsample_threshold", 0)
+        # 子解释器后端（Python 3.13+）：只用标准库的轻量代码在插件进程内的隔离子解释器中并行执行
+        self.enable_subinterpreter_backend = self.config.get("enable_subinterpreter_backend", False)
+        # 单次执行资源限制（仅在执行进程池中生效，0 表示不限制）
+        self.memory_limit_mb = self.config.get("memory_limit_mb", 0)
+        self.cpu_time_limit_seconds = self.config.get("cpu_time_limit_seconds", 0)
+        # 会话模式：同一会话的多次执行共享命名空间，变量在专用工作进程中保留
+        self.enable_python_sessions = self.config.get("enable_python_sessions", False)
+        self.session_idle_ttl_seconds = self.config.get("session_idle_ttl_seconds", 1800)
+        self.max_sessions = self.config.get("max_sessions", 4)
+        self.session_memory_limit_mb = self.config.get("session_memory_limit_mb", 2048)
+        # persist() 持久化状态：每个会话的检查点存储上限（MB，0 表示不限制）
+        self.persist_max_mb = self.config.get("persist_max_mb", 1024)
+        # 流式输出：长时间运行的代码执行期间分批把输出发送到聊天
+        self.enable_output_streaming = self.config.get("enable_output_streaming", False)
+        self.stream_interval_seconds = self.config.get("stream_interval_seconds", 3)
+        self.stream_max_messages_per_minute = self.config.get("stream_max_messages_per_minute", 10)
+        # 图片预取配置
+        self.image_prefetch_enabled = self.config.get("image_prefetch_enabled", True)
+        self.image_prefetch_max_mb = self.config.get("image_prefetch_max_mb", 20)
+        self.image_prefetch_timeout_seconds = self.config.get("image_prefetch_timeout_seconds", 15)
+        self.image_cache_enabled = self.config.get("image_cache_enabled", True)
+        self.image_cache_max_mb = self.config.get("image_cache_max_mb", 512)
+
         # 错误分析相关配置
         self.enable_error_analysis = self.config.get("enable_error_analysis", False)
         self.error_analysis_provider_id = self.config.get("error_analysis_provider_id", "")
@@ -99,6 +162,23 @@ class CodeExecutorPlugin(Star):
         plugin_data_dir = self.tools.get_data_dir()
         db_path = os.path.join(plugin_data_dir, 'execution_history.db')
         self.db = ExecutionHistoryDB(db_path)
+
+        # 图片缓存：图片预取与用户代码中的 fetch_cached(url) 共用，引用消息中重复出现的图片不再重新下载
+        image_cache_dir = os.path.join(plugin_data_dir, CACHE_DIR) if self.image_cache_enabled else None
+        self.image_cache = (
+            ImageCache(image_cache_dir, self.image_cache_max_mb * 1024 * 1024) if image_cache_dir else None
+        )
+
+        # 代码用到图片时，在排队期间并发预取消息中的图片
+        if self.image_prefetch_enabled:
+            self.image_prefetcher = ImagePrefetcher(
+                os.path.join(plugin_data_dir, 'images'),
+                self.image_prefetch_max_mb * 1024 * 1024,
+                self.image_prefetch_timeout_seconds,
+                cache=self.image_cache,
+            )
+        else:
+            self.image_prefetcher = None
         
         # 只有启用WebUI时才初始化
         if self.enable_webui:
@@ -111,6 +191,64 @@ class CodeExecutorPlugin(Star):
         else:
             self.webui = None
         self.webui_task = None
+
+        # 创建执行进程池，工作进程在 _async_init 中启动并预热
+        worker_options = {
+            "file_output_dir": self.file_output_dir,
+            "restricted_libraries": self.restricted_libraries,
+            "data_dir": plugin_data_dir,
+            "output_capture_bytes": self.output_capture_bytes,
+            "output_spill_max_bytes": self.output_spill_max_bytes,
+            "memory_limit_mb": self.memory_limit_mb,
+            "cpu_time_limit": self.cpu_time_limit_seconds,
+            "persist_max_bytes": self.persist_max_mb * 1024 * 1024,
+            "fork_per_task": self.fork_server_mode,
+            "stream_interval": self.stream_interval_seconds,
+            "in_memory_figures": self.in_memory_figures,
+            "figure_format": self.figure_format,
+            "figure_dpi": self.figure_dpi,
+            "figure_max_bytes": self.figure_max_bytes,
+            "plot_downsample_threshold": self.plot_downsample_threshold,
+            "image_cache_dir": image_cache_dir,
+            "image_cache_max_bytes": self.image_cache_max_mb * 1024 * 1024,
+            "image_max_bytes": self.image_prefetch_max_mb * 1024 * 1024,
+            "image_timeout": self.image_prefetch_timeout_seconds,
+        }
+        # 插件进程内执行（进程池关闭或启动失败时）同样使用这份配置
+        init_worker(worker_options)
+        if self.worker_pool_size > 0:
+            self.worker_pool = WorkerPool(
+                size=self.worker_pool_size,
+                max_tasks_per_worker=self.worker_max_tasks,
+                options=worker_options,
+            )
+        else:
+            self.worker_pool = None
+        if self.enable_python_sessions:
+            self.session_pool = SessionPool(
+                max_sessions=self.max_sessions,
+                idle_ttl=self.session_idle_ttl_seconds,
+                memory_limit_mb=self.session_memory_limit_mb,
+                options=worker_options,
+            )
+        else:
+            self.session_pool = None
+        self.subinterpreter_backend = None
+        if self.enable_subinterpreter_backend:
+            if subinterpreter.is_available():
+                self.subinterpreter_backend = subinterpreter.SubinterpreterBackend(
+                    self.file_output_dir, self.output_capture_bytes,
+                    max_threads=self.max_concurrent_executions or self.worker_pool_size or 2,
+                )
+            else:
+                logger.warning("当前 Python 不支持隔离子解释器（需要 3.13+），子解释器后端未启用")
+        self.scheduler = ExecutionScheduler(
+            max_concurrent=self.max_concurrent_executions or self.worker_pool_size or 2,
+            per_user_limit=self.per_user_concurrent_limit,
+            max_queue=self.execution_queue_size,
+            admin_reserved_slots=self.admin_reserved_slots,
+            admin_priority=self.admin_queue_priority,
+        )
         
         # 异步初始化数据库和启动WebUI
         asyncio.create_task(self._async_init())
@@ -131,17 +269,18 @@ class CodeExecutorPlugin(Star):
             # 安全检查：确保文件在输出目录内
             real_file_path = os.path.realpath(file_path)
             real_output_dir = os.path.realpath(self.file_output_dir)
-            if not real_file_path.startswith(real_output_dir):
+            if not real_file_path.startswith(real_output_dir + os.sep):
                 logger.warning(f"文件不在输出目录内，跳过本地路由发送: {file_path}")
                 return False
             
-            # 构建文件URL（使用实际端口）
+            # 构建文件URL（使用实际端口）；文件位于各次执行的输出子目录中，URL 使用相对输出目录的路径
             actual_port = self.webui.port
-            file_url = f"http://{self.local_route_host}:{actual_port}/files/{file_name}"
+            relative_path = os.path.relpath(real_file_path, real_output_dir).replace(os.sep, "/")
+            file_url = f"http://{self.local_route_host}:{actual_port}/files/{quote(relative_path)}"
             
             # 使用AstrBot原生方法发送文件URL
             is_image = any(
-                file_name.lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp'])
+                file_name.lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'])
             
             if is_image:
                 logger.info(f"正在以图片URL形式发送: {file_url}")
@@ -179,7 +318,7 @@ class CodeExecutorPlugin(Star):
             
             # 检测文件类型
             is_image = any(
-                file_name.lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp'])
+                file_name.lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'])
             
             if is_image:
                 logger.info(f"正在以base64图片形式发送: {file_name} ({file_size / 1024:.1f}KB)")
@@ -197,6 +336,35 @@ class CodeExecutorPlugin(Star):
             logger.error(f"base64文件发送异常: {e}", exc_info=True)
             return False
     
+    def _persist_figures(self, figures: List[Dict[str, Any]]) -> List[str]:
+        """把内存模式下生成的图表写入输出目录（供 WebUI 历史记录与本地路由使用），返回文件路径"""
+        paths = []
+        for figure in figures:
+            path = os.path.join(self.file_output_dir, figure["name"])
+            try:
+                with open(path, "wb") as f:
+                    f.write(figure["data"])
+                paths.append(path)
+            except OSError as e:
+                logger.error(f"保存图表 {figure['name']} 失败: {e}")
+        return paths
+
+    async def _send_figure_from_memory(self, figure: Dict[str, Any], event: AstrMessageEvent) -> bool:
+        """直接发送内存中的图表，不经过磁盘"""
+        try:
+            logger.info(f"正在从内存发送图表: {figure['name']} ({len(figure['data']) / 1024:.1f}KB)")
+            if figure["name"].lower().endswith(".svg"):
+                # 多数平台不把 SVG 当作图片显示，以文件形式发送
+                base64_data = base64.b64encode(figure["data"]).decode('utf-8')
+                chain = [Comp.File(file=f"data:image/svg+xml;base64,{base64_data}", name=figure["name"])]
+            else:
+                chain = [Comp.Image.fromBytes(figure["data"])]
+            await event.send(event.chain_result(chain))
+            return True
+        except Exception as e:
+            logger.error(f"内存图表发送异常: {e}", exc_info=True)
+            return False
+
     def get_image_urls_from_message(self, message) -> List[str]:
         """从消息链中获取图片URL列表，包括引用消息中的图片"""
         image_urls = []
@@ -248,6 +416,17 @@ class CodeExecutorPlugin(Star):
         try:
             # 初始化数据库
             await self.db.init_database()
+
+            # 启动并预热执行进程池
+            if self.worker_pool:
+                try:
+                    await self.worker_pool.start()
+                except Exception as e:
+                    logger.error(f"执行进程池启动失败，回退到插件进程内执行: {e}", exc_info=True)
+                    await self.worker_pool.shutdown()
+                    self.worker_pool = None
+            if self.session_pool:
+                self.session_pool.start()
             
             # 只有启用WebUI时才启动WebUI服务器
             if self.enable_webui and self.webui:
@@ -355,7 +534,9 @@ class CodeExecutorPlugin(Star):
 
         【IMAGE HANDLING — MUST】
         - `img_url`: list of image URLs from the current message.
-        - Download each URL with timeouts; optionally process via PIL/cv2; save under `SAVE_DIR`; append saved paths to `FILES_TO_SEND`.
+        - `img_files`: local paths of the same images, already downloaded (same order as `img_url`; `None` where a download failed; empty when prefetch is disabled). Open these directly instead of downloading again; fall back to downloading `img_url[i]` with timeouts only when `img_files[i]` is missing.
+        - `fetch_cached(url)` (available when the image cache is enabled) downloads an image once and returns its local path; repeated URLs are served from a shared on-disk cache. Use it for `img_url[i]` fallbacks and any other image URL.
+        - Optionally process via PIL/cv2; save results under `SAVE_DIR`; append saved paths to `FILES_TO_SEND`.
 
         【STOP CONDITIONS】
         - End when code runs and produces output or appends files to `FILES_TO_SEND`.
@@ -369,6 +550,7 @@ class CodeExecutorPlugin(Star):
         - Network calls allowed; always set timeouts and, when appropriate, retries.
         - Cross‑platform paths/drives; check paths and handle exceptions.
         - Code must be self‑contained (no interactive/external dependencies).
+        - `persist(name, obj)` saves an expensive intermediate result (DataFrame, array, plain object) for this conversation; later executions — even after a restart — can use `name` directly as a variable.
 
         Args:
             code(string): self‑contained Python code to execute.
@@ -379,23 +561,12 @@ class CodeExecutorPlugin(Star):
         if not self.allow_all_users and event.role != "admin":
             await event.send(MessageChain().message("❌ 你没有权限使用此功能！"))
             return "❌ 权限验证失败：用户不是管理员，无权限运行代码。请联系管理员获取权限。操作已终止，无需重复尝试。"
+        # 预检：编译一次（按哈希缓存），安全策略与后续执行阶段共用分析结果
+        pre = preflight(code)
         if event.role != "admin" and self.non_admin_safety_enabled:
-            code_lower = code.lower() if isinstance(code, str) else str(code).lower()
-            matched = set()
-            for kw in self.restricted_keywords:
-                if kw and kw in code_lower:
-                    matched.add(kw)
-            for lib in self.restricted_libraries:
-                if not lib:
-                    continue
-                lib_l = lib.lower()
-                pattern_import = re.compile(r"^(\s*(import|from)\s+" + re.escape(lib_l) + r"\b)", re.IGNORECASE | re.MULTILINE)
-                if pattern_import.search(code):
-                    matched.add(lib_l)
-                if lib_l + "." in code_lower:
-                    matched.add(lib_l)
+            matched = self.policy.check(code, pre)
             if matched:
-                details = "、".join(sorted(matched))
+                details = "、".join(matched)
                 text = (
                     "❌ 安全策略阻止执行：检测到非管理员代码包含危险操作或库。\n"
                     f"被拦截项：{details}\n"
@@ -411,21 +582,89 @@ class CodeExecutorPlugin(Star):
         sender_name = event.get_sender_name()
         start_time = time.time()
 
+        # 语法错误不进入调度和执行
+        if not pre.ok:
+            logger.info(f"代码预检发现语法错误: {pre.syntax_error}")
+            error_msg = (
+                f"❌ 代码存在语法错误，未执行：\n```\n{pre.syntax_error}\n```\n"
+                "💡 建议：修正语法后重新调用。"
+            )
+            await event.send(MessageChain().message(error_msg))
+            try:
+                await self.db.add_execution_record(
+                    sender_id=sender_id,
+                    sender_name=sender_name,
+                    code=code,
+                    description=description,
+                    success=False,
+                    error_msg=pre.syntax_error,
+                    execution_time=time.time() - start_time
+                )
+            except Exception as db_error:
+                logger.error(f"记录执行历史失败: {db_error}", exc_info=True)
+            return error_msg
+
         # 获取消息中的图片URL
         img_urls = self.get_image_urls_from_message(event.message_obj.message)
         logger.info(f"检测到 {len(img_urls)} 个图片URL: {img_urls}")
+        # 与排队等待同时下载，执行时以 img_files 提供本地路径，下载时间不再占用执行超时
+        prefetch = None
+        if img_urls and self.image_prefetcher and pre.uses_images:
+            prefetch = asyncio.create_task(self.image_prefetcher.fetch_all(img_urls))
+
+        is_admin = event.role == "admin"
+        queue_lane = "admin" if is_admin else "user"
+        queue_wait = None
+
+        async def notify_queued(position: int):
+            await event.send(MessageChain().message(
+                f"⏳ 当前执行任务较多，已加入队列，排在第 {position} 位，轮到后将自动执行。"
+            ))
 
         try:
-            result = await self._execute_code_safely(code, img_urls, is_admin=(event.role == "admin"))
+            # 先经过调度器获取执行槽位；执行时间不包含排队等待
+            async with self.scheduler.slot(str(sender_id), is_admin, on_queued=notify_queued) as queue_wait:
+                img_files = await prefetch if prefetch else None
+                start_time = time.time()
+                streamer = None
+                if self.enable_output_streaming:
+                    streamer = OutputStreamer(
+                        event, self.stream_interval_seconds, self.stream_max_messages_per_minute,
+                        self.max_output_length
+                    )
+                    streamer.start()
+                try:
+                    result = await self._execute_code_safely(
+                        code, img_urls, is_admin=is_admin,
+                        on_stream=streamer.feed if streamer else None,
+                        session_id=event.unified_msg_origin, pre=pre, img_files=img_files
+                    )
+                finally:
+                    if streamer:
+                        await streamer.stop()
             execution_time = time.time() - start_time
+            if result.get("blocked_imports"):
+                logger.warning(f"已拦截用户 {sender_id} 导入受限库: {', '.join(result['blocked_imports'])}")
+
+            # 输出在执行端已按字节预算截断，这里只做一次 strip
+            full_output = (result.get("output") or "").strip()
+            output_note = ""
+            if result.get("output_dropped_bytes"):
+                output_note = f"⚠️ 输出过长，已省略中间 {result['output_dropped_bytes']} 字节"
+                if result.get("output_spill_path"):
+                    output_note += f"，完整输出已保存到: {result['output_spill_path']}"
+            if result.get("session_reset"):
+                output_note = "\n".join(filter(None, [output_note, f"♻️ {result['session_reset']}"]))
 
             if result["success"]:
                 response_parts = ["✅ 任务完成！"]
-                if result["output"] and result["output"].strip():
-                    output = result["output"].strip()
+                if full_output:
+                    output = full_output
                     if len(output) > self.max_output_length:
                         output = output[:self.max_output_length] + "\n...(内容已截断)"
                     response_parts.append(f"📤 执行结果：\n```\n{output}\n```")
+                if output_note:
+                    response_parts.append(output_note)
 
                 text_response = "\n".join(response_parts)
                 await event.send(MessageChain().message(text_response))
@@ -441,12 +680,41 @@ class CodeExecutorPlugin(Star):
                     llm_context_parts.append(img_context.rstrip())
                 
                 # 添加执行输出到LLM上下文
-                if result["output"] and result["output"].strip():
-                    full_output = result["output"].strip()
+                if full_output:
                     llm_context_parts.append(f"📤 执行结果：\n```\n{full_output}\n```")
+                if output_note:
+                    llm_context_parts.append(output_note)
+                if result.get("restored"):
+                    llm_context_parts.append(f"📂 已从检查点恢复变量: {', '.join(result['restored'])}")
+                if result.get("persisted"):
+                    llm_context_parts.append(
+                        f"💾 已持久化变量: {', '.join(result['persisted'])}（后续执行可直接使用，插件重启后仍然有效）"
+                    )
+                if "session_reused" in result and not result.get("session_reset"):
+                    llm_context_parts.append(
+                        "🧠 会话模式：本次定义的变量已保留，后续执行可直接使用，无需重新下载或计算；"
+                        "需要清空时调用 reset_python_session。"
+                    )
 
                 # 发送文件并记录到LLM上下文
                 sent_files = []
+                # 内存模式下生成的图表：已落盘的路径只用于 WebUI 历史记录
+                figures = result.get("figures") or []
+                recorded_figure_paths = []
+                if figures:
+                    if self.enable_local_route_sending and self.enable_webui and self.webui:
+                        # 本地路由按文件 URL 发送，图表落盘后交给下面的文件发送流程
+                        figure_paths = await asyncio.to_thread(self._persist_figures, figures)
+                        result["file_paths"] = figure_paths + result["file_paths"]
+                    else:
+                        for figure in figures:
+                            if await self._send_figure_from_memory(figure, event):
+                                sent_files.append(f"📷 已发送图片: {figure['name']} - 发送成功，任务完成。")
+                            else:
+                                sent_files.append(f"❌ 图表发送失败: {figure['name']}")
+                        if self.enable_webui:
+                            # 发送完成后再落盘，供 WebUI 历史记录查看
+                            recorded_figure_paths = await asyncio.to_thread(self._persist_figures, figures)
                 if result["file_paths"]:
                     logger.info(f"发现 {len(result['file_paths'])} 个待发送文件，正在处理...")
                     for file_path in result["file_paths"]:
@@ -474,7 +742,7 @@ class CodeExecutorPlugin(Star):
                             # 如果前面的方式都失败或未启用，使用AstrBot原生方法发送文件
                             if not success:
                                 is_image = any(
-                                    file_name.lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp'])
+                                    file_name.lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'])
                                 if is_image:
                                     logger.info(f"正在以图片形式发送: {file_path}")
                                     await event.send(MessageChain().file_image(file_path))
@@ -519,13 +787,21 @@ class CodeExecutorPlugin(Star):
                         success=True,
                         output=result["output"],
                         error_msg=None,
-                        file_paths=result["file_paths"],
-                        execution_time=execution_time
+                        file_paths=recorded_figure_paths + result["file_paths"],
+                        execution_time=execution_time,
+                        libraries_used=result.get("libraries_used"),
+                        resource_usage=result.get("resource_usage"),
+                        session_reused=result.get("session_reused"),
+                        figure_stats=result.get("figure_stats"),
+                        blocked_imports=result.get("blocked_imports"),
+                        output_file=result.get("output_spill_path"),
+                        queue_lane=queue_lane,
+                        queue_wait=queue_wait
                     )
                 except Exception as db_error:
                     logger.error(f"记录执行历史失败: {db_error}", exc_info=True)
                 
-                if not (result["output"] and result["output"].strip()) and not result["file_paths"]:
+                if not full_output and not result["file_paths"] and not figures:
                     return "✅ 代码执行完成，但无文件、图片或文本输出或者文件操作未添加到FILES_TO_SEND列表。任务已完全完成，无需再次执行或重复调用。"
                 
                 # 在返回内容末尾明确标记任务完成
@@ -536,6 +812,8 @@ class CodeExecutorPlugin(Star):
                 error_msg = f"❌ 代码执行失败！\n错误信息：\n```\n{result['error']}\n```"
                 if result.get("output"):
                     error_msg += f"\n\n出错前输出：\n```\n{result['output']}\n```"
+                if output_note:
+                    error_msg += f"\n{output_note}"
                 error_msg += "\n💡 建议：请检查代码逻辑和语法，修正后可重新尝试执行。"
                 
                 # 添加图片URL信息到错误上下文
@@ -563,7 +841,16 @@ class CodeExecutorPlugin(Star):
                         output=result.get("output"),
                         error_msg=result["error"],
                         file_paths=[],
-                        execution_time=execution_time
+                        execution_time=execution_time,
+                        status="killed" if result.get("killed") else "failed",
+                        reclaim_time=result.get("reclaim_time"),
+                        libraries_used=result.get("libraries_used"),
+                        resource_usage=result.get("resource_usage"),
+                        session_reused=result.get("session_reused"),
+                        blocked_imports=result.get("blocked_imports"),
+                        output_file=result.get("output_spill_path"),
+                        queue_lane=queue_lane,
+                        queue_wait=queue_wait
                     )
                 except Exception as db_error:
                     logger.error(f"记录执行历史失败: {db_error}", exc_info=True)
@@ -571,6 +858,27 @@ class CodeExecutorPlugin(Star):
                 # 返回详细的错误信息给LLM上下文（包含错误分析）
                 return error_msg
 
+        except QueueFullError as e:
+            # 队列已满时立即拒绝，不进入执行，以 rejected 状态记录执行历史
+            logger.warning(f"执行队列已满，拒绝用户 {sender_id} 的任务: {e}")
+            text = f"❌ 当前执行任务过多，{e}，请稍后再试。"
+            await event.send(MessageChain().message(text))
+            try:
+                await self.db.add_execution_record(
+                    sender_id=sender_id,
+                    sender_name=sender_name,
+                    code=code,
+                    description=description,
+                    success=False,
+                    error_msg=f"执行队列已满: {e}",
+                    execution_time=time.time() - start_time,
+                    status="rejected",
+                    queue_lane=queue_lane
+                )
+            except Exception as db_error:
+                logger.error(f"记录执行历史失败: {db_error}", exc_info=True)
+            return text
+
         except Exception as e:
             logger.error(f"插件内部错误: {str(e)}", exc_info=True)
             execution_time = time.time() - start_time
@@ -596,306 +904,100 @@ class CodeExecutorPlugin(Star):
                     output=None,
                     error_msg=f"插件内部错误: {str(e)}",
                     file_paths=[],
-                    execution_time=execution_time
+                    execution_time=execution_time,
+                    queue_lane=queue_lane,
+                    queue_wait=queue_wait
                 )
             except Exception as db_error:
                 logger.error(f"记录执行历史失败: {db_error}", exc_info=True)
             
             # 返回详细的错误信息给LLM上下文
             return error_msg
+        finally:
+            if prefetch is not None:
+                # 预取的图片只供本次执行使用；排队被拒绝时同时取消未完成的下载
+                prefetch.cancel()
+                prefetch.add_done_callback(self.image_prefetcher.discard)
 
-    async def _execute_code_safely(self, code: str, img_urls: List[str] = None, is_admin: bool = True) -> Dict[str, Any]:
-        def run_code(code_to_run: str, file_output_dir: str, image_urls: List[str] = None, is_admin_flag: bool = True):
-            old_stdout, old_stderr = sys.stdout, sys.stderr
-            output_buffer, error_buffer = io.StringIO(), io.StringIO()
-
-            files_to_send_explicitly = []
-            files_before = set(os.listdir(file_output_dir)) if os.path.exists(file_output_dir) else set()
-
-            try:
-                sys.stdout, sys.stderr = output_buffer, error_buffer
+    @filter.llm_tool(name="reset_python_session")
+    async def reset_python_session(self, event: AstrMessageEvent) -> str:
+        '''
+        Reset the persistent Python session of the current conversation, discarding all variables kept by previous
+        `execute_python_code` calls. Call ONLY when the user asks to start over/clear state, or when stale session
+        state is clearly causing errors.
+        '''
+        if not self.session_pool:
+            return "ℹ️ 会话模式未启用，每次执行本来就使用全新的命名空间，无需重置。"
+        if not self.allow_all_users and event.role != "admin":
+            return "❌ 权限验证失败：用户不是管理员，无权限重置执行会话。"
+        if await self.session_pool.reset(self._session_key(event.unified_msg_origin, event.role == "admin")):
+            await event.send(MessageChain().message("♻️ 已重置当前会话的 Python 执行环境"))
+            return "✅ 当前会话的 Python 执行环境已重置，之前定义的变量已全部清除。"
+        return "ℹ️ 当前会话没有活动的 Python 执行环境，无需重置。"
 
-                exec_globals = {
-                    '__builtins__': __builtins__,
-                    'print': print,
-                    'SAVE_DIR': file_output_dir,
-                    'FILES_TO_SEND': files_to_send_explicitly,
-                    'img_url': image_urls or [],  # 提供图片URL列表给代码使用
-                    'io': io
-                }
+    @staticmethod
+    def _session_key(session_id: str, is_admin: bool) -> str:
+        """会话按对话与执行身份区分：管理员会话的命名空间模板包含受限库，不能被同一对话中的普通用户沿用"""
+        return f"{session_id}:{'admin' if is_admin else 'user'}"
 
-                try:
-                    import matplotlib
-                    matplotlib.use('Agg')
-                    import matplotlib.pyplot as plt
-                    import matplotlib.font_manager as fm
-                    import platform
-                    
-                    # 智能检测和配置中文字体
-                    def setup_chinese_fonts():
-                        """智能检测并配置中文字体，支持多平台，并强制设置默认字体族"""
-                        system = platform.system().lower()
-                        available_fonts = [f.name for f in fm.fontManager.ttflist]
-                        
-                        # 定义不同平台的中文字体优先级列表
-                        chinese_fonts = {
-                            'windows': [
-                                'Microsoft YaHei', 'SimHei', 'SimSun', 'KaiTi', 'FangSong',
-                                'Microsoft JhengHei', 'DFKai-SB', 'MingLiU'
-                            ],
-                            'darwin': [  # macOS
-                                'PingFang SC', 'Hiragino Sans GB', 'STHeiti', 'STSong',
-                                'STKaiti', 'STFangsong', 'Songti SC', 'Kaiti SC'
-                            ],
-                            'linux': [
-                                'Noto Sans CJK SC', 'Noto Serif CJK SC', 'Source Han Sans SC',
-                                'Source Han Serif SC', 'WenQuanYi Micro Hei', 'WenQuanYi Zen Hei',
-                                'AR PL UMing CN', 'AR PL UKai CN', 'SimHei', 'SimSun'
-                            ]
-                        }
-                        
-                        # 获取当前系统的字体列表
-                        system_fonts = chinese_fonts.get(system, chinese_fonts['windows'])
-                        
-                        found_fonts, found_paths = [], []
-                        
-                        # 先按优先级尝试 findfont，确保拿到路径并注册
-                        for font in system_fonts:
-                            try:
-                                path = fm.findfont(font, fallback_to_default=False)
-                                if path and os.path.exists(path):
-                                    try:
-                                        fm.fontManager.addfont(path)
-                                    except Exception:
-                                        pass
-                                    family = fm.FontProperties(fname=path).get_name()
-                                    found_fonts.append(family)
-                                    found_paths.append(path)
-                                    logger.debug(f"找到可用中文字体: {family} ({path})")
-                            except Exception:
-                                continue
-                        
-                        # 如果没找到，尝试常见候选与名称关键词
-                        if not found_fonts:
-                            logger.warning("未找到预定义的中文字体，尝试搜索其他中文字体...")
-                            fallback_candidates = [
-                                'Microsoft YaHei', 'SimHei', 'SimSun', 'Noto Sans CJK SC',
-                                'Source Han Sans SC', 'PingFang SC'
-                            ]
-                            for font in fallback_candidates + available_fonts:
-                                try:
-                                    path = fm.findfont(font, fallback_to_default=False)
-                                    if path and os.path.exists(path):
-                                        try:
-                                            fm.fontManager.addfont(path)
-                                        except Exception:
-                                            pass
-                                        family = fm.FontProperties(fname=path).get_name()
-                                        # 避免重复
-                                        if family not in found_fonts:
-                                            found_fonts.append(family)
-                                            found_paths.append(path)
-                                            logger.debug(f"找到候选中文字体: {family} ({path})")
-                                            if len(found_fonts) >= 3:
-                                                break
-                                except Exception:
-                                    continue
-                        
-                        # 构建字体列表（中文字体 + 英文回退字体）
-                        font_list = found_fonts + ['DejaVu Sans', 'Arial', 'Liberation Sans', 'sans-serif']
-                        primary_font = found_fonts[0] if found_fonts else 'DejaVu Sans'
-                        
-                        if found_fonts:
-                            logger.info(f"配置中文字体成功，使用字体: {primary_font} (共找到 {len(found_fonts)} 个中文字体)")
-                            try:
-                                logger.debug(f"主字体路径: {found_paths[0]}")
-                            except Exception:
-                                pass
-                        else:
-                            logger.warning("未找到任何中文字体，将使用系统默认字体，中文可能显示为方框")
-                        
-                        return font_list, primary_font
-                    
-                    # 应用字体配置
-                    font_list, primary_font = setup_chinese_fonts()
-                    plt.rcParams['font.family'] = [primary_font, 'sans-serif']
-                    plt.rcParams['font.sans-serif'] = font_list
-                    plt.rcParams['axes.unicode_minus'] = False
-                    
-                    # 设置字体缓存刷新（确保字体配置生效）
-                    try:
-                        fm._rebuild()
-                    except:
-                        pass  # 某些版本的matplotlib可能没有这个方法
-                    
-                    original_show, original_savefig = plt.show, plt.savefig
-
-                    def save_and_close_current_fig(base_name: str):
-                        fig = plt.gcf()
-                        if not fig.get_axes(): plt.close(fig); return
-                        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                        filename = f"{base_name}_{timestamp}_{len(os.listdir(file_output_dir))}.png"
-                        filepath = os.path.join(file_output_dir, filename)
-                        try:
-                            original_savefig(filepath, dpi=150, bbox_inches='tight')
-                            print(f"[图表已保存: {filepath}]")
-                            try:
-                                files_to_send_explicitly.append(filepath)
-                            except Exception:
-                                pass
-                        except Exception as e:
-                            print(f"[保存图表失败: {e}]")
-                        finally:
-                            plt.close(fig)
-
-                    plt.show = lambda *args, **kwargs: save_and_close_current_fig("plot")
-                    plt.savefig = lambda fname, *args, **kwargs: save_and_close_current_fig(
-                        os.path.splitext(os.path.basename(fname))[0] if isinstance(fname, str) else "plot"
-                    )
-                    exec_globals.update({'matplotlib': matplotlib, 'plt': plt})
-                except ImportError:
-                    logger.warning("matplotlib 不可用，图表功能禁用")
-
-                libs_to_inject = {
-                    # 数据科学核心
-                    'numpy': 'np', 'pandas': 'pd', 'scipy': 'scipy', 'statsmodels': 'statsmodels',
-                    # 网络请求
-                    'requests': 'requests', 'aiohttp': 'aiohttp', 'urllib': 'urllib', 'socket': 'socket',
-                    # 可视化
-                    'seaborn': 'sns', 'plotly': 'plotly', 'bokeh': 'bokeh',
-                    # 文件处理
-                    'openpyxl': 'openpyxl', 'docx': 'docx', 'fpdf': 'fpdf', 
-                    'json': 'json', 'yaml': 'yaml', 'csv': 'csv', 'pickle': 'pickle',
-                    # 数据库
-                    'sqlite3': 'sqlite3', 'pymongo': 'pymongo', 'sqlalchemy': 'sqlalchemy',
-                    'psycopg2': 'psycopg2',
-                    # 图像处理
-                    'PIL': 'PIL', 'cv2': 'cv2', 'imageio': 'imageio',
-                    # 时间处理
-                    'datetime': 'datetime', 'time': 'time', 'calendar': 'calendar',
-                    # 加密安全
-                    'hashlib': 'hashlib', 'hmac': 'hmac', 'secrets': 'secrets', 
-                    'base64': 'base64', 'cryptography': 'cryptography',
-                    # 文本处理
-                    're': 're', 'string': 'string', 'textwrap': 'textwrap', 
-                    'difflib': 'difflib', 'nltk': 'nltk', 'jieba': 'jieba',
-                    # 系统工具
-                    'os': 'os', 'sys': 'sys', 'shutil': 'shutil', 'zipfile': 'zipfile',
-                    'tarfile': 'tarfile', 'pathlib': 'pathlib', 'subprocess': 'subprocess',
-                    # 数学科学
-                    'sympy': 'sympy', 'math': 'math', 'statistics': 'statistics',
-                    'random': 'random', 'decimal': 'decimal', 'fractions': 'fractions',
-                    # 实用工具
-                    'itertools': 'itertools', 'collections': 'collections', 
-                    'functools': 'functools', 'operator': 'operator', 'copy': 'copy', 'uuid': 'uuid'
-                }
-                if not is_admin_flag and getattr(self, 'restricted_libraries', None):
-                    rl = set(self.restricted_libraries)
-                    libs_to_inject = {k: v for k, v in libs_to_inject.items() if k.lower() not in rl}
-                for lib_name, alias in libs_to_inject.items():
-                    try:
-                        lib = __import__(lib_name)
-                        exec_globals[alias or lib_name] = lib
-                    except ImportError:
-                        logger.warning(f"库 {lib_name} 不可用，相关功能禁用")
-                # 特殊库导入处理
-                try:
-                    from bs4 import BeautifulSoup; exec_globals['BeautifulSoup'] = BeautifulSoup
-                except ImportError:
-                    pass
-                try:
-                    from PIL import Image; exec_globals['Image'] = Image
-                except ImportError:
-                    pass
-                try:
-                    from dateutil import parser as dateutil_parser; exec_globals['dateutil_parser'] = dateutil_parser
-                    import dateutil; exec_globals['dateutil'] = dateutil
-                except ImportError:
-                    pass
-                # 机器学习库导入已移除
-
-                # 确保代码字符串使用正确的编码
-                if isinstance(code_to_run, str):
-                    # 处理可能的编码问题
-                    try:
-                        code_to_run.encode('utf-8')
-                    except UnicodeEncodeError:
-                        # 如果包含无法编码的字符，尝试清理
-                        code_to_run = code_to_run.encode('utf-8', errors='ignore').decode('utf-8')
-                
-                exec(code_to_run, exec_globals)
-
-                # 检查是否有未关闭的图表，但不自动保存，只关闭
-                if 'plt' in exec_globals and plt.get_fignums():
-                    for fig_num in list(plt.get_fignums()):
-                        plt.figure(fig_num)
-                        plt.close(fig_num)  # 只关闭图表，不保存
-
-                if 'plt' in exec_globals: plt.show, plt.savefig = original_show, original_savefig
-
-                # 优先使用 FILES_TO_SEND 列表，提高文件归属准确性
-                # 过滤掉不存在的显式路径，避免重复和日志噪音
-                files_to_send_explicitly = [
-                    p for p in files_to_send_explicitly
-                    if isinstance(p, str) and os.path.exists(p) and os.path.isfile(p)
-                ]
-                if files_to_send_explicitly:
-                    # 如果用户显式添加了文件到 FILES_TO_SEND，优先使用这些文件
-                    all_files_to_send = files_to_send_explicitly[:]
-                    # 同时检测新生成的文件作为补充
-                    files_after = set(os.listdir(file_output_dir)) if os.path.exists(file_output_dir) else set()
-                    newly_generated_filenames = files_after - files_before
-                    newly_generated_files = [os.path.join(file_output_dir, f) for f in newly_generated_filenames]
-                    # 去重合并
-                    all_files_to_send.extend([f for f in newly_generated_files if f not in all_files_to_send])
-                else:
-                    # 如果没有显式指定文件，则使用目录检测方式
-                    files_after = set(os.listdir(file_output_dir)) if os.path.exists(file_output_dir) else set()
-                    newly_generated_filenames = files_after - files_before
-                    all_files_to_send = [os.path.join(file_output_dir, f) for f in newly_generated_filenames]
-
-                # 安全处理输出内容的编码
-                output_content = output_buffer.getvalue()
-                try:
-                    # 确保输出内容可以正确编码
-                    output_content.encode('utf-8')
-                except UnicodeEncodeError:
-                    # 如果输出包含无法编码的字符，进行清理
-                    output_content = output_content.encode('utf-8', errors='ignore').decode('utf-8')
-                
-                return {
-                    "success": True, "output": output_content, "error": None,
-                    "file_paths": all_files_to_send
-                }
-            except Exception:
-                tb_str = traceback.format_exc()
-                logger.error(f"代码执行出错:\n{tb_str}")
-                
-                # 安全处理错误输出的编码
-                error_output = output_buffer.getvalue()
-                try:
-                    error_output.encode('utf-8')
-                    tb_str.encode('utf-8')
-                except UnicodeEncodeError:
-                    error_output = error_output.encode('utf-8', errors='ignore').decode('utf-8')
-                    tb_str = tb_str.encode('utf-8', errors='ignore').decode('utf-8')
-                
-                return {"success": False, "error": tb_str, "output": error_output, "file_paths": []}
-            finally:
-                sys.stdout, sys.stderr = old_stdout, old_stderr
-                try:
-                    if 'plt' in locals() and 'matplotlib' in sys.modules: plt.close('all')
-                except:
-                    pass
+    async def _execute_in_subinterpreter(self, code: str, pre: PreflightResult, img_urls: List[str],
+                                         session_id: str = None,
+                                         img_files: List[Optional[str]] = None) -> Dict[str, Any]:
+        """按代码的导入判断能否在子解释器中执行，不适用或执行中遇到不支持的模块时返回 None"""
+        persisted = set(StateStore(self.tools.get_data_dir(), session_id).names()) if session_id else set()
+        if not subinterpreter.can_run(pre, persisted):
+            return None
+        if not self.subinterpreter_backend.available:
+            logger.warning("子解释器线程已全部被占用（可能有超时后仍在运行的代码），改用进程池执行")
+            return None
+        try:
+            return await self.subinterpreter_backend.execute(code, pre, img_urls, img_files,
+                                                             timeout=self.timeout_seconds)
+        except asyncio.TimeoutError:
+            raise
+        except Exception as e:
+            logger.warning(f"子解释器执行出错，回退到进程池: {e}")
+            return None
 
-        # 使用 asyncio.to_thread 替代 threading + queue，避免阻塞事件循环
+    async def _execute_code_safely(self, code: str, img_urls: List[str] = None, is_admin: bool = True,
+                                   on_stream: Callable[[str], None] = None, session_id: str = None,
+                                   pre: PreflightResult = None,
+                                   img_files: List[Optional[str]] = None) -> Dict[str, Any]:
+        pre = pre or preflight(code)
+        # session_id 同时作为 persist() 持久化状态的作用域；编译结果随任务发送，执行端不再重复编译
+        task = {"code": code, "img_urls": img_urls, "img_files": img_files, "is_admin": is_admin,
+                "state_scope": session_id,
+                "compiled": pre.marshalled() if pre.ok else None, "needs_plotting": pre.uses_plotting}
         try:
+            # 子解释器中没有运行时导入拦截（import_guard），设置了受限库时非管理员代码只在进程池中执行；
+            # 子解释器也不支持流式输出，需要流式发送的执行同样交给进程池
+            if (self.subinterpreter_backend and not (self.session_pool and session_id) and on_stream is None
+                    and (is_admin or not self.restricted_libraries)):
+                result = await self._execute_in_subinterpreter(code, pre, img_urls, session_id, img_files)
+                if result is not None:
+                    return result
+            if self.session_pool and session_id:
+                # 会话模式：在该会话的专用工作进程中执行，保留命名空间
+                return await self.session_pool.execute(self._session_key(session_id, is_admin), task,
+                                                       timeout=self.timeout_seconds, on_stream=on_stream)
+            if self.worker_pool:
+                # 在预热的工作进程中执行，避免占用主进程的 GIL
+                return await self.worker_pool.execute(task, timeout=self.timeout_seconds, on_stream=on_stream)
+            # 进程池关闭时回退到 asyncio.to_thread，在插件进程内执行
+            stream_callback = None
+            if on_stream:
+                loop = asyncio.get_running_loop()
+                stream_callback = lambda text: loop.call_soon_threadsafe(on_stream, text)
             result = await asyncio.wait_for(
-                asyncio.to_thread(run_code, code, self.file_output_dir, img_urls, is_admin),
+                asyncio.to_thread(run_code, code, self.file_output_dir, img_urls, is_admin,
+                                  self.restricted_libraries, stream_callback, None, session_id,
+                                  pre.compiled, pre.uses_plotting, img_files),
                 timeout=self.timeout_seconds
             )
             return result
         except asyncio.TimeoutError:
+            # 线程无法被强制终止，只有进程池模式才会真正结束超时的代码
+            logger.warning("代码执行超时，插件进程内的执行线程无法被终止，建议启用执行进程池")
             return {"success": False, "error": f"代码执行超时（超过 {self.timeout_seconds} 秒）", "output": None,
                     "file_paths": []}
 
@@ -903,6 +1005,22 @@ class CodeExecutorPlugin(Star):
         """插件卸载时的清理工作"""
         try:
             logger.info("正在卸载代码执行器插件...")
+
+            # 关闭执行进程池
+            if getattr(self, 'worker_pool', None):
+                try:
+                    await self.worker_pool.shutdown()
+                except Exception as e:
+                    logger.warning(f"关闭执行进程池时出现问题: {e}")
+            if getattr(self, 'session_pool', None):
+                try:
+                    await self.session_pool.shutdown()
+                except Exception as e:
+                    logger.warning(f"关闭执行会话时出现问题: {e}")
+            if getattr(self, 'subinterpreter_backend', None):
+                self.subinterpreter_backend.shutdown()
+            if getattr(self, 'image_prefetcher', None):
+                await self.image_prefetcher.close()
             
             # 只有启用WebUI时才进行清理
             if self.enable_webui and hasattr(self, 'webui') and self.webui:
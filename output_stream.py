@@ -0,0 +1,67 @@
+import asyncio
+import time
+from collections import deque
+
+from astrbot.api import logger
+from astrbot.api.event import AstrMessageEvent, MessageChain
+
+
+class OutputStreamer:
+    """把执行中途的输出分批发送到聊天
+
+    新输出先合并缓存，按固定间隔只发送完整的行；发送频率受每分钟消息数限制，
+    超出限制时继续合并，等待下一个可用窗口。最终完整结果仍由 execute_python_code 返回给LLM。
+    """
+
+    def __init__(self, event: AstrMessageEvent, interval: float, max_messages_per_minute: int,
+                 max_chars: int = 2000):
+        self.event = event
+        self.interval = max(0.5, interval)
+        self.max_messages_per_minute = max(1, max_messages_per_minute)
+        self.max_chars = max_chars
+        self._pending = ""
+        self._sent_times = deque()
+        self._task = None
+        self.messages_sent = 0
+
+    def feed(self, text: str):
+        """接收工作进程发来的新增输出（在事件循环中调用）"""
+        self._pending += text
+        # 积压过多时只保留最新部分，避免发送超长消息
+        if len(self._pending) > self.max_chars * 4:
+            self._pending = self._pending[-self.max_chars * 4:]
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止发送；尚未发送的输出包含在最终结果中，这里直接丢弃"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _has_budget(self) -> bool:
+        now = time.monotonic()
+        while self._sent_times and now - self._sent_times[0] > 60:
+            self._sent_times.popleft()
+        return len(self._sent_times) < self.max_messages_per_minute
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            # 只发送完整的行，未换行的部分留到下次合并
+            cut = self._pending.rfind("\n")
+            if cut < 0 or not self._has_budget():
+                continue
+            chunk, self._pending = self._pending[:cut], self._pending[cut + 1:]
+            if not chunk.strip():
+                continue
+            if len(chunk) > self.max_chars:
+                chunk = "...(部分输出已省略)\n" + chunk[-self.max_chars:]
+            try:
+                await self.event.send(MessageChain().message(f"⏳ 运行中输出：\n```\n{chunk}\n```"))
+                self._sent_times.append(time.monotonic())
+                self.messages_sent += 1
+            except Exception as e:
+                logger.warning(f"发送流式输出失败: {e}")
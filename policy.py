@@ -0,0 +1,101 @@
+"""非管理员代码的安全策略检查
+
+配置加载时编译一次，之后每次执行只做一遍扫描：
+- 关键词（restricted_keywords）：关键词较多时使用 Aho-Corasick 自动机，一遍扫描即可找出全部命中；
+  关键词较少时逐个子串查找（C 实现）反而更快，编译时按数量自动选择；
+- 库（restricted_libraries）：复用预检阶段的 AST 分析结果（导入的模块、作为变量读取的名称），
+  不再对每个库单独编译正则、逐行扫描源码。
+检查结果按代码哈希缓存，LLM 重试提交相同代码时直接复用。
+"""
+from collections import OrderedDict, deque
+from typing import Dict, FrozenSet, Iterable, List
+
+from .preflight import PreflightResult
+
+# 关键词数量达到该值时改用自动机（更少时逐个子串查找更快，见 bench_executor.bench_policy_engine）
+AUTOMATON_MIN_KEYWORDS = 128
+
+# 检查结果缓存条数上限
+VERDICT_CACHE_SIZE = 256
+
+
+class KeywordAutomaton:
+    """Aho-Corasick 多模式匹配自动机
+
+    构建时把失败转移展开成完整的转移表，扫描时每个字符只需一次字典查找。
+    """
+
+    def __init__(self, keywords: Iterable[str]):
+        goto: List[Dict[str, int]] = [{}]
+        self._outputs: List[FrozenSet[str]] = [frozenset()]
+        for keyword in keywords:
+            state = 0
+            for char in keyword:
+                if char not in goto[state]:
+                    goto.append({})
+                    self._outputs.append(frozenset())
+                    goto[state][char] = len(goto) - 1
+                state = goto[state][char]
+            self._outputs[state] |= {keyword}
+
+        # 按广度优先顺序计算失败转移，并把父状态的完整转移表合并进来
+        fail = [0] * len(goto)
+        self._delta: List[Dict[str, int]] = [dict(goto[0])] + [None] * (len(goto) - 1)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            inherited = self._delta[fail[state]]
+            self._delta[state] = dict(inherited, **goto[state]) if goto[state] else inherited
+            for char, child in goto[state].items():
+                fail[child] = self._delta[fail[state]].get(char, 0)
+                self._outputs[child] |= self._outputs[fail[child]]
+                queue.append(child)
+
+    def find_all(self, text: str) -> FrozenSet[str]:
+        delta, outputs = self._delta, self._outputs
+        state, found = 0, set()
+        for char in text:
+            state = delta[state].get(char, 0)
+            if outputs[state]:
+                found |= outputs[state]
+        return frozenset(found)
+
+
+class PolicyEngine:
+    """根据关键词与库黑名单检查代码，返回命中的拦截项"""
+
+    def __init__(self, keywords: Iterable[str], libraries: Iterable[str]):
+        self.keywords = sorted({k.lower() for k in keywords if k})
+        self.libraries = sorted({lib.lower() for lib in libraries if lib})
+        self._automaton = KeywordAutomaton(self.keywords) if len(self.keywords) >= AUTOMATON_MIN_KEYWORDS else None
+        self._verdicts: "OrderedDict[str, List[str]]" = OrderedDict()
+
+    def _match_keywords(self, code_lower: str) -> FrozenSet[str]:
+        if self._automaton is not None:
+            return self._automaton.find_all(code_lower)
+        return frozenset(k for k in self.keywords if k in code_lower)
+
+    def _match_libraries(self, pre: PreflightResult) -> FrozenSet[str]:
+        if not pre.ok:
+            return frozenset()  # 有语法错误的代码不会被执行，只需检查关键词
+        modules = {m.lower() for m in pre.modules}
+        names = {n.lower() for n in pre.loaded_names}
+        matched = set()
+        for lib in self.libraries:
+            # 导入该库（或其子模块），或直接读取注入的同名变量（如 socket.socket(...)）；
+            # 同名的属性（self.socket、obj.psutil）与其他库无关，不算命中
+            if any(m == lib or m.startswith(lib + ".") for m in modules) or lib in names:
+                matched.add(lib)
+        return frozenset(matched)
+
+    def check(self, code: str, pre: PreflightResult) -> List[str]:
+        """返回命中的关键词与库（已排序），为空表示允许执行"""
+        verdict = self._verdicts.get(pre.code_hash)
+        if verdict is not None:
+            self._verdicts.move_to_end(pre.code_hash)
+            return verdict
+        verdict = sorted(self._match_keywords(code.lower()) | self._match_libraries(pre))
+        self._verdicts[pre.code_hash] = verdict
+        if len(self._verdicts) > VERDICT_CACHE_SIZE:
+            self._verdicts.popitem(last=False)
+        return verdict
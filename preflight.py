@@ -0,0 +1,122 @@
+"""代码预检
+
+在进入调度和执行之前把代码编译一次（按代码哈希缓存），语法错误直接返回，
+并提取导入的模块和引用的名称，供后续阶段跳过用不到的准备工作（字体配置、图片处理等）。
+"""
+import ast
+import hashlib
+import marshal
+from collections import OrderedDict
+from typing import FrozenSet, Optional
+
+from .checkpoint import referenced_names
+
+# 预检结果缓存条数上限（LLM 重试时常会提交完全相同的代码）
+PREFLIGHT_CACHE_SIZE = 256
+
+# 引用到这些名称（含 df.plot() 之类的属性名）说明代码可能绘图
+PLOTTING_NAMES = frozenset({
+    'plt', 'matplotlib', 'sns', 'seaborn', 'plot', 'hist', 'boxplot', 'scatter_matrix', 'pyplot',
+})
+PLOTTING_MODULES = frozenset({'matplotlib', 'seaborn'})
+
+# 引用到这些注入变量说明代码要处理消息中的图片
+IMAGE_NAMES = frozenset({'img_url', 'img_files'})
+
+
+class PreflightResult:
+    """一段代码的预检结果"""
+
+    def __init__(self, code_hash: str, compiled=None, syntax_error: str = None,
+                 imports: FrozenSet[str] = frozenset(), names: FrozenSet[str] = frozenset(),
+                 has_relative_import: bool = False, modules: FrozenSet[str] = frozenset(),
+                 loaded_names: FrozenSet[str] = frozenset()):
+        self.code_hash = code_hash
+        self.compiled = compiled
+        self.syntax_error = syntax_error
+        # 导入的顶层模块名
+        self.imports = imports
+        # 导入的完整模块名：含 from x import y 的 x.y，以及 __import__/import_module 的常量参数
+        self.modules = modules
+        self.names = names
+        # 作为变量读取的名称（ast.Name 的 Load），不含属性名，如 obj.socket 中的 socket
+        self.loaded_names = loaded_names
+        self.has_relative_import = has_relative_import
+        self._marshalled: Optional[bytes] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.syntax_error is None
+
+    @property
+    def uses_plotting(self) -> bool:
+        return bool(self.imports & PLOTTING_MODULES or self.names & PLOTTING_NAMES)
+
+    @property
+    def uses_images(self) -> bool:
+        return bool(self.names & IMAGE_NAMES)
+
+    def marshalled(self) -> bytes:
+        """编译结果的 marshal 序列化，发送给工作进程后无需再次编译"""
+        if self._marshalled is None:
+            self._marshalled = marshal.dumps(self.compiled)
+        return self._marshalled
+
+
+_cache: "OrderedDict[str, PreflightResult]" = OrderedDict()
+
+
+def _format_syntax_error(e: SyntaxError) -> str:
+    lines = [f"{type(e).__name__}: {e.msg}（第 {e.lineno} 行）"]
+    if e.text:
+        lines.append(e.text.rstrip("\n"))
+        if e.offset:
+            lines.append(" " * (e.offset - 1) + "^")
+    return "\n".join(lines)
+
+
+def _is_dynamic_import(func: ast.expr) -> bool:
+    """__import__('x') 或 importlib.import_module('x')"""
+    if isinstance(func, ast.Name):
+        return func.id in ('__import__', 'import_module')
+    return isinstance(func, ast.Attribute) and func.attr == 'import_module'
+
+
+def preflight(code: str) -> PreflightResult:
+    """编译并分析代码，结果按代码哈希缓存"""
+    code_hash = hashlib.sha256(code.encode("utf-8", errors="surrogatepass")).hexdigest()
+    cached = _cache.get(code_hash)
+    if cached is not None:
+        _cache.move_to_end(code_hash)
+        return cached
+
+    try:
+        tree = ast.parse(code)
+        compiled = compile(tree, "<string>", "exec")
+    except (SyntaxError, ValueError) as e:
+        error = _format_syntax_error(e) if isinstance(e, SyntaxError) else f"{type(e).__name__}: {e}"
+        result = PreflightResult(code_hash, syntax_error=error)
+    else:
+        modules, loaded, relative = set(), set(), False
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules.update(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom):
+                if node.level or not node.module:
+                    relative = True
+                else:
+                    modules.add(node.module)
+                    modules.update(f"{node.module}.{alias.name}" for alias in node.names)
+            elif isinstance(node, ast.Call) and node.args and isinstance(node.args[0], ast.Constant) \
+                    and isinstance(node.args[0].value, str) and _is_dynamic_import(node.func):
+                modules.add(node.args[0].value)
+            elif isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
+                loaded.add(node.id)
+        result = PreflightResult(code_hash, compiled, imports=frozenset(m.partition('.')[0] for m in modules),
+                                 names=frozenset(referenced_names(compiled)), has_relative_import=relative,
+                                 modules=frozenset(modules), loaded_names=frozenset(loaded))
+
+    _cache[code_hash] = result
+    if len(_cache) > PREFLIGHT_CACHE_SIZE:
+        _cache.popitem(last=False)
+    return result
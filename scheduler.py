@@ -0,0 +1,187 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, Optional
+
+from astrbot.api import logger
+
+ADMIN_LANE = "admin"
+USER_LANE = "user"
+
+
+class QueueFullError(Exception):
+    """执行等待队列已满"""
+
+
+class ExecutionScheduler:
+    """代码执行准入调度器
+
+    - 全局并发上限：同时执行的任务数不超过 max_concurrent
+    - 用户并发上限：同一发送者同时执行的任务数不超过 per_user_limit
+    - 有界等待队列：每个通道最多 max_queue 个等待任务，普通用户排满队列不影响管理员入队；每个用户一个 FIFO 队列，用户之间轮询出队（最久未获得槽位的用户优先，刚执行过的用户排到最后），
+      避免单个用户的突发请求占满执行槽位
+    - 管理员通道：admin_reserved_slots 个槽位只分配给管理员（普通用户的并发上限相应减少）；admin_priority 开启时管理员的等待任务优先出队，
+      关闭时两个通道轮流出队
+    """
+
+    def __init__(self, max_concurrent: int, per_user_limit: int, max_queue: int,
+                 admin_reserved_slots: int = 0, admin_priority: bool = True):
+        self.max_concurrent = max(1, max_concurrent)
+        self.per_user_limit = max(1, per_user_limit)
+        self.max_queue = max(0, max_queue)
+        # 至少保留一个普通用户可用的槽位
+        self.admin_reserved_slots = min(max(0, admin_reserved_slots), self.max_concurrent - 1)
+        self.admin_priority = admin_priority
+        self._running_total = 0
+        self._running_by_lane: Dict[str, int] = {ADMIN_LANE: 0, USER_LANE: 0}
+        self._running_by_user: Dict[str, int] = {}
+        # 通道 -> 用户 -> 等待中的 Future 队列；OrderedDict 的顺序为入队顺序，同等条件下先入队的用户优先
+        self._lanes: Dict[str, "OrderedDict[str, deque]"] = {ADMIN_LANE: OrderedDict(), USER_LANE: OrderedDict()}
+        # 用户最近一次获得槽位的序号，轮询时序号最小（最久未执行）的用户优先；没有运行也没有排队的用户会被清除
+        self._served: Dict[str, int] = {}
+        self._serve_seq = 0
+        self._lane_order = [ADMIN_LANE, USER_LANE]
+        self._queued = 0
+        self._queued_by_lane: Dict[str, int] = {ADMIN_LANE: 0, USER_LANE: 0}
+
+    @property
+    def running(self) -> int:
+        return self._running_total
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    def _can_run(self, user_id: str, lane: str) -> bool:
+        if self._running_total >= self.max_concurrent:
+            return False
+        if lane == USER_LANE and self._running_by_lane[USER_LANE] >= self.max_concurrent - self.admin_reserved_slots:
+            return False
+        return self._running_by_user.get(user_id, 0) < self.per_user_limit
+
+    def _grant(self, user_id: str, lane: str):
+        self._running_total += 1
+        self._running_by_lane[lane] += 1
+        self._running_by_user[user_id] = self._running_by_user.get(user_id, 0) + 1
+        self._serve_seq += 1
+        self._served[user_id] = self._serve_seq
+
+    def _forget_if_idle(self, user_id: str):
+        if user_id not in self._running_by_user and not any(user_id in queues for queues in self._lanes.values()):
+            self._served.pop(user_id, None)
+
+    def _next_waiter(self):
+        """按通道优先级、通道内按用户轮询（最久未获得槽位的用户优先）找到下一个可以运行的等待者"""
+        for lane in self._lane_order:
+            runnable = [user_id for user_id, waiters in self._lanes[lane].items()
+                        if waiters and self._can_run(user_id, lane)]
+            if runnable:
+                user_id = min(runnable, key=lambda uid: self._served.get(uid, 0))
+                return lane, user_id, self._lanes[lane][user_id]
+        return None
+
+    def _dispatch(self):
+        """把空闲执行槽位分配给可以运行的等待者"""
+        while self._running_total < self.max_concurrent:
+            found = self._next_waiter()
+            if not found:
+                return
+            lane, user_id, waiters = found
+            future = waiters.popleft()
+            self._queued -= 1
+            self._queued_by_lane[lane] -= 1
+            if not waiters:
+                del self._lanes[lane][user_id]
+            if not self.admin_priority:
+                # 不区分优先级时两个通道轮流出队
+                self._lane_order.remove(lane)
+                self._lane_order.append(lane)
+            self._grant(user_id, lane)
+            future.set_result(None)
+
+    def _position(self, user_id: str, lane: str) -> int:
+        """估算某用户最新入队任务的排队位置（按轮询顺序）"""
+        own_index = len(self._lanes[lane][user_id])
+        ahead = sum(min(len(waiters), own_index) for uid, waiters in self._lanes[lane].items() if uid != user_id)
+        other_lane = USER_LANE if lane == ADMIN_LANE else ADMIN_LANE
+        other_queued = sum(len(waiters) for waiters in self._lanes[other_lane].values())
+        if self.admin_priority:
+            # 优先级模式下普通用户排在全部管理员任务之后，管理员不受普通用户影响
+            ahead += other_queued if lane == USER_LANE else 0
+        else:
+            ahead += min(other_queued, ahead + own_index)
+        return ahead + own_index
+
+    async def acquire(self, user_id: str, is_admin: bool = False,
+                      on_queued: Optional[Callable[[int], Awaitable[None]]] = None) -> float:
+        """获取执行槽位，需要排队时先调用 on_queued(排队位置)
+
+        :return: 排队等待的秒数
+        :raises QueueFullError: 等待队列已满
+        """
+        lane = ADMIN_LANE if is_admin else USER_LANE
+        if not self._queued and self._can_run(user_id, lane):
+            self._grant(user_id, lane)
+            return 0.0
+
+        start = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        self._lanes[lane].setdefault(user_id, deque()).append(future)
+        self._queued += 1
+        self._queued_by_lane[lane] += 1
+        # 先尝试分配空闲槽位（例如空闲的管理员保留槽位），确实需要排队时才检查队列上限
+        self._dispatch()
+        if future.done():
+            return 0.0
+        if self._queued_by_lane[lane] > self.max_queue:
+            self._remove_waiter(user_id, lane, future)
+            raise QueueFullError(f"执行队列已满（{self._queued_by_lane[lane]}/{self.max_queue}）")
+
+        position = self._position(user_id, lane)
+        logger.info(f"用户 {user_id} 的执行任务进入{lane}通道队列，位置 {position}")
+        try:
+            if on_queued:
+                await on_queued(position)
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已分配到槽位但调用方被取消，归还槽位
+                self.release(user_id, is_admin)
+            else:
+                self._remove_waiter(user_id, lane, future)
+            raise
+        return time.monotonic() - start
+
+    def _remove_waiter(self, user_id: str, lane: str, future: asyncio.Future):
+        queues = self._lanes[lane]
+        waiters = queues.get(user_id)
+        if waiters and future in waiters:
+            waiters.remove(future)
+            self._queued -= 1
+            self._queued_by_lane[lane] -= 1
+            if not waiters:
+                del queues[user_id]
+        self._forget_if_idle(user_id)
+
+    def release(self, user_id: str, is_admin: bool = False):
+        """归还执行槽位并唤醒下一个等待者"""
+        self._running_total -= 1
+        self._running_by_lane[ADMIN_LANE if is_admin else USER_LANE] -= 1
+        remaining = self._running_by_user.get(user_id, 1) - 1
+        if remaining > 0:
+            self._running_by_user[user_id] = remaining
+        else:
+            self._running_by_user.pop(user_id, None)
+        self._dispatch()
+        self._forget_if_idle(user_id)
+
+    @asynccontextmanager
+    async def slot(self, user_id: str, is_admin: bool = False,
+                   on_queued: Optional[Callable[[int], Awaitable[None]]] = None):
+        """占用一个执行槽位的上下文管理器，返回排队等待的秒数"""
+        queue_wait = await self.acquire(user_id, is_admin, on_queued)
+        try:
+            yield queue_wait
+        finally:
+            self.release(user_id, is_admin)
@@ -0,0 +1,239 @@
+"""子解释器执行后端
+
+在支持每解释器独立 GIL（PEP 684）的 Python 上，轻量代码片段在插件进程内的隔离子解释器中执行：
+多个执行可以真正并行使用多个 CPU 核心，内存开销又远小于进程池。
+
+子解释器中只能加载支持多解释器的扩展模块，numpy、pandas 等第三方库目前都不支持，
+因此每次执行前根据代码的导入和引用的注入变量判断是否适用，不适用时交给进程池执行；
+执行中遇到不支持子解释器的模块时同样自动回退。
+子解释器中使用原始的 __import__，没有运行时导入拦截（import_guard.py），
+设置了受限库时插件不会把非管理员代码交给本后端。
+"""
+import asyncio
+import json
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Set
+
+from astrbot.api import logger
+
+from .executor import LIBS_TO_INJECT, _make_run_dir
+from .preflight import PreflightResult
+
+try:
+    # Python 3.13+ 提供隔离配置（独立 GIL）的子解释器接口。
+    # 3.12 的 _xxsubinterpreters 在销毁加载过 OpenSSL 的子解释器时会破坏主进程堆内存，不予支持
+    import _interpreters
+except ImportError:
+    _interpreters = None
+
+# 已验证可在隔离子解释器中导入的标准库
+SUBINTERPRETER_SAFE_MODULES = {
+    'json', 're', 'math', 'random', 'statistics', 'datetime', 'time', 'calendar',
+    'itertools', 'collections', 'functools', 'operator', 'copy', 'uuid', 'decimal', 'fractions',
+    'string', 'textwrap', 'difflib', 'hashlib', 'hmac', 'secrets', 'base64', 'csv', 'pickle',
+    'os', 'sys', 'shutil', 'zipfile', 'tarfile', 'pathlib', 'io', 'struct', 'heapq', 'bisect',
+    'enum', 'dataclasses', 'typing', 'array', 'urllib',
+}
+
+# 子解释器中预先导入的注入库：模块名 -> 变量名（与进程池的命名空间一样额外提供 io）
+SAFE_INJECTED_LIBS = dict(
+    {name: alias for name, alias in LIBS_TO_INJECT.items() if name in SUBINTERPRETER_SAFE_MODULES}, io='io'
+)
+
+# 其余注入库的变量名：代码引用到它们就说明需要进程池中的完整环境
+_UNSAFE_ALIASES = (
+    {alias for name, alias in LIBS_TO_INJECT.items() if name not in SUBINTERPRETER_SAFE_MODULES}
+    | {'plt', 'matplotlib', 'BeautifulSoup', 'Image', 'dateutil', 'dateutil_parser', 'persist', 'fetch_cached',
+       '__import__', 'importlib'}
+)
+
+# 子解释器内执行的引导脚本：重定向输出、构建命名空间、执行代码并把结果写入文件。
+# 子解释器运行在插件进程内，输出与进程池一样写入有字节上限的开头/结尾缓冲区（同 executor.CappedOutputBuffer），
+# 无限打印也不会耗尽插件进程的内存
+_BOOTSTRAP = '''
+import collections as _collections, json as _json, sys as _sys, traceback as _traceback
+
+class _CappedOutput:
+    def __init__(self, budget):
+        self.head_limit = budget // 2
+        self.tail_limit = budget - self.head_limit
+        self.head = bytearray()
+        self.tail = _collections.deque()
+        self.tail_bytes = 0
+        self.total_bytes = 0
+
+    def write(self, s):
+        data = str(s).encode("utf-8", errors="ignore")
+        self.total_bytes += len(data)
+        room = self.head_limit - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if data:
+            self.tail.append(data)
+            self.tail_bytes += len(data)
+            while self.tail_bytes > self.tail_limit:
+                excess = self.tail_bytes - self.tail_limit
+                if len(self.tail[0]) <= excess:
+                    self.tail_bytes -= len(self.tail.popleft())
+                else:
+                    self.tail[0] = self.tail[0][excess:]
+                    self.tail_bytes -= excess
+        return len(s)
+
+    def flush(self):
+        pass
+
+    def dropped(self):
+        return self.total_bytes - len(self.head) - self.tail_bytes
+
+    def getvalue(self):
+        head = self.head.decode("utf-8", errors="ignore")
+        tail = b"".join(self.tail).decode("utf-8", errors="ignore")
+        if self.dropped():
+            return f"{{head}}\\n...(输出过长，已省略 {{self.dropped()}} 字节)...\\n{{tail}}"
+        return head + tail
+
+_out = _CappedOutput({capture_bytes!r})
+_sys.stdout = _sys.stderr = _out
+_ns = {{"__name__": "__main__", "SAVE_DIR": {save_dir!r}, "FILES_TO_SEND": [], "img_url": {img_urls!r},
+       "img_files": {img_files!r}}}
+for _name, _alias in {libs!r}:
+    _ns[_alias] = __import__(_name)
+_result = {{"success": True, "error": None}}
+try:
+    exec(compile({code!r}, "<string>", "exec"), _ns)
+except BaseException as _e:
+    _result = {{"success": False, "error": _traceback.format_exc(),
+               "unsupported_module": isinstance(_e, ImportError) and "subinterpreter" in str(_e)}}
+_result["output"] = _out.getvalue()
+_result["dropped"] = _out.dropped()
+_result["files"] = [p for p in _ns["FILES_TO_SEND"] if isinstance(p, str)]
+with open({result_path!r}, "w", encoding="utf-8") as _f:
+    _json.dump(_result, _f, ensure_ascii=False)
+'''
+
+
+def is_available() -> bool:
+    return _interpreters is not None
+
+
+def can_run(pre: PreflightResult, unavailable_names: Set[str] = frozenset()) -> bool:
+    """根据预检结果判断代码能否在子解释器中执行
+
+    :param unavailable_names: 子解释器中无法提供的其他名称（如需要从检查点恢复的持久化变量）
+    """
+    if not pre.ok or pre.has_relative_import or not pre.imports <= SUBINTERPRETER_SAFE_MODULES:
+        return False
+    return not (pre.names & _UNSAFE_ALIASES or pre.names & unavailable_names)
+
+
+def _remove_if_empty(path: str):
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
+
+
+class SubinterpreterBackend:
+    """每次执行创建一个隔离子解释器，执行结束后销毁
+
+    子解释器中的代码无法从外部中止，超时后线程仍会运行到代码结束。执行放在专用的有界线程池中，
+    不占用 asyncio 默认线程池（进程池等待工作进程结果也使用它）；线程全部被占用时 available 为 False，
+    调用方应改用进程池执行。
+    """
+
+    def __init__(self, file_output_dir: str, capture_bytes: int, max_threads: int = 2):
+        self.file_output_dir = file_output_dir
+        self.capture_bytes = capture_bytes
+        self.max_threads = max(1, max_threads)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_threads, thread_name_prefix="subinterpreter")
+        # 占用中的线程数，包括超时后仍在运行的执行
+        self._busy = 0
+        self._busy_lock = threading.Lock()
+
+    @property
+    def available(self) -> bool:
+        return self._busy < self.max_threads
+
+    async def execute(self, code: str, pre: PreflightResult, image_urls: List[str] = None,
+                      image_files: List[Optional[str]] = None, timeout: float = None) -> Optional[Dict[str, Any]]:
+        """在专用线程中执行 run()，超时抛出 asyncio.TimeoutError（线程占用到代码结束才释放）"""
+        with self._busy_lock:
+            self._busy += 1
+        try:
+            future = asyncio.get_running_loop().run_in_executor(
+                self._executor, self._run_tracked, code, pre, image_urls, image_files
+            )
+        except BaseException:
+            with self._busy_lock:
+                self._busy -= 1
+            raise
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"子解释器执行超时，代码无法中止，线程将在代码结束后释放"
+                           f"（占用 {self._busy}/{self.max_threads}）")
+            raise
+
+    def _run_tracked(self, *args) -> Optional[Dict[str, Any]]:
+        try:
+            return self.run(*args)
+        finally:
+            with self._busy_lock:
+                self._busy -= 1
+
+    def shutdown(self):
+        """不再接受新的执行；仍在运行的子解释器无法中止，不等待其结束"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def run(self, code: str, pre: PreflightResult, image_urls: List[str] = None,
+            image_files: List[Optional[str]] = None) -> Optional[Dict[str, Any]]:
+        """在子解释器中执行（阻塞，调用方应放到线程中）
+
+        :return: 结果字典；遇到不支持子解释器的模块时返回 None，由调用方回退到进程池
+        """
+        fd, result_path = tempfile.mkstemp(suffix=".json", prefix="subinterp_")
+        os.close(fd)
+        # 与进程池一样每次执行使用自己的输出子目录，只收集其中新增的文件
+        run_dir = _make_run_dir(self.file_output_dir)
+        # 每个子解释器都要重新导入模块，只导入代码实际引用到的注入库
+        libs = sorted((name, alias) for name, alias in SAFE_INJECTED_LIBS.items() if alias in pre.names)
+        script = _BOOTSTRAP.format(
+            save_dir=run_dir, img_urls=list(image_urls or []), img_files=list(image_files or []),
+            libs=libs, code=code, result_path=result_path, capture_bytes=self.capture_bytes,
+        )
+        interp = _interpreters.create(_interpreters.new_config('isolated'))
+        try:
+            failure = _interpreters.exec(interp, script)
+            if failure is not None:
+                # 引导脚本本身失败（用户代码的异常已在脚本内捕获）
+                logger.warning(f"子解释器执行失败，回退到进程池: {getattr(failure, 'formatted', failure)}")
+                _remove_if_empty(run_dir)
+                return None
+            with open(result_path, encoding="utf-8") as f:
+                result = json.load(f)
+        finally:
+            _interpreters.destroy(interp)
+            try:
+                os.remove(result_path)
+            except OSError:
+                pass
+
+        if result.pop("unsupported_module", False):
+            logger.info("代码用到了不支持子解释器的模块，回退到进程池执行")
+            _remove_if_empty(run_dir)
+            return None
+        file_paths = [p for p in result["files"] if os.path.isfile(p)]
+        file_paths += [os.path.join(run_dir, f) for f in sorted(os.listdir(run_dir))
+                       if os.path.join(run_dir, f) not in file_paths]
+        _remove_if_empty(run_dir)
+        return {
+            "success": result["success"], "output": result["output"], "error": result["error"],
+            "file_paths": file_paths if result["success"] else [],
+            "libraries_used": sorted(set(SAFE_INJECTED_LIBS) & (pre.imports | pre.names)),
+            "output_dropped_bytes": result["dropped"], "output_spill_path": None, "backend": "subinterpreter",
+        }
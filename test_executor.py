@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+代码执行器执行层测试脚本
+用于验证 executor.py 在并发执行时的隔离性
+
+运行方式（在插件所在目录的上一级执行）:
+    python -m <插件目录名>.test_executor
+"""
+
+import os
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .executor import run_code, init_worker
+from .image_cache import ImageCache
+from .policy import KeywordAutomaton, PolicyEngine
+from .preflight import preflight
+
+
+def test_concurrent_output_capture(workers: int = 50, lines: int = 200):
+    """测试并发执行时每次执行只捕获自己的输出"""
+    print(f"🔍 测试 {workers} 个并发执行的输出隔离...")
+    output_dir = tempfile.mkdtemp()
+
+    def printer(worker_id: int):
+        # time.sleep(0) 主动让出 GIL，让各执行的 print 充分交错
+        code = (
+            f"for i in range({lines}):\n"
+            f"    print('worker-{worker_id}', i)\n"
+            f"    time.sleep(0)\n"
+        )
+        return worker_id, run_code(code, output_dir)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(printer, range(workers)))
+
+    for worker_id, result in results:
+        assert result["success"], result["error"]
+        expected = "".join(f"worker-{worker_id} {i}\n" for i in range(lines))
+        assert result["output"] == expected, f"执行 {worker_id} 的输出混入了其他执行的内容"
+    print(f"✅ {workers} 个并发执行各自只捕获到自己的 {lines} 行输出")
+
+
+def test_system_exit():
+    """测试用户代码调用 sys.exit()/exit() 时正常返回已有输出"""
+    print("🔍 测试用户代码提前退出...")
+    output_dir = tempfile.mkdtemp()
+    result = run_code("print('before')\nsys.exit()\nprint('after')", output_dir)
+    assert result["success"] and result["output"] == "before\n", result
+    result = run_code("print('before')\nexit(2)", output_dir)
+    assert not result["success"] and result["output"] == "before\n" and "sys.exit(2)" in result["error"], result
+    print("✅ sys.exit()/exit() 只结束用户代码，输出保留")
+
+
+def test_output_stream_attributes():
+    """测试输出路由代理转发 encoding/errors/fileno/isatty"""
+    print("🔍 测试输出路由代理的流属性...")
+    from .executor import install_output_router
+    install_output_router()
+    # 与路由代理包装的原始流比较（pytest 捕获输出时它不是 sys.__stdout__）
+    fallback = sys.stdout._fallback
+
+    def outcome(method):
+        try:
+            return method()
+        except Exception as e:
+            return type(e)
+
+    assert sys.stdout.encoding == fallback.encoding and sys.stdout.errors == fallback.errors
+    assert outcome(sys.stdout.fileno) == outcome(fallback.fileno) and sys.stdout.isatty() == fallback.isatty()
+    code = (
+        "print(sys.stdout.encoding == sys.stdout._fallback.encoding, sys.stdout.errors is not None,"
+        " sys.stdout.isatty())\n"
+        "try:\n"
+        "    sys.stdout.fileno()\n"
+        "except io.UnsupportedOperation:\n"
+        "    print('no fileno')\n"
+    )
+    result = run_code(code, tempfile.mkdtemp())
+    assert result["success"], result["error"]
+    assert result["output"] == "True True False\nno fileno\n", result["output"]
+    print("✅ 执行外沿用原始流，执行中的输出流没有文件描述符且不是终端")
+
+
+def test_concurrent_figure_capture(workers: int = 8, figures: int = 3):
+    """测试并发绘图时每次执行只收集自己的图表"""
+    print(f"🔍 测试 {workers} 个并发执行的图表隔离...")
+    output_dir = tempfile.mkdtemp()
+
+    def plotter(worker_id: int):
+        # 每张图的标题带上执行编号，画完后让出 GIL 再保存，让各执行的绘图充分交错
+        code = (
+            f"for i in range({figures}):\n"
+            f"    plt.plot([0, {worker_id}])\n"
+            f"    plt.title('worker-{worker_id}')\n"
+            f"    time.sleep(0.01)\n"
+            f"    plt.show() if i % 2 else plt.savefig(f'{{SAVE_DIR}}/fig_{worker_id}_{{i}}.png')\n"
+        )
+        return worker_id, run_code(code, output_dir)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(plotter, range(workers)))
+
+    import matplotlib.pyplot as plt
+    all_files = set()
+    for worker_id, result in results:
+        assert result["success"], result["error"]
+        assert len(result["file_paths"]) == figures, f"执行 {worker_id} 收集到 {len(result['file_paths'])} 张图表"
+        all_files.update(result["file_paths"])
+    assert len(all_files) == workers * figures, "不同执行收集到了同一张图表"
+    assert not plt.get_fignums(), "执行结束后仍有未关闭的图表"
+    print(f"✅ {workers} 个并发执行各自只收集到自己的 {figures} 张图表")
+
+
+def test_savefig_path():
+    """测试 fig.savefig(path) 写入指定路径，代码之后可以直接读取该文件"""
+    print("🔍 测试 savefig 保存路径...")
+    output_dir = tempfile.mkdtemp()
+    code = (
+        "fig, ax = plt.subplots()\n"
+        "ax.plot([1, 2, 3])\n"
+        "p = f'{SAVE_DIR}/chart'\n"
+        "fig.savefig(p + '.png')\n"
+        "fig2 = plt.figure()\n"
+        "plt.plot([3, 2])\n"
+        "plt.savefig(p)\n"
+        "from PIL import Image\n"
+        "print(Image.open(p + '.png').size[0] > 0, os.path.exists(p + '.png'))\n"
+    )
+    result = run_code(code, output_dir)
+    assert result["success"], result["error"]
+    assert "True True" in result["output"], result["output"]
+    assert [os.path.basename(p) for p in result["file_paths"]] == ["chart.png"], result["file_paths"]
+    print("✅ 图表写入 savefig 指定的路径并登记为待发送文件")
+
+
+def test_in_memory_figures():
+    """测试图表内存模式：图表以 PNG 字节返回，不写入输出目录"""
+    print("🔍 测试图表内存模式...")
+    output_dir = tempfile.mkdtemp()
+    bar_path = os.path.join(tempfile.mkdtemp(), "bar.png")
+    init_worker({"in_memory_figures": True})
+    try:
+        result = run_code(f"plt.plot([1, 2])\nplt.show()\nplt.bar([1], [2])\nplt.savefig({bar_path!r})", output_dir)
+    finally:
+        init_worker({})
+    assert result["success"], result["error"]
+    assert not result["file_paths"] and not os.listdir(output_dir), "内存模式下图表不应写入输出目录"
+    assert [f["data"][:4] for f in result["figures"]] == [b"\x89PNG"] * 2, "内存模式下应返回两张 PNG 图表"
+    assert open(bar_path, "rb").read() == result["figures"][1]["data"], "savefig 应写入指定路径"
+    print("✅ 图表以字节形式返回，输出目录保持为空，savefig 的文件写入指定路径")
+
+
+def test_figure_size_budget():
+    """测试图表大小预算：超出时降低质量和分辨率直到满足预算，并记录编码统计"""
+    print("🔍 测试图表大小预算...")
+    output_dir = tempfile.mkdtemp()
+    code = "plt.scatter(np.random.rand(5000), np.random.rand(5000), s=2)\nplt.show()"
+    for fmt in ("png", "webp"):
+        init_worker({"figure_format": fmt, "figure_dpi": 150, "figure_max_bytes": 30000})
+        try:
+            result = run_code(code, output_dir)
+        finally:
+            init_worker({})
+        assert result["success"], result["error"]
+        stats = result["figure_stats"][0]
+        assert stats["format"] == fmt and stats["within_budget"] and stats["attempts"] > 1, stats
+        assert os.path.getsize(result["file_paths"][0]) == stats["bytes"] <= 30000
+    print("✅ 图表已自动降级到预算以内，编码统计已记录")
+
+
+def test_plot_downsampling():
+    """测试大数据量折线降采样：点数降到阈值以内，原始与绘制点数写入输出"""
+    print("🔍 测试图表降采样...")
+    output_dir = tempfile.mkdtemp()
+    code = "y = np.random.rand(1_000_000)\nplt.plot(y)\nplt.show()"
+    init_worker({"plot_downsample_threshold": 2000})
+    try:
+        result = run_code(code, output_dir)
+    finally:
+        init_worker({})
+    assert result["success"], result["error"]
+    stats = result["figure_stats"][0]
+    assert stats["points_original"] == 1_000_000 and stats["points_rendered"] <= 2002, stats
+    assert "1,000,000 个点" in result["output"], "输出中缺少降采样点数报告"
+    print(f"✅ 1,000,000 个点降采样为 {stats['points_rendered']} 个点")
+
+
+def test_preflight():
+    """测试预检：语法错误直接返回，导入与名称提取正确，结果按哈希缓存"""
+    print("🔍 测试代码预检...")
+    bad = preflight("x = (1,\nprint(x)")
+    assert not bad.ok and "SyntaxError" in bad.syntax_error, "语法错误未被预检发现"
+
+    code = "import requests\ndf.plot()\nprint(img_url)"
+    pre = preflight(code)
+    assert pre.ok and pre.imports == {"requests"}
+    assert pre.uses_plotting and pre.uses_images
+    assert preflight(code) is pre, "相同代码未命中预检缓存"
+    assert not preflight("print(1 + 1)").uses_plotting
+
+    output_dir = tempfile.mkdtemp()
+    result = run_code("IGNORED", output_dir, compiled=preflight("print(1 + 1)").compiled, needs_plotting=False)
+    assert result["success"] and result["output"] == "2\n", "预编译代码对象执行结果不正确"
+    print("✅ 预检结果正确，预编译代码可直接执行")
+
+
+def test_policy_engine():
+    """测试安全策略：自动机与逐个子串查找结果一致，库检查基于 AST 而非源码文本"""
+    print("🔍 测试安全策略检查...")
+    keywords = ["os.system", "popen", "eval(", "exec(", "system"]
+    text = "x = eval(input())\nos.popen('ls')\nos.system('rm')"
+    assert KeywordAutomaton(keywords).find_all(text) == {k for k in keywords if k in text}
+
+    engine = PolicyEngine(keywords, ["subprocess", "socket"])
+    for code, expected in (
+        ("import subprocess.run", ["subprocess"]),
+        ("from socket import create_connection", ["socket"]),
+        ("m = __import__('subprocess')", ["subprocess"]),
+        ("m = importlib.import_module('socket')", ["socket"]),
+        ("# import subprocess\nprint('socket')", []),
+        ("socket.socket()", ["socket"]),
+        ("self.socket = None\nprint(obj.socket, obj.subprocess.run)", []),
+        ("OS.SYSTEM('ls')", ["os.system", "system"]),
+    ):
+        assert engine.check(code, preflight(code)) == expected, (code, engine.check(code, preflight(code)))
+    code = "import socket"
+    assert engine.check(code, preflight(code)) is engine.check(code, preflight(code)), "相同代码未命中检查结果缓存"
+    print("✅ 关键词与库检查结果正确，相同代码复用检查结果")
+
+
+def test_import_guard():
+    """测试运行时导入拦截：非管理员执行拦截拼接模块名与间接导入，并记录被拦截的模块"""
+    print("🔍 测试运行时导入拦截...")
+    output_dir = tempfile.mkdtemp()
+    restricted = ["subprocess", "xmlrpc"]
+    for code, blocked in (
+        ("m = __import__('sub' + 'process')", ["subprocess"]),
+        ("import importlib\nimportlib.import_module('xmlrpc.' + 'client')", ["xmlrpc"]),
+    ):
+        result = run_code(code, output_dir, is_admin_flag=False, restricted_libraries=restricted)
+        assert not result["success"] and "ImportError" in result["error"], result
+        assert result["blocked_imports"] == blocked, result["blocked_imports"]
+        admin_result = run_code(code, output_dir, is_admin_flag=True, restricted_libraries=restricted)
+        assert admin_result["success"] and not admin_result["blocked_imports"], "管理员执行不应被拦截"
+
+    result = run_code("import json, os.path\nprint(json.dumps(1))", output_dir, is_admin_flag=False,
+                      restricted_libraries=restricted)
+    assert result["success"] and not result["blocked_imports"], "合法导入被拦截"
+    print("✅ 受限库在导入时被拦截并记录，管理员与合法导入不受影响")
+
+
+def test_image_cache():
+    """测试图片缓存：同一 URL 与相同内容只下载、保存一次，超出配额时淘汰最久未使用的图片"""
+    print("🔍 测试图片缓存...")
+    images = {f"/{name}.png": b"\x89PNG\r\n\x1a\n" + name.encode() * 1200 for name in "abc"}
+    images["/copy.png"] = images["/a.png"]
+    requested = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requested.append(self.path)
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.end_headers()
+            self.wfile.write(images[self.path])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    cache_dir = tempfile.mkdtemp()
+    init_worker({"image_cache_dir": cache_dir, "image_cache_max_bytes": 3000})
+    try:
+        code = (f"paths = [fetch_cached('{base}' + p) for p in ('/a.png', '/a.png', '/copy.png')]\n"
+                "print(len(set(paths)), open(paths[0], 'rb').read(4))")
+        result = run_code(code, tempfile.mkdtemp())
+        assert result["success"], result["error"]
+        assert result["output"] == "1 b'\\x89PNG'\n", result["output"]
+        assert requested == ["/a.png", "/copy.png"], f"同一 URL 被重复下载: {requested}"
+        cache = ImageCache(cache_dir, 3000)
+        assert cache.stats() == {"hits": 1, "misses": 2, "entries": 1, "bytes": 1208}, cache.stats()
+
+        # 第三张图片使总大小超出配额，淘汰最久未使用的 a.png
+        cache.fetch(base + "/b.png")
+        cache.lookup(base + "/b.png")
+        cache.fetch(base + "/c.png")
+        assert cache.lookup(base + "/a.png") is None and cache.lookup(base + "/b.png"), "未按最近最少使用淘汰"
+        blobs = [f for f in os.listdir(cache_dir) if not f.startswith("index.db")]
+        assert cache.stats()["entries"] == len(blobs) == 2, f"淘汰的图片文件未删除: {blobs}"
+    finally:
+        init_worker({})
+        server.shutdown()
+    print("✅ 重复图片命中缓存，超出配额时按最近最少使用淘汰")
+
+
+def main():
+    """主测试函数"""
+    print("🚀 开始测试代码执行层...\n")
+    try:
+        test_concurrent_output_capture()
+        test_output_stream_attributes()
+        test_system_exit()
+        test_concurrent_figure_capture()
+        test_savefig_path()
+        test_in_memory_figures()
+        test_figure_size_budget()
+        test_plot_downsampling()
+        test_preflight()
+        test_policy_engine()
+        test_import_guard()
+        test_image_cache()
+        print("\n🎉 所有测试通过！")
+    except Exception as e:
+        print(f"\n❌ 测试失败: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,12 @@ import asyncio
 import os
 import sys
 import tempfile
+import time
 from .database import ExecutionHistoryDB
+from .image_cache import ImageCache
+from .image_prefetch import ImagePrefetcher
+from .scheduler import ExecutionScheduler, QueueFullError
+from .worker_pool import WorkerPool, SessionPool
 from .webui import CodeExecutorWebUI
 
 
@@ -41,6 +46,22 @@ async def test_database():
         )
         print(f"✅ 添加执行记录成功，ID: {record_id}")
         
+        # 添加超时被终止的记录
+        killed_id = await db.add_execution_record(
+            sender_id="test_user_123",
+            sender_name="测试用户",
+            code="while True: pass",
+            description="测试超时终止",
+            success=False,
+            error_msg="代码执行超时",
+            execution_time=10.0,
+            status="killed",
+            reclaim_time=0.02
+        )
+        killed_detail = await db.get_execution_detail(killed_id)
+        assert killed_detail['status'] == 'killed'
+        print(f"✅ 添加超时终止记录成功，ID: {killed_id}")
+        
         # 查询记录
         history = await db.get_execution_history(page=1, page_size=10)
         print(f"✅ 查询历史记录成功，共 {history['total_count']} 条记录")
@@ -52,6 +73,7 @@ async def test_database():
         
         # 获取统计信息
         stats = await db.get_statistics()
+        assert stats['killed_executions'] == 1
         print(f"✅ 获取统计信息成功: 总执行 {stats['total_executions']} 次")
         
         print("🎉 数据库功能测试通过！")
@@ -102,6 +124,364 @@ async def test_webui_init():
             os.unlink(db_path)
 
 
+async def test_image_prefetch():
+    """测试图片预取：并发下载、大小上限与超时"""
+    print("🔍 测试图片预取...")
+    from aiohttp import web
+
+    png = b"\x89PNG\r\n\x1a\n" + b"0" * 1024
+    requested = []
+
+    async def image(request):
+        requested.append(request.path)
+        return web.Response(body=png, content_type="image/png")
+
+    async def large(request):
+        return web.Response(body=b"0" * 4096, content_type="image/jpeg")
+
+    async def slow(request):
+        await asyncio.sleep(3)
+        return web.Response(body=png, content_type="image/png")
+
+    app = web.Application()
+    app.add_routes([web.get("/a.png", image), web.get("/large.jpg", large), web.get("/slow.png", slow)])
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    prefetcher = ImagePrefetcher(tempfile.mkdtemp(), max_bytes=2048, timeout=1)
+    try:
+        urls = [f"http://127.0.0.1:{port}/{name}" for name in ("a.png", "large.jpg", "slow.png")] + ["base64://..."]
+        paths = await prefetcher.fetch_all(urls)
+        assert paths[0].endswith(".png") and open(paths[0], "rb").read() == png
+        assert paths[1:] == [None, None, None], "超出大小上限、超时或不支持的地址应返回 None"
+        print("✅ 图片已预取到本地，超出上限与超时的图片被跳过")
+
+        task = asyncio.ensure_future(prefetcher.fetch_all(urls[:1]))
+        await task
+        prefetcher.discard(task)
+        assert not os.path.exists(task.result()[0]), "执行结束后预取的图片未被删除"
+        print("✅ 执行结束后预取的图片已删除")
+
+        cached = ImagePrefetcher(tempfile.mkdtemp(), 2048, 1, cache=ImageCache(tempfile.mkdtemp(), 1 << 20))
+        try:
+            requested.clear()
+            first = await cached.fetch_all(urls[:1] * 2)
+            second = await cached.fetch_all(urls[:1])
+            assert first[0] == second[0] and os.path.exists(second[0]), "预取未使用图片缓存"
+            assert requested == ["/a.png"] and cached.cache.stats()["hits"] == 1, requested
+        finally:
+            await cached.close()
+        print("✅ 启用缓存后重复图片直接使用缓存文件")
+    finally:
+        await prefetcher.close()
+        await runner.cleanup()
+
+
+async def test_scheduler():
+    """测试执行调度器：并发上限、用户轮询、取消排队与队列已满"""
+    print("🔍 测试执行调度器...")
+    order = []
+
+    async def run(scheduler, user_id, name, is_admin=False):
+        await scheduler.acquire(user_id, is_admin)
+        order.append(name)
+
+    # 并发上限：同一用户超出 per_user_limit 时排队，其他用户仍可使用空闲槽位
+    scheduler = ExecutionScheduler(max_concurrent=2, per_user_limit=1, max_queue=10)
+    await scheduler.acquire("A")
+    a1 = asyncio.create_task(run(scheduler, "A", "A1"))
+    await asyncio.sleep(0)
+    assert scheduler.running == 1 and scheduler.queued == 1
+    await scheduler.acquire("B")
+    assert scheduler.running == 2 and scheduler.queued == 1
+    scheduler.release("A")
+    await a1
+    assert order == ["A1"] and scheduler.running == 2 and scheduler.queued == 0
+    print("✅ 全局与单用户并发上限生效")
+
+    # 轮询：刚执行过的用户排到最后，A0 执行时先入队的 A1 不会抢在 B0 前面
+    order.clear()
+    scheduler = ExecutionScheduler(max_concurrent=1, per_user_limit=1, max_queue=10)
+    await scheduler.acquire("A")
+    tasks = [asyncio.create_task(run(scheduler, user_id, name))
+             for user_id, name in (("A", "A1"), ("A", "A2"), ("B", "B0"), ("C", "C0"))]
+    await asyncio.sleep(0)
+    for user_id in ("A", "B", "C", "A"):
+        scheduler.release(user_id)
+        await asyncio.sleep(0)
+    scheduler.release("A")
+    await asyncio.gather(*tasks)
+    assert order == ["B0", "C0", "A1", "A2"], order
+    print("✅ 用户之间轮询出队，刚执行过的用户排在最后")
+
+    # 取消排队：被取消的等待者移出队列，之后的槽位分配给下一个等待者
+    order.clear()
+    scheduler = ExecutionScheduler(max_concurrent=1, per_user_limit=1, max_queue=10)
+    await scheduler.acquire("A")
+    cancelled = asyncio.create_task(run(scheduler, "B", "B0"))
+    waiting = asyncio.create_task(run(scheduler, "C", "C0"))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    await asyncio.gather(cancelled, return_exceptions=True)
+    assert scheduler.queued == 1
+    scheduler.release("A")
+    await waiting
+    assert order == ["C0"] and scheduler.running == 1
+    print("✅ 取消的排队任务不占用槽位")
+
+    # 队列已满：超出 max_queue 时立即拒绝
+    scheduler = ExecutionScheduler(max_concurrent=1, per_user_limit=1, max_queue=1)
+    await scheduler.acquire("A")
+    queued = asyncio.create_task(scheduler.acquire("B"))
+    await asyncio.sleep(0)
+    try:
+        await scheduler.acquire("C")
+        raise AssertionError("队列已满时应拒绝新任务")
+    except QueueFullError:
+        pass
+    scheduler.release("A")
+    await queued
+    print("✅ 队列已满时拒绝新任务")
+
+    # 管理员通道：普通用户排满队列时，管理员仍可直接使用空闲的保留槽位，并有独立的等待队列
+    scheduler = ExecutionScheduler(max_concurrent=2, per_user_limit=1, max_queue=1, admin_reserved_slots=1)
+    await scheduler.acquire("A")
+    queued = asyncio.create_task(scheduler.acquire("B"))
+    await asyncio.sleep(0)
+    assert await asyncio.wait_for(scheduler.acquire("admin", is_admin=True), 1) == 0.0
+    admin_queued = asyncio.create_task(scheduler.acquire("admin2", is_admin=True))
+    await asyncio.sleep(0)
+    assert scheduler.running == 2 and scheduler.queued == 2
+    try:
+        await scheduler.acquire("C")
+        raise AssertionError("普通用户队列已满时应拒绝新任务")
+    except QueueFullError:
+        pass
+    scheduler.release("admin", is_admin=True)
+    await admin_queued
+    scheduler.release("A")
+    await queued
+    print("✅ 管理员使用保留槽位与独立队列，不受普通用户排队影响")
+
+
+async def test_worker_pool_figures():
+    """测试多个工作进程同时执行时，每次执行只收到自己生成的文件"""
+    print("🔍 测试工作进程之间的输出文件隔离...")
+    output_dir = tempfile.mkdtemp()
+    pool = WorkerPool(size=2, max_tasks_per_worker=0, options={"file_output_dir": output_dir})
+    try:
+        await pool.start()
+        # 保存后等待一段时间，让两次执行的文件检测窗口互相重叠
+        code = "plt.plot([1, {n}])\nplt.show()\nopen(f'{{SAVE_DIR}}/data_{n}.txt', 'w').write('x')\ntime.sleep(1)\n"
+        results = await asyncio.gather(*(pool.execute({"code": code.format(n=n)}, timeout=60) for n in (1, 2)))
+        for n, result in zip((1, 2), results):
+            assert result["success"], result["error"]
+            names = sorted(os.path.basename(p) for p in result["file_paths"])
+            assert len(names) == 2 and names[0] == f"data_{n}.txt" and names[1].startswith("plot_"), names
+        assert not set(results[0]["file_paths"]) & set(results[1]["file_paths"]), "不同执行收到了同一个文件"
+    finally:
+        await pool.shutdown()
+    print("✅ 并发执行各自只收到自己生成的图表与文件")
+
+
+async def _wait_pool_ready(pool: WorkerPool, timeout: float = 30):
+    """等待被丢弃的工作进程补充完成，返回当前全部工作进程的 pid"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        workers = list(pool._workers.values())
+        if len(workers) == pool.size and pool._idle.qsize() == pool.size and all(w.is_alive() for w in workers):
+            return {w.pid for w in workers}
+        await asyncio.sleep(0.1)
+    raise AssertionError("工作进程未能及时补充")
+
+
+async def test_worker_pool_recovery():
+    """测试超时终止、进程崩溃与调用取消后工作进程被替换，进程池继续可用"""
+    print("🔍 测试执行进程池的故障恢复...")
+    output_dir = tempfile.mkdtemp()
+    pool = WorkerPool(size=1, max_tasks_per_worker=0, options={"file_output_dir": output_dir})
+    try:
+        await pool.start()
+        pids = await _wait_pool_ready(pool)
+
+        # 超时：强制终止工作进程，返回 killed=True，随后补充新进程
+        result = await pool.execute({"code": "time.sleep(30)"}, timeout=1)
+        assert not result["success"] and result.get("killed"), result
+        assert result["reclaim_time"] >= 0
+        new_pids = await _wait_pool_ready(pool)
+        assert not new_pids & pids, "超时的工作进程应被替换"
+        result = await pool.execute({"code": "print(1 + 1)"}, timeout=30)
+        assert result["success"] and result["output"].strip() == "2", result
+        print("✅ 超时的执行被强制终止，进程池继续可用")
+
+        # 崩溃：代码中直接 os._exit，返回可读的失败结果并补充新进程
+        pids = new_pids
+        result = await pool.execute({"code": "import os\nos._exit(3)"}, timeout=30)
+        assert not result["success"] and not result.get("killed"), result
+        assert "退出码 3" in result["error"], result["error"]
+        new_pids = await _wait_pool_ready(pool)
+        assert not new_pids & pids, "崩溃的工作进程应被替换"
+        result = await pool.execute({"code": "print('ok')"}, timeout=30)
+        assert result["success"] and result["output"].strip() == "ok", result
+        print("✅ 工作进程崩溃后自动补充新进程")
+
+        # 取消：正在执行的调用被取消时终止并替换工作进程，排队中的调用被取消不影响工作进程
+        pids = new_pids
+        old_workers = list(pool._workers.values())
+        running = asyncio.create_task(pool.execute({"code": "time.sleep(30)"}, timeout=60))
+        waiting = asyncio.create_task(pool.execute({"code": "print('waiting')"}, timeout=60))
+        await asyncio.sleep(1)
+        assert not waiting.done()
+        waiting.cancel()
+        running.cancel()
+        for task in (running, waiting):
+            try:
+                await task
+                raise AssertionError("被取消的调用应抛出 CancelledError")
+            except asyncio.CancelledError:
+                pass
+        new_pids = await _wait_pool_ready(pool)
+        assert not new_pids & pids, "被取消的执行所在的工作进程应被替换"
+        assert not any(w.is_alive() for w in old_workers), "被取消的执行所在的工作进程应已退出"
+        result = await pool.execute({"code": "print('after cancel')"}, timeout=30)
+        assert result["success"] and result["output"].strip() == "after cancel", result
+        print("✅ 调用被取消后工作进程被替换，进程池继续可用")
+    finally:
+        await pool.shutdown()
+
+
+async def test_session_pool():
+    """测试会话模式：变量跨执行保留、空闲超时与LRU淘汰、内存超限重置"""
+    print("🔍 测试会话模式...")
+    output_dir = tempfile.mkdtemp()
+    options = {"file_output_dir": output_dir}
+
+    pool = SessionPool(max_sessions=1, idle_ttl=3600, memory_limit_mb=0, options=options)
+    try:
+        first = await pool.execute("A", {"code": "counter = 41"}, timeout=30)
+        assert first["success"] and first["session_reused"] is False, first
+        second = await pool.execute("A", {"code": "counter += 1\nprint(counter)"}, timeout=30)
+        assert second["success"] and second["output"].strip() == "42", second
+        assert second["session_reused"] is True and not second.get("session_reset")
+        print("✅ 同一会话的变量在多次执行之间保留")
+
+        # 会话数达到上限时淘汰最久未使用的会话，被淘汰的会话重新开始
+        other = await pool.execute("B", {"code": "print('counter' in globals())"}, timeout=30)
+        assert other["success"] and other["output"].strip() == "False", other
+        assert pool.active_sessions == 1 and "A" not in pool._sessions
+        again = await pool.execute("A", {"code": "print('counter' in globals())"}, timeout=30)
+        assert again["output"].strip() == "False" and again["session_reused"] is False, again
+        print("✅ 超出会话上限时按LRU淘汰")
+    finally:
+        await pool.shutdown()
+
+    pool = SessionPool(max_sessions=4, idle_ttl=1, memory_limit_mb=0, options=options)
+    try:
+        pool.start()
+        await pool.execute("A", {"code": "counter = 1"}, timeout=30)
+        deadline = time.monotonic() + 10
+        while pool.active_sessions and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+        assert pool.active_sessions == 0, "空闲超时的会话应被回收"
+        result = await pool.execute("A", {"code": "print('counter' in globals())"}, timeout=30)
+        assert result["output"].strip() == "False", result
+        print("✅ 空闲超时的会话被自动回收")
+    finally:
+        await pool.shutdown()
+
+    # 上限设为 1MB，任何执行后的常驻内存都会超出，会话随即重置
+    pool = SessionPool(max_sessions=4, idle_ttl=3600, memory_limit_mb=1, options=options)
+    try:
+        result = await pool.execute("A", {"code": "counter = 1"}, timeout=30)
+        assert result["success"] and result["process_rss_mb"] > 1, result
+        assert result.get("session_reset") and pool.active_sessions == 0, result
+        result = await pool.execute("A", {"code": "print('counter' in globals())"}, timeout=30)
+        assert result["output"].strip() == "False", result
+        print("✅ 会话内存超过上限时被重置")
+    finally:
+        await pool.shutdown()
+
+
+async def test_persist_round_trip():
+    """测试 persist 保存的对象在新的工作进程中恢复，且只在同一作用域可见"""
+    print("🔍 测试持久化检查点...")
+    options = {"file_output_dir": tempfile.mkdtemp(), "data_dir": tempfile.mkdtemp()}
+
+    pool = WorkerPool(size=1, max_tasks_per_worker=0, options=options)
+    try:
+        code = "arr = np.arange(12, dtype=np.float64).reshape(3, 4)\npersist('arr', arr)"
+        result = await pool.execute({"code": code, "state_scope": "scope_a"}, timeout=60)
+        assert result["success"] and result["persisted"] == ["arr"], result
+
+        # 名称不合法与无法序列化的对象返回可读的错误
+        result = await pool.execute({"code": "persist('not a name', 1)", "state_scope": "scope_a"}, timeout=60)
+        assert not result["success"] and "合法的变量名" in result["error"], result["error"]
+        result = await pool.execute({"code": "persist('fn', lambda: 1)", "state_scope": "scope_a"}, timeout=60)
+        assert not result["success"] and "无法序列化" in result["error"], result["error"]
+    finally:
+        await pool.shutdown()
+
+    # 新的进程池模拟插件重启：同一作用域恢复数组，其他作用域看不到
+    pool = WorkerPool(size=1, max_tasks_per_worker=0, options=options)
+    try:
+        code = "print(arr.shape, float(arr.sum()), arr.flags.writeable)"
+        result = await pool.execute({"code": code, "state_scope": "scope_a"}, timeout=60)
+        assert result["success"], result["error"]
+        assert result["restored"] == ["arr"] and result["output"].strip() == "(3, 4) 66.0 True", result
+        result = await pool.execute({"code": "print('arr' in globals())", "state_scope": "scope_b"}, timeout=60)
+        assert result["success"] and result["output"].strip() == "False" and not result["restored"], result
+        result = await pool.execute({"code": "arr", "state_scope": "scope_b"}, timeout=60)
+        assert not result["success"] and "NameError" in result["error"], result["error"]
+    finally:
+        await pool.shutdown()
+    print("✅ 持久化的数组在新进程中恢复，其他作用域不可见，错误信息可读")
+
+
+async def test_fork_server_mode():
+    """测试 fork 服务器模式下的执行、超时终止与子进程崩溃"""
+    print("🔍 测试 fork 服务器模式...")
+    if not hasattr(os, "fork"):
+        print("⚠️ 当前系统不支持 fork，跳过")
+        return
+    options = {"file_output_dir": tempfile.mkdtemp(), "fork_per_task": True}
+    pool = WorkerPool(size=1, max_tasks_per_worker=0, options=options)
+    try:
+        await pool.start()
+        pids = await _wait_pool_ready(pool)
+
+        # 每次执行在新的子进程中进行，对进程全局状态的修改不会带到下一次执行
+        code = "import os\nprint(os.getpid(), os.environ.get('FORK_TEST'))\nos.environ['FORK_TEST'] = '1'"
+        first = await pool.execute({"code": code}, timeout=30)
+        second = await pool.execute({"code": code}, timeout=30)
+        assert first["success"] and second["success"], (first, second)
+        first_pid, first_env = first["output"].split()
+        second_pid, second_env = second["output"].split()
+        assert first_pid != second_pid and int(first_pid) not in pids, (first, second)
+        assert first_env == second_env == "None", (first, second)
+        print("✅ 每次执行在独立的子进程中进行，全局状态不会残留")
+
+        # 超时只终止当前执行的子进程，zygote 继续服务
+        result = await pool.execute({"code": "time.sleep(30)"}, timeout=1)
+        assert not result["success"] and result.get("killed"), result
+        assert await _wait_pool_ready(pool) == pids, "超时只应终止子进程，不应替换 zygote"
+        result = await pool.execute({"code": "print('after timeout')"}, timeout=30)
+        assert result["success"] and result["output"].strip() == "after timeout", result
+        print("✅ 超时的子进程被强制终止，zygote 继续可用")
+
+        # 子进程崩溃：zygote 发回可读的失败结果
+        result = await pool.execute({"code": "import os\nos._exit(3)"}, timeout=30)
+        assert not result["success"] and "执行子进程异常退出（退出码 3）" in result["error"], result
+        assert await _wait_pool_ready(pool) == pids, "子进程崩溃不应影响 zygote"
+        result = await pool.execute({"code": "print('after crash')"}, timeout=30)
+        assert result["success"] and result["output"].strip() == "after crash", result
+        print("✅ 子进程崩溃后返回可读的失败原因，zygote 继续可用")
+    finally:
+        await pool.shutdown()
+
+
+
 async def main():
     """主测试函数"""
     print("🚀 开始测试代码执行器插件增强功能...\n")
@@ -111,6 +491,20 @@ async def main():
         print()
         await test_webui_init()
         print()
+        await test_image_prefetch()
+        print()
+        await test_scheduler()
+        print()
+        await test_worker_pool_figures()
+        print()
+        await test_worker_pool_recovery()
+        print()
+        await test_session_pool()
+        print()
+        await test_persist_round_trip()
+        print()
+        await test_fork_server_mode()
+        print()
         print("🎉 所有测试通过！插件增强功能正常工作。")
         print("\n📝 功能说明:")
         print("1. ✅ 数据库记录功能 - 自动记录每次代码执行的详细信息")
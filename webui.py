@@ -113,6 +113,29 @@ class CodeExecutorWebUI:
                 logger.error(f"获取执行详情失败: {e}", exc_info=True)
                 raise HTTPException(status_code=500, detail=str(e))
         
+        @self.app.get("/api/output/{record_id}")
+        async def get_full_output(record_id: int):
+            """查看超出捕获预算时保存的完整输出"""
+            try:
+                result = await self.db.get_execution_detail(record_id)
+                output_file = result.get('output_file') if result else None
+                if not output_file or not os.path.isfile(output_file):
+                    raise HTTPException(status_code=404, detail="完整输出文件不存在")
+                
+                # 安全检查：确保文件在输出目录内
+                if self.file_output_dir:
+                    real_file_path = os.path.realpath(output_file)
+                    real_output_dir = os.path.realpath(self.file_output_dir)
+                    if not real_file_path.startswith(real_output_dir):
+                        raise HTTPException(status_code=403, detail="访问被拒绝")
+                
+                return FileResponse(output_file, media_type="text/plain; charset=utf-8")
+            except HTTPException:
+                raise
+            except Exception as e:
+                logger.error(f"获取完整输出失败: {e}", exc_info=True)
+                raise HTTPException(status_code=500, detail=str(e))
+        
         @self.app.get("/api/statistics")
         async def get_statistics():
             """获取统计信息API"""
@@ -125,9 +148,9 @@ class CodeExecutorWebUI:
         
         # 文件服务路由（用于本地路由发送）
         if self.enable_file_serving and self.file_output_dir:
-            @self.app.get("/files/{file_name}")
+            @self.app.get("/files/{file_name:path}")
             async def serve_file(file_name: str):
-                """提供文件下载服务"""
+                """提供文件下载服务（file_name 为相对输出目录的路径，可以包含执行子目录）"""
                 try:
                     file_path = os.path.join(self.file_output_dir, file_name)
                     if not os.path.exists(file_path) or not os.path.isfile(file_path):
@@ -136,10 +159,10 @@ class CodeExecutorWebUI:
                     # 安全检查：确保文件在指定目录内
                     real_file_path = os.path.realpath(file_path)
                     real_output_dir = os.path.realpath(self.file_output_dir)
-                    if not real_file_path.startswith(real_output_dir):
+                    if not real_file_path.startswith(real_output_dir + os.sep):
                         raise HTTPException(status_code=403, detail="访问被拒绝")
                     
-                    return FileResponse(file_path, filename=file_name)
+                    return FileResponse(file_path, filename=os.path.basename(file_path))
                 except HTTPException:
                     raise
                 except Exception as e:
@@ -648,6 +671,7 @@ class CodeExecutorWebUI:
                     { label: '总执行次数', val: stats.total_executions },
                     { label: '成功执行', val: stats.successful_executions },
                     { label: '失败执行', val: stats.failed_executions },
+                    { label: '超时终止', val: stats.killed_executions || 0 },
                     { label: '成功率', val: stats.success_rate + '%' },
                     { label: '用户数量', val: stats.unique_users },
                     { label: '近7天', val: stats.recent_executions }
@@ -694,7 +718,13 @@ class CodeExecutorWebUI:
                         <div class="record-meta">
                             <span>📅 ${formatTime(r.created_at)}</span>
                             <span>⏱ ${r.execution_time ? r.execution_time.toFixed(2)+'s' : '-'}</span>
-                            <span style="color:${r.success?'#00b894':'#ff7675'}">${r.success?'成功':'失败'}</span>
+                            <span style="color:${r.success?'#00b894':'#ff7675'}">${r.success?'成功':(r.status==='killed'?'超时终止':(r.status==='rejected'?'排队被拒':'失败'))}</span>
+                            ${r.status==='killed' && r.reclaim_time != null ? `<span>♻ 回收 ${r.reclaim_time.toFixed(3)}s</span>` : ''}
+                            ${r.queue_wait ? `<span>⏳ 排队 ${r.queue_wait.toFixed(2)}s（${r.queue_lane==='admin'?'管理员':'普通'}通道）</span>` : ''}
+                            ${r.peak_rss_mb != null ? `<span>🧠 峰值内存 ${r.peak_rss_mb.toFixed(1)}MB</span>` : ''}
+                            ${r.figure_stats?.length ? `<span>🖼 图表 ${r.figure_stats.length} 张 · ${(r.figure_stats.reduce((s,f)=>s+f.bytes,0)/1024).toFixed(0)}KB · 编码 ${r.figure_stats.reduce((s,f)=>s+f.encode_ms,0).toFixed(0)}ms</span>` : ''}
+                            ${r.blocked_imports?.length ? `<span style="color:#ff7675">🛡 拦截导入 ${escapeHtml(r.blocked_imports.join(', '))}</span>` : ''}
+                            ${r.cpu_user_time != null ? `<span>🖥 CPU ${(r.cpu_user_time + r.cpu_sys_time).toFixed(2)}s（用户 ${r.cpu_user_time.toFixed(2)}s / 系统 ${r.cpu_sys_time.toFixed(2)}s）</span>` : ''}
                         </div>
                         ${r.description ? `<div style="margin-top:5px;color:#666;font-size:0.9em">${escapeHtml(r.description)}</div>` : ''}
                     </div>
@@ -787,6 +817,7 @@ class CodeExecutorWebUI:
                         <div class="code-block-wrapper">
                             <pre class="language-none"><code>${escapeHtml(r.output)}</code></pre>
                         </div>
+                        ${r.output_file ? `<div style="margin-top:8px"><a href="/api/output/${r.id}" target="_blank">📄 查看完整输出</a></div>` : ''}
                     </div>` : ''}
                     ${r.error_msg ? `
                     <div style="margin-bottom:25px">
@@ -795,6 +826,11 @@ class CodeExecutorWebUI:
                             <pre class="language-none" style="color: #c0392b"><code>${escapeHtml(r.error_msg)}</code></pre>
                         </div>
                     </div>` : ''}
+                    ${r.libraries_used?.length ? `
+                    <div style="margin-bottom:25px">
+                        <div class="detail-section-title">📚 使用的库</div>
+                        <div>${r.libraries_used.map(escapeHtml).join('、')}</div>
+                    </div>` : ''}
                     ${r.file_paths?.length ? `
                     <div style="margin-bottom:25px">
                         <div class="detail-section-title">📂 生成文件</div>
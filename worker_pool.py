@@ -0,0 +1,363 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Callable
+
+from astrbot.api import logger
+
+from .executor import worker_main
+
+
+class CodeWorker:
+    """单个常驻工作进程，通过管道收发任务与结果"""
+
+    def __init__(self, ctx, options: Dict[str, Any], worker_id: int):
+        self.worker_id = worker_id
+        self.tasks_done = 0
+        self.busy = False
+        # fork 服务器模式下当前执行所在的子进程
+        self.fork_per_task = bool(options.get("fork_per_task"))
+        self.child_pid: Optional[int] = None
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=worker_main,
+            args=(child_conn, options),
+            name=f"code_executor_worker_{worker_id}",
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+    @property
+    def pid(self) -> Optional[int]:
+        return self.process.pid
+
+    def is_alive(self) -> bool:
+        return self.process.is_alive()
+
+    async def wait_ready(self):
+        """等待工作进程完成库预热"""
+        message = await asyncio.to_thread(self.conn.recv)
+        if not message.get("ready"):
+            raise RuntimeError(f"工作进程 {self.worker_id} 启动失败: {message}")
+
+    async def run(self, task: Dict[str, Any], on_stream: Callable[[str], None] = None) -> Dict[str, Any]:
+        """发送任务并等待结果，期间不阻塞事件循环
+
+        :param on_stream: 可选，收到执行中途的流式输出时在事件循环中调用
+        """
+        self.busy = True
+        try:
+            self.conn.send(dict(task, stream=on_stream is not None))
+            while True:
+                message = await asyncio.to_thread(self.conn.recv)
+                if "forked" in message:
+                    self.child_pid = message["forked"]
+                    continue
+                if "stream" in message and "success" not in message:
+                    if on_stream:
+                        on_stream(message["stream"])
+                    continue
+                self.tasks_done += 1
+                return message
+        finally:
+            self.busy = False
+            self.child_pid = None
+
+    def kill(self) -> float:
+        """强制终止工作进程，返回进程完全退出（资源被系统回收）所用的秒数
+
+        fork 服务器模式下只终止当前执行的子进程，zygote 回收子进程后发回失败结果并继续服务。
+        """
+        start = time.perf_counter()
+        if self.fork_per_task and self.child_pid and self.is_alive():
+            try:
+                os.kill(self.child_pid, signal.SIGKILL)
+                return time.perf_counter() - start
+            except ProcessLookupError:
+                pass
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+        return time.perf_counter() - start
+
+    def close(self, timeout: float = 2.0):
+        """请求工作进程退出，超时未退出则强制终止"""
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout)
+        self.conn.close()
+
+
+async def run_with_timeout(worker: CodeWorker, task: Dict[str, Any], timeout: float,
+                           on_stream: Callable[[str], None] = None) -> Dict[str, Any]:
+    """在指定工作进程中执行任务
+
+    执行超过 timeout 秒时强制终止该工作进程，返回 killed=True 的结果；
+    工作进程异常退出时返回失败结果。两种情况下调用方都应丢弃该进程。
+    调用方被取消（工具调用取消、插件重载）时同样终止该进程，此时 worker.busy 仍为 True，调用方应丢弃并补充。
+    """
+    run_task = asyncio.ensure_future(worker.run(task, on_stream))
+    try:
+        return await asyncio.wait_for(asyncio.shield(run_task), timeout=timeout)
+    except asyncio.CancelledError:
+        # 不再有人等待结果，执行却仍在进行：直接发信号终止（不阻塞事件循环），管道读取随之以 EOFError 结束
+        if worker.fork_per_task and worker.child_pid:
+            try:
+                os.kill(worker.child_pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        worker.process.kill()
+        run_task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        logger.warning(f"工作进程 {worker.worker_id} 的执行被取消，进程已被终止")
+        raise
+    except asyncio.TimeoutError:
+        start = time.perf_counter()
+        await asyncio.to_thread(worker.kill)
+        # 进程退出后管道读取会抛出 EOFError（fork 模式下则收到 zygote 发回的失败结果），这里等待并吞掉
+        await asyncio.gather(run_task, return_exceptions=True)
+        reclaim_time = time.perf_counter() - start
+        logger.warning(f"工作进程 {worker.worker_id} 执行超时已被终止，资源回收耗时 {reclaim_time:.3f}s")
+        return {
+            "success": False, "killed": True, "reclaim_time": reclaim_time,
+            "error": f"代码执行超时（超过 {timeout} 秒），执行进程已被强制终止",
+            "output": None, "file_paths": [],
+        }
+    except (EOFError, OSError) as e:
+        await asyncio.to_thread(worker.process.join, 1)
+        exitcode = worker.process.exitcode
+        logger.error(f"工作进程 {worker.worker_id} 异常退出 (exitcode={exitcode}): {e}")
+        if exitcode == -getattr(signal, "SIGKILL", 9):
+            error = "执行进程被系统强制终止，可能是内存耗尽（超出系统可用内存或内存限制）"
+        else:
+            error = f"执行进程异常退出（退出码 {exitcode}）: {e}"
+        return {"success": False, "error": error, "output": None, "file_paths": []}
+
+
+class WorkerPool:
+    """预热的常驻工作进程池
+
+    代码在独立进程中执行，不再占用 AstrBot 主进程的 GIL，多个任务可以并行使用多个CPU核心。
+    排队上限由插件的 ExecutionScheduler 负责，进程池本身不限制等待的任务数。
+    """
+
+    def __init__(self, size: int, max_tasks_per_worker: int, options: Dict[str, Any]):
+        self.size = max(1, size)
+        self.max_tasks_per_worker = max(0, max_tasks_per_worker)
+        self.options = options
+        # 使用 spawn 避免 fork 正在运行事件循环的 AstrBot 主进程
+        self._ctx = multiprocessing.get_context("spawn")
+        self._idle: asyncio.Queue = asyncio.Queue()
+        self._workers: Dict[int, CodeWorker] = {}
+        self._next_worker_id = 0
+        self._start_lock = asyncio.Lock()
+        self._started = False
+        self._closed = False
+
+    async def start(self):
+        """启动并预热全部工作进程"""
+        async with self._start_lock:
+            if self._started:
+                return
+            await asyncio.gather(*(self._spawn_worker() for _ in range(self.size)))
+            self._started = True
+            logger.info(f"代码执行进程池已启动，共 {self.size} 个工作进程")
+
+    async def _spawn_worker(self):
+        self._next_worker_id += 1
+        worker = CodeWorker(self._ctx, self.options, self._next_worker_id)
+        try:
+            await worker.wait_ready()
+        except Exception as e:
+            logger.error(f"工作进程 {worker.worker_id} 启动失败: {e}", exc_info=True)
+            worker.close()
+            raise
+        if self._closed:
+            await asyncio.to_thread(worker.close)
+            return
+        self._workers[worker.worker_id] = worker
+        self._idle.put_nowait(worker)
+        logger.debug(f"工作进程 {worker.worker_id} 已就绪 (pid={worker.pid})")
+
+    async def _replace_worker(self, worker: CodeWorker):
+        self._workers.pop(worker.worker_id, None)
+        await asyncio.to_thread(worker.close)
+        if not self._closed:
+            await self._respawn()
+
+    def _release(self, worker: CodeWorker):
+        """任务结束后归还工作进程，必要时回收并重新创建"""
+        if self._closed:
+            asyncio.create_task(asyncio.to_thread(worker.close))
+            return
+        needs_recycle = not worker.is_alive() or (
+            self.max_tasks_per_worker and worker.tasks_done >= self.max_tasks_per_worker
+        )
+        if needs_recycle:
+            logger.debug(f"回收工作进程 {worker.worker_id}（已执行 {worker.tasks_done} 个任务）")
+            asyncio.create_task(self._replace_worker(worker))
+        else:
+            self._idle.put_nowait(worker)
+
+    async def execute(self, task: Dict[str, Any], timeout: float,
+                      on_stream: Callable[[str], None] = None) -> Dict[str, Any]:
+        """在空闲工作进程中执行任务
+
+        执行超过 timeout 秒时强制终止该工作进程并补充新进程，返回 killed=True 的结果。
+        """
+        if not self._started:
+            await self.start()
+        worker = await self._idle.get()
+
+        try:
+            return await run_with_timeout(worker, task, timeout, on_stream)
+        finally:
+            if worker.worker_id in self._workers:
+                if worker.busy:
+                    # 调用方被取消，进程已被终止但管道读取可能尚未结束：直接丢弃并补充
+                    asyncio.create_task(self._replace_worker(worker))
+                else:
+                    # 被终止或异常退出的进程由 _release 回收并补充
+                    self._release(worker)
+
+    async def _respawn(self):
+        try:
+            await self._spawn_worker()
+        except Exception as e:
+            logger.error(f"补充工作进程失败: {e}", exc_info=True)
+
+    async def shutdown(self):
+        """关闭全部工作进程"""
+        self._closed = True
+        workers = list(self._workers.values())
+        self._workers.clear()
+        await asyncio.gather(*(asyncio.to_thread(w.close) for w in workers), return_exceptions=True)
+        logger.info("代码执行进程池已关闭")
+
+
+class SessionPool:
+    """会话模式：每个会话（unified_msg_origin 加执行身份）一个专用工作进程，命名空间在多次执行之间保留
+
+    - 空闲超过 idle_ttl 秒的会话由后台任务回收
+    - 会话数超过 max_sessions 时按 LRU 淘汰最久未使用的空闲会话
+    - 执行后工作进程常驻内存超过 memory_limit_mb 时重置该会话
+    同一会话内的执行串行进行，超时或进程异常退出时会话随进程一起丢弃。
+    """
+
+    def __init__(self, max_sessions: int, idle_ttl: float, memory_limit_mb: int, options: Dict[str, Any]):
+        self.max_sessions = max(1, max_sessions)
+        self.idle_ttl = max(1, idle_ttl)
+        self.memory_limit_mb = max(0, memory_limit_mb)
+        self.options = dict(options, session=True)
+        self._ctx = multiprocessing.get_context("spawn")
+        # 会话ID -> 工作进程；OrderedDict 的顺序即最近使用顺序
+        self._sessions: "OrderedDict[str, CodeWorker]" = OrderedDict()
+        self._last_used: Dict[str, float] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._next_worker_id = 0
+        self._reaper_task = None
+        self._closed = False
+
+    @property
+    def active_sessions(self) -> int:
+        return len(self._sessions)
+
+    def start(self):
+        if self._reaper_task is None:
+            self._reaper_task = asyncio.create_task(self._reap_idle())
+
+    async def _drop(self, session_id: str, reason: str):
+        worker = self._sessions.pop(session_id, None)
+        self._last_used.pop(session_id, None)
+        if worker:
+            logger.info(f"会话 {session_id} 已关闭：{reason}")
+            await asyncio.to_thread(worker.close)
+
+    async def _evict_if_full(self):
+        """会话数达到上限时淘汰最久未使用的空闲会话"""
+        while len(self._sessions) >= self.max_sessions:
+            idle = [sid for sid, worker in self._sessions.items() if not worker.busy]
+            if not idle:
+                return
+            await self._drop(idle[0], "会话数达到上限，按LRU淘汰")
+
+    async def _get_worker(self, session_id: str) -> CodeWorker:
+        worker = self._sessions.get(session_id)
+        if worker and worker.is_alive():
+            self._sessions.move_to_end(session_id)
+            return worker
+        if worker:
+            await self._drop(session_id, "工作进程已退出")
+        await self._evict_if_full()
+        self._next_worker_id += 1
+        worker = CodeWorker(self._ctx, self.options, self._next_worker_id)
+        try:
+            await worker.wait_ready()
+        except Exception:
+            await asyncio.to_thread(worker.close)
+            raise
+        self._sessions[session_id] = worker
+        logger.info(f"会话 {session_id} 已创建 (pid={worker.pid})")
+        return worker
+
+    async def execute(self, session_id: str, task: Dict[str, Any], timeout: float,
+                      on_stream: Callable[[str], None] = None) -> Dict[str, Any]:
+        """在会话的专用工作进程中执行任务，结果中 session_reset 非空表示会话已被重置"""
+        lock = self._locks.setdefault(session_id, asyncio.Lock())
+        async with lock:
+            worker = await self._get_worker(session_id)
+            try:
+                result = await run_with_timeout(worker, task, timeout, on_stream)
+            except asyncio.CancelledError:
+                # 执行被取消时进程已被终止，会话随之丢弃
+                self._sessions.pop(session_id, None)
+                self._last_used.pop(session_id, None)
+                asyncio.create_task(asyncio.to_thread(worker.close))
+                raise
+            self._last_used[session_id] = time.monotonic()
+            if not worker.is_alive():
+                self._sessions.pop(session_id, None)
+                self._last_used.pop(session_id, None)
+                result["session_reset"] = "执行进程已终止，会话中的变量已丢失"
+                return result
+            rss_mb = result.get("process_rss_mb")
+            if self.memory_limit_mb and rss_mb and rss_mb > self.memory_limit_mb:
+                await self._drop(session_id, f"内存占用 {rss_mb:.0f}MB 超过上限 {self.memory_limit_mb}MB")
+                result["session_reset"] = f"会话内存占用超过 {self.memory_limit_mb}MB，已重置，变量已丢失"
+            return result
+
+    async def reset(self, session_id: str) -> bool:
+        """关闭并丢弃会话，返回会话是否存在"""
+        if session_id not in self._sessions:
+            return False
+        async with self._locks.setdefault(session_id, asyncio.Lock()):
+            await self._drop(session_id, "用户请求重置")
+        return True
+
+    async def _reap_idle(self):
+        """定期回收空闲超时的会话"""
+        while not self._closed:
+            await asyncio.sleep(min(60, self.idle_ttl / 2))
+            now = time.monotonic()
+            for session_id, worker in list(self._sessions.items()):
+                if not worker.busy and now - self._last_used.get(session_id, now) > self.idle_ttl:
+                    await self._drop(session_id, f"空闲超过 {self.idle_ttl} 秒")
+
+    async def shutdown(self):
+        """关闭全部会话"""
+        self._closed = True
+        if self._reaper_task:
+            self._reaper_task.cancel()
+        workers = list(self._sessions.values())
+        self._sessions.clear()
+        self._last_used.clear()
+        await asyncio.gather(*(asyncio.to_thread(w.close) for w in workers), return_exceptions=True)
+        logger.info("代码执行会话已全部关闭")